@@ -0,0 +1,179 @@
+"""
+Archivado de las tablas de salida ya procesadas.
+
+Mueve las filas procesadas más viejas que la ventana de retención desde las
+tablas "calientes" (mensaje_a_sms, mensaje_a_telegram, mensaje_llamada_por_robo,
+telegram_observaciones) a <tabla>_archivo, en bloques acotados y con pausas
+para no competir con los workers.
+
+Uso:
+    python archive_messages.py                          # Una pasada sobre todas las tablas
+    python archive_messages.py --retention-days 15 --chunk 200 --sleep 1
+    python archive_messages.py --tables mensaje_a_sms --loop 3600
+
+También puede correr dentro de un worker como tarea de fondo:
+    ArchiveJob(open_db, tables=["mensaje_a_sms"]).start(interval=3600)
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+from threading import Thread, Event
+from dotenv import load_dotenv
+from dbSigesmen import Database
+
+logger = logging.getLogger(__name__)
+
+# tabla -> condición extra además de la antigüedad (solo se archiva lo ya procesado)
+ARCHIVE_TABLES = {
+    "mensaje_a_telegram": "men_status = 1",
+    "mensaje_a_sms": "men_status = 1",
+    "mensaje_llamada_por_robo": "men_status = 1",
+    "telegram_observaciones": None,
+}
+ARCHIVE_SUFFIX = "_archivo"
+# Método de Database -> descripción para el log
+PURGES = [
+    ("purge_expired_leases", "leases vencidos"),
+    ("purge_chat_events", "avisos de telegram_chat_evento"),
+    ("purge_call_cooldown", "cooldowns de llamadas vencidos"),
+]
+
+CREATE_ARCHIVE_TABLE = "CREATE TABLE IF NOT EXISTS {archive} LIKE {table}"
+GET_PRIMARY_KEY = """SELECT COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE
+WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND CONSTRAINT_NAME = 'PRIMARY'
+ORDER BY ORDINAL_POSITION LIMIT 1"""
+GET_DATE_COLUMN = """SELECT COLUMN_NAME FROM information_schema.COLUMNS
+WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND DATA_TYPE IN ('date', 'datetime', 'timestamp')
+ORDER BY ORDINAL_POSITION LIMIT 1"""
+
+
+class ArchiveJob(object):
+    """
+    Archiva por bloques las filas procesadas con más de retention_days días.
+    open_db es una función que devuelve un Database listo para usar con 'with'
+    (por ejemplo uno que toma la conexión del pool del worker).
+    """
+    def __init__(self, open_db, tables=None, retention_days=30, chunk_size=500, pause=0.5):
+        unknown = [table for table in (tables or []) if table not in ARCHIVE_TABLES]
+        if unknown:
+            raise ValueError(f"Tablas no archivables: {unknown}")
+        self.__open_db = open_db
+        self.__tables = list(tables or ARCHIVE_TABLES)
+        self.__retention_days = retention_days
+        self.__chunk_size = chunk_size
+        self.__pause = pause
+        self.__columns = {}  # tabla -> (clave primaria, columna de fecha)
+        self.__stop = Event()
+        self.__thread = None
+        self.last_report = {}
+
+    def __describe(self, db, table):
+        """Detecta la clave primaria y la primera columna de fecha de la tabla."""
+        if table not in self.__columns:
+            key = db.get_one_row(GET_PRIMARY_KEY, (table,))
+            date = db.get_one_row(GET_DATE_COLUMN, (table,))
+            if not key or not date:
+                raise ValueError(f"La tabla {table} necesita clave primaria y una columna de fecha para archivarse")
+            db.execute(CREATE_ARCHIVE_TABLE.format(archive=table + ARCHIVE_SUFFIX, table=table))
+            self.__columns[table] = (key[0], date[0])
+        return self.__columns[table]
+
+    def archive_table(self, table):
+        """Archiva una tabla hasta agotar las filas vencidas. Devuelve el reporte de la pasada."""
+        moved = 0
+        chunks = 0
+        lock_total = 0.0
+        lock_max = 0.0
+        start_time = time.time()
+        while not self.__stop.is_set():
+            with self.__open_db() as db:
+                key, date = self.__describe(db, table)
+                where = f"`{date}` < NOW() - INTERVAL %s DAY"
+                if ARCHIVE_TABLES[table]:
+                    where += f" AND {ARCHIVE_TABLES[table]}"
+                count, lock_seconds = db.move_rows(table, table + ARCHIVE_SUFFIX, key, where, (self.__retention_days,), self.__chunk_size)
+            moved += count
+            chunks += 1
+            lock_total += lock_seconds
+            lock_max = max(lock_max, lock_seconds)
+            if count < self.__chunk_size:
+                break
+            # Pausa entre bloques para dejar pasar a los workers
+            self.__stop.wait(self.__pause)
+
+        elapsed = time.time() - start_time
+        report = {
+            "rows_moved": moved,
+            "chunks": chunks,
+            "seconds": round(elapsed, 2),
+            "rows_per_second": round(moved / elapsed, 1) if elapsed > 0 else 0.0,
+            "lock_seconds_total": round(lock_total, 3),
+            "lock_seconds_max": round(lock_max, 3),
+        }
+        logger.info(f"Archivado {table}: {moved} filas en {report['seconds']}s ({report['rows_per_second']} filas/s), lock total {report['lock_seconds_total']}s, máx {report['lock_seconds_max']}s")
+        return report
+
+    def run_once(self):
+        """Una pasada completa sobre todas las tablas configuradas."""
+        report = {}
+        for table in self.__tables:
+            try:
+                report[table] = self.archive_table(table)
+            except Exception as e:
+                logger.error(f"Error archivando {table}: {e}", exc_info=True)
+                report[table] = {"error": str(e)}
+        # Tablas auxiliares que sólo crecen: leases vencidos hace tiempo (mensajes
+        # que otro worker ya completó), avisos de chat_id ya leídos y cooldowns vencidos
+        for purge, description in PURGES:
+            try:
+                with self.__open_db() as db:
+                    getattr(db, purge)()
+            except Exception as e:
+                logger.warning(f"No se pudieron purgar {description}: {e}")
+        self.last_report = report
+        return report
+
+    def start(self, interval=3600):
+        """Corre run_once cada 'interval' segundos en un hilo de fondo."""
+        def loop():
+            while not self.__stop.is_set():
+                self.run_once()
+                self.__stop.wait(interval)
+        self.__thread = Thread(target=loop, name="archive-job", daemon=True)
+        self.__thread.start()
+        return self.__thread
+
+    def stop(self):
+        self.__stop.set()
+
+
+def main(argv=None):
+    load_dotenv()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description="Archiva mensajes procesados de las tablas de salida")
+    parser.add_argument("--tables", nargs="+", default=list(ARCHIVE_TABLES), choices=list(ARCHIVE_TABLES))
+    parser.add_argument("--retention-days", type=int, default=int(os.getenv("ARCHIVE_RETENTION_DAYS", "30")))
+    parser.add_argument("--chunk", type=int, default=500, help="Filas por transacción")
+    parser.add_argument("--sleep", type=float, default=0.5, help="Pausa entre bloques (segundos)")
+    parser.add_argument("--loop", type=int, default=0, help="Repetir cada N segundos (0 = una sola pasada)")
+    args = parser.parse_args(argv)
+
+    def open_db():
+        return Database(os.getenv("DB_USER"), os.getenv("DB_PASSWORD"), os.getenv("DB_HOST"), int(os.getenv("DB_PORT", 3306)), os.getenv("DB_DATABASE"))
+
+    job = ArchiveJob(open_db, args.tables, args.retention_days, args.chunk, args.sleep)
+    while True:
+        report = job.run_once()
+        if not args.loop:
+            break
+        time.sleep(args.loop)
+    return 1 if any("error" in table_report for table_report in report.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,355 @@
+"""
+Transacciones AT sobre el puerto serie del módem GSM.
+
+send_at_command dormía 0.5 s después de escribir, sondeaba in_waiting cada
+0.1 s y dormía otros 0.3 s al ver OK: cada intercambio costaba ~0.9 s
+aunque el módem contestara en 20 ms. ModemChannel lee con lecturas
+bloqueantes hasta un código de resultado final (OK, ERROR, +CMS ERROR,
++CME ERROR, ...) o el prompt '>', con un plazo por comando: la latencia
+la pone el módem, no nuestros sleeps.
+
+ModemChannel es dueño del puerto: un hilo lector reparte las respuestas
+al comando en curso (un Future por comando, en una cola FIFO) y los
+códigos no solicitados (+CMTI, +CDS, RING, +CREG, ...) a los suscriptores,
+sin vaciar el buffer de entrada entre comandos.
+"""
+import re
+import time
+import logging
+from collections import deque
+from concurrent.futures import Future
+from threading import Lock, Thread, current_thread
+
+logger = logging.getLogger(__name__)
+
+# Códigos de resultado que terminan un comando
+FINAL_OK = ("OK",)
+FINAL_ERRORS = ("ERROR", "NO CARRIER", "BUSY", "NO ANSWER", "NO DIALTONE", "COMMAND NOT SUPPORT")
+FINAL_ERROR_PREFIXES = ("+CMS ERROR:", "+CME ERROR:")
+PROMPT = ">"
+CTRL_Z = b"\x1a"
+ESC = b"\x1b"
+
+CMGS_REFERENCE = re.compile(r"\+CMGS:\s*(\d+)")
+RESPONSE_PREFIX = re.compile(r"^AT([+^$#*][A-Z0-9]+)", re.IGNORECASE)
+
+# Códigos no solicitados habituales; los de URC_WITH_BODY traen una segunda línea
+URC_PREFIXES = ("+CMTI:", "+CMT:", "+CDS:", "+CDSI:", "+CBM:", "RING", "+CLIP:", "+CRING:", "+CREG:", "+CGREG:",
+                "+CEREG:", "+CUSD:", "+CIEV:", "+CPIN:", "+CFUN:", "RDY", "^", "+PBREADY", "PB DONE",
+                "SMS READY", "SMS Ready", "CALL READY", "Call Ready")
+URC_WITH_BODY = ("+CMT:", "+CBM:")
+
+
+def is_final(line):
+    return line in FINAL_OK or line in FINAL_ERRORS or line.startswith(FINAL_ERROR_PREFIXES)
+
+
+def sms_result(response):
+    """(ok, referencia o motivo) a partir de la respuesta al envío de un AT+CMGS."""
+    if response.timed_out:
+        if response.command and response.command.startswith("AT+CMGS") and not response.prompted:
+            return False, "Timeout esperando prompt '>' del módem"
+        return False, f"Timeout esperando confirmación +CMGS del módem: {response.lines}"
+    if not response.ok:
+        return False, f"Envío rechazado: {response.text}"
+    match = CMGS_REFERENCE.search(response.text)
+    return True, match.group(1) if match else "unknown"
+
+
+class ATResponse(object):
+    """Resultado de un comando: líneas intermedias, código final y cuánto tardó."""
+    def __init__(self, command, lines, final, elapsed, prompted=False):
+        self.command = command
+        self.lines = lines      # Líneas de información (sin eco ni código final)
+        self.final = final      # "OK", "ERROR", "+CMS ERROR: n", ">" o None si venció el plazo
+        self.elapsed = elapsed
+        self.prompted = prompted  # Con cuerpo (AT+CMGS): si llegó a verse el prompt '>'
+
+    @property
+    def ok(self):
+        return self.final in FINAL_OK
+
+    @property
+    def prompt(self):
+        return self.final == PROMPT
+
+    @property
+    def timed_out(self):
+        return self.final is None
+
+    @property
+    def text(self):
+        """Respuesta como texto, con el mismo aspecto que devolvía send_at_command."""
+        return "\n".join(self.lines + ([self.final] if self.final else []))
+
+    def __repr__(self):
+        return f"ATResponse({self.command!r}, final={self.final!r}, lines={self.lines!r}, {self.elapsed * 1000:.0f} ms)"
+
+
+class _PendingCommand(object):
+    """Comando encolado en un ModemChannel."""
+    def __init__(self, command, payload, timeout, prompt_timeout, after=None):
+        self.command = command
+        self.after = after                # Future que debe haber terminado con OK (si no, se cancela este)
+        self.payload = payload            # Cuerpo a enviar tras el prompt '>' (o None)
+        self.timeout = timeout
+        self.prompt_timeout = prompt_timeout
+        match = RESPONSE_PREFIX.match(command)
+        self.response_prefix = match.group(1).upper() + ":" if match else None
+        self.future = Future()
+        self.lines = []
+        self.started = None
+        self.deadline = None
+        self.prompted = False
+
+
+class ModemChannel(object):
+    """
+    Dueño exclusivo del puerto serie. submit() encola un comando y
+    devuelve un Future con su ATResponse; el siguiente se escribe apenas
+    llega el código final del anterior (V.250 no admite dos comandos en
+    vuelo), sin sleeps ni reset_input_buffer. Un comando con 'payload'
+    (AT+CMGS) es una única transacción: el lector envía el cuerpo al ver
+    '>' y espera el resultado del envío.
+
+    Las líneas que no pertenecen al comando en curso se entregan a los
+    suscriptores como callback(línea, cuerpo) desde el hilo lector: los
+    callbacks deben ser rápidos y no pueden esperar comandos del canal.
+    """
+    def __init__(self, port, default_timeout=5, read_slice=0.2, encoding="utf-8",
+                 urc_prefixes=URC_PREFIXES, urc_with_body=URC_WITH_BODY, name="modem"):
+        self.port = port
+        self.name = name
+        self.__default_timeout = default_timeout
+        self.__encoding = encoding
+        self.__urc_prefixes = tuple(urc_prefixes)
+        self.__urc_with_body = tuple(urc_with_body)
+        self.__buffer = b""
+        self.__queue = deque()
+        self.__current = None
+        self.__urc_waiting_body = None
+        self.__subscribers = []  # (prefijo, callback); prefijo "" recibe todo
+        self.__lock = Lock()
+        self.__running = False
+        self.__error = None
+        self.__thread = None
+        self.__stats = {"commands": 0, "timeouts": 0, "errors": 0, "urcs": 0, "latency_total": 0.0, "latency_max": 0.0}
+        self.__urc_counts = {}
+        port.timeout = read_slice
+
+    @property
+    def alive(self):
+        return self.__running and self.__error is None
+
+    def start(self):
+        self.__running = True
+        self.__thread = Thread(target=self.__read_loop, name=f"{self.name}-reader", daemon=True)
+        self.__thread.start()
+        return self
+
+    def close(self, timeout=2):
+        """Detiene el lector y falla los comandos pendientes. No cierra el puerto."""
+        self.__running = False
+        if self.__thread is not None and self.__thread is not current_thread():
+            self.__thread.join(timeout)
+        self.__fail_all(ConnectionError(f"Canal {self.name} cerrado"))
+
+    def subscribe(self, prefix, callback):
+        """callback(línea, cuerpo) para cada código no solicitado que empieza con 'prefix' ("" = todos)."""
+        with self.__lock:
+            self.__subscribers.append((prefix, callback))
+
+    def submit(self, command, timeout=None, payload=None, prompt_timeout=10, after=None):
+        """
+        Encola 'command'. Con 'payload' espera '>' (prompt_timeout), envía el
+        cuerpo + Ctrl+Z y su resultado (timeout). Con 'after' (el Future de
+        un comando encolado antes) se cancela sin escribirse si aquel no terminó con OK.
+        """
+        pending = _PendingCommand(command, payload, timeout if timeout is not None else self.__default_timeout,
+                                  prompt_timeout, after)
+        with self.__lock:
+            if self.__error is not None or not self.__running:
+                raise ConnectionError(f"Canal {self.name} no disponible: {self.__error or 'detenido'}")
+            self.__queue.append(pending)
+            self.__advance()
+        return pending.future
+
+    def command(self, command, timeout=None):
+        """submit() bloqueante: devuelve el ATResponse."""
+        return self.submit(command, timeout).result()
+
+    def send_sms_text(self, number, text, prompt_timeout=10, submit_timeout=30):
+        """AT+CMGS en modo texto. Devuelve (ok, referencia o motivo del error)."""
+        response = self.submit(f'AT+CMGS="{number}"', timeout=submit_timeout, payload=text.encode(self.__encoding),
+                               prompt_timeout=prompt_timeout).result()
+        return sms_result(response)
+
+    def send_sms_pdu(self, pdus, prompt_timeout=10, submit_timeout=30):
+        """
+        AT+CMGS=<largo> en modo PDU para cada (pdu_hex, largo) de 'pdus'.
+        Los segmentos se encolan juntos: cada uno se escribe apenas llega el
+        +CMGS del anterior, y si uno falla los siguientes no se envían.
+        Devuelve (ok, referencias separadas por coma o motivo del error).
+        """
+        futures = []
+        for pdu, length in pdus:
+            futures.append(self.submit(f"AT+CMGS={length}", timeout=submit_timeout, payload=pdu.encode("ascii"),
+                                       prompt_timeout=prompt_timeout, after=futures[-1] if futures else None))
+        references = []
+        for index, future in enumerate(futures, 1):
+            ok, result = sms_result(future.result())
+            if not ok:
+                for rest in futures[index:]:
+                    rest.cancel()
+                prefix = f"Segmento {index}/{len(futures)}: " if len(futures) > 1 else ""
+                return False, prefix + result
+            references.append(result)
+        return True, ",".join(references)
+
+    def wait_ready(self, timeout=5, probe_timeout=0.5):
+        """Repite AT hasta que el módem conteste OK."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.command("AT", timeout=min(probe_timeout, max(0.05, deadline - time.monotonic()))).ok:
+                return True
+        return False
+
+    def __advance(self):
+        """Escribe el próximo comando si no hay uno en vuelo. Llamar con el lock tomado."""
+        while self.__current is None and self.__queue:
+            pending = self.__queue.popleft()
+            if pending.future.cancelled():
+                continue
+            if pending.after is not None and not self.__succeeded(pending.after):
+                pending.future.cancel()
+                continue
+            pending.started = time.monotonic()
+            pending.deadline = pending.started + (pending.prompt_timeout if pending.payload is not None else pending.timeout)
+            try:
+                self.port.write((pending.command + "\r\n").encode(self.__encoding))
+            except Exception as e:
+                pending.future.set_exception(e)
+                continue
+            self.__current = pending
+
+    @staticmethod
+    def __succeeded(future):
+        return future.done() and not future.cancelled() and future.exception() is None and future.result().ok
+
+    def __complete(self, final):
+        """Resuelve el comando en curso y escribe el siguiente. Llamar con el lock tomado."""
+        pending, self.__current = self.__current, None
+        elapsed = time.monotonic() - pending.started
+        response = ATResponse(pending.command, pending.lines, final, elapsed, pending.prompted)
+        self.__stats["commands"] += 1
+        self.__stats["latency_total"] += elapsed
+        self.__stats["latency_max"] = max(self.__stats["latency_max"], elapsed)
+        if response.timed_out:
+            self.__stats["timeouts"] += 1
+            logger.warning(f"[{self.name}] Sin respuesta final a '{pending.command}' en {elapsed:.1f}s: {pending.lines}")
+            if pending.payload is not None and not pending.prompted:
+                self.port.write(ESC)  # No dejar el módem esperando el cuerpo
+        elif not response.ok:
+            self.__stats["errors"] += 1
+        pending.future.set_result(response)
+        self.__advance()
+
+    def __is_urc(self, line, pending):
+        if pending is not None and pending.response_prefix and line.upper().startswith(pending.response_prefix):
+            return False
+        return line.startswith(self.__urc_prefixes)
+
+    def __handle_line(self, line):
+        """Clasifica una línea. Devuelve el URC a despachar (línea, cuerpo) o None."""
+        if self.__urc_waiting_body is not None:
+            header, self.__urc_waiting_body = self.__urc_waiting_body, None
+            return header, line
+        pending = self.__current
+        if pending is not None:
+            if line == pending.command:
+                return None  # Eco (ATE1)
+            if is_final(line):
+                self.__complete(line)
+                return None
+        if pending is None or self.__is_urc(line, pending):
+            if line.startswith(self.__urc_with_body):
+                self.__urc_waiting_body = line
+                return None
+            return line, None
+        pending.lines.append(line)
+        return None
+
+    def __check_prompt(self):
+        """El prompt '>' llega sin fin de línea. Llamar con el lock tomado."""
+        pending = self.__current
+        if pending is None or pending.payload is None or pending.prompted:
+            return
+        if self.__buffer.strip() != PROMPT.encode():
+            return
+        self.__buffer = b""
+        pending.prompted = True
+        pending.deadline = time.monotonic() + pending.timeout
+        self.port.write(pending.payload + CTRL_Z)
+
+    def __dispatch(self, line, body):
+        with self.__lock:
+            self.__stats["urcs"] += 1
+            key = line.split(":", 1)[0]
+            self.__urc_counts[key] = self.__urc_counts.get(key, 0) + 1
+            subscribers = [callback for prefix, callback in self.__subscribers if line.startswith(prefix)]
+        if not subscribers:
+            logger.info(f"[{self.name}] Código no solicitado sin suscriptores: {line}")
+        for callback in subscribers:
+            try:
+                callback(line, body)
+            except Exception as e:
+                logger.error(f"[{self.name}] Error en suscriptor de '{line}': {e}", exc_info=True)
+
+    def __read_loop(self):
+        while self.__running:
+            try:
+                chunk = self.port.read(self.port.in_waiting or 1)
+            except Exception as e:
+                logger.error(f"[{self.name}] Error leyendo el puerto serie: {e}")
+                self.__error = e
+                self.__fail_all(e)
+                return
+            urcs = []
+            with self.__lock:
+                self.__buffer += chunk
+                while True:
+                    cut = min((i for i in (self.__buffer.find(b"\r"), self.__buffer.find(b"\n")) if i >= 0), default=-1)
+                    if cut < 0:
+                        break
+                    raw, self.__buffer = self.__buffer[:cut], self.__buffer[cut + 1:]
+                    line = raw.decode(self.__encoding, errors="ignore").strip()
+                    if line:
+                        urc = self.__handle_line(line)
+                        if urc is not None:
+                            urcs.append(urc)
+                self.__check_prompt()
+                if self.__current is not None and time.monotonic() >= self.__current.deadline:
+                    self.__complete(None)
+            # Los suscriptores corren fuera del lock
+            for line, body in urcs:
+                self.__dispatch(line, body)
+
+    def __fail_all(self, error):
+        with self.__lock:
+            pending = ([self.__current] if self.__current else []) + list(self.__queue)
+            self.__current = None
+            self.__queue.clear()
+        for item in pending:
+            if not item.future.done():
+                item.future.set_exception(error)
+
+    def get_stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats["queued"] = len(self.__queue) + (1 if self.__current else 0)
+            stats["urc_counts"] = dict(self.__urc_counts)
+        total = stats.pop("latency_total")
+        stats["latency_avg_ms"] = round(total / stats["commands"] * 1000) if stats["commands"] else 0
+        stats["latency_max_ms"] = round(stats.pop("latency_max") * 1000)
+        stats["alive"] = self.alive
+        return stats
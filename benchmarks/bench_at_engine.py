@@ -0,0 +1,206 @@
+"""
+Benchmark de intercambios AT: send_at_command / envío de SMS anteriores
+(copiados acá, con sus sleeps fijos) contra at_modem.ModemChannel, sobre un
+módem simulado que contesta con una latencia configurable.
+
+Uso:
+    python benchmarks/bench_at_engine.py
+    python benchmarks/bench_at_engine.py --latency 0.02 --submit-latency 0.8 --rounds 3
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from at_modem import ModemChannel  # noqa: E402
+
+
+class FakeModem(object):
+    """
+    Imita un serial.Serial conectado a un módem con eco (ATE1): cada
+    respuesta queda disponible 'latency' segundos después de la escritura
+    (submit_latency para el Ctrl+Z del SMS). read() respeta self.timeout.
+    """
+    def __init__(self, latency=0.02, submit_latency=0.8):
+        self.latency = latency
+        self.submit_latency = submit_latency
+        self.timeout = 3
+        self.is_open = True
+        self.__pending = []  # (disponible_desde, bytes)
+        self.__line = b""
+        self.__in_body = False
+        self.__reference = 0
+        self.__cond = threading.Condition()
+
+    def __push(self, delay, data):
+        with self.__cond:
+            self.__pending.append((time.monotonic() + delay, data))
+            self.__cond.notify_all()
+
+    def write(self, data):
+        for byte in data:
+            char = bytes([byte])
+            if self.__in_body:
+                if char == b"\x1a":
+                    self.__in_body = False
+                    self.__reference += 1
+                    self.__push(self.submit_latency, f"\r\n+CMGS: {self.__reference}\r\n\r\nOK\r\n".encode())
+                elif char == b"\x1b":
+                    self.__in_body = False
+                continue
+            if char in (b"\r", b"\n"):
+                if self.__line:
+                    self.__answer(self.__line.decode())
+                self.__line = b""
+            else:
+                self.__line += char
+        return len(data)
+
+    def __answer(self, command):
+        echo = command + "\r"
+        if command.startswith("AT+CMGS="):
+            self.__in_body = True
+            self.__push(self.latency, (echo + "\r\n> ").encode())
+        elif command == "AT+CSQ":
+            self.__push(self.latency, (echo + "\r\n+CSQ: 21,99\r\n\r\nOK\r\n").encode())
+        elif command == "AT+COPS?":
+            self.__push(self.latency, (echo + '\r\n+COPS: 0,0,"Personal AR"\r\n\r\nOK\r\n').encode())
+        else:
+            self.__push(self.latency, (echo + "\r\nOK\r\n").encode())
+
+    def __ready(self):
+        now = time.monotonic()
+        return b"".join(data for when, data in self.__pending if when <= now)
+
+    @property
+    def in_waiting(self):
+        with self.__cond:
+            return len(self.__ready())
+
+    def read(self, size=1):
+        deadline = time.monotonic() + (self.timeout if self.timeout is not None else 1e9)
+        with self.__cond:
+            while True:
+                now = time.monotonic()
+                ready = [(when, data) for when, data in self.__pending if when <= now]
+                if ready:
+                    data = b"".join(chunk for _, chunk in ready)
+                    self.__pending = [item for item in self.__pending if item[0] > now]
+                    out, rest = data[:size], data[size:]
+                    if rest:
+                        self.__pending.insert(0, (now, rest))
+                    return out
+                if now >= deadline:
+                    return b""
+                next_ready = min((when for when, _ in self.__pending), default=deadline)
+                self.__cond.wait(max(0.0, min(deadline, next_ready) - now))
+
+    def reset_input_buffer(self):
+        with self.__cond:
+            now = time.monotonic()
+            self.__pending = [item for item in self.__pending if item[0] > now]
+
+    def reset_output_buffer(self):
+        pass
+
+
+# --- Implementación anterior (send_to_sms_modem.py) ---
+
+def legacy_send_at_command(ser, command, timeout=5):
+    ser.reset_input_buffer()
+    ser.write((command + '\r\n').encode('utf-8'))
+    time.sleep(0.5)
+    response = b''
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        if ser.in_waiting:
+            response += ser.read(ser.in_waiting)
+            if b'OK' in response or b'ERROR' in response:
+                time.sleep(0.3)
+                if ser.in_waiting:
+                    response += ser.read(ser.in_waiting)
+                break
+        time.sleep(0.1)
+    return response.decode('utf-8', errors='ignore').strip()
+
+
+def legacy_send_sms(modem, phone, message):
+    modem.reset_input_buffer()
+    modem.reset_output_buffer()
+    response = legacy_send_at_command(modem, 'AT+CMGF=1')
+    if 'OK' not in response:
+        raise Exception("No se pudo configurar modo texto")
+    modem.write(f'AT+CMGS="{phone}"\r\n'.encode('utf-8'))
+    time.sleep(1)
+    start_time = time.time()
+    prompt_received = False
+    while time.time() - start_time < 10:
+        if modem.in_waiting:
+            if b'>' in modem.read(modem.in_waiting):
+                prompt_received = True
+                break
+        time.sleep(0.1)
+    if not prompt_received:
+        raise Exception("Timeout esperando prompt '>' del módem")
+    modem.write(message.encode('utf-8'))
+    modem.write(b'\x1A')
+    response = b''
+    start_time = time.time()
+    while time.time() - start_time < 30:
+        if modem.in_waiting:
+            response += modem.read(modem.in_waiting)
+            if b'+CMGS:' in response or b'OK' in response:
+                break
+        time.sleep(0.5)
+    return '+CMGS:' in response.decode('utf-8', errors='ignore')
+
+
+def channel_send_sms(channel, phone, message):
+    if not channel.command('AT+CMGF=1').ok:
+        raise Exception("No se pudo configurar modo texto")
+    ok, _ = channel.send_sms_text(phone, message)
+    return ok
+
+
+def measure(func, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = func()
+        samples.append(time.perf_counter() - start)
+        assert result, "respuesta inesperada"
+    return sum(samples) / len(samples)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del motor AT")
+    parser.add_argument("--latency", type=float, default=0.02, help="Latencia de respuesta del módem (s)")
+    parser.add_argument("--submit-latency", type=float, default=0.8, help="Latencia de +CMGS tras el Ctrl+Z (s)")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    phone, text = "+5493516483831", "ALARMA ROBO ZONA 3 - PUERTA PRINCIPAL"
+    legacy_modem = FakeModem(args.latency, args.submit_latency)
+    channel = ModemChannel(FakeModem(args.latency, args.submit_latency), name="bench").start()
+    cases = [
+        ("AT", lambda: "OK" in legacy_send_at_command(legacy_modem, "AT"), lambda: channel.command("AT").ok),
+        ("AT+CSQ", lambda: "+CSQ" in legacy_send_at_command(legacy_modem, "AT+CSQ"), lambda: channel.command("AT+CSQ").ok),
+        ("check_modem_status (AT + AT+CSQ)",
+         lambda: "OK" in legacy_send_at_command(legacy_modem, "AT") and "OK" in legacy_send_at_command(legacy_modem, "AT+CSQ"),
+         lambda: channel.command("AT").ok and channel.command("AT+CSQ").ok),
+        ("SMS (CMGF + CMGS)", lambda: legacy_send_sms(legacy_modem, phone, text), lambda: channel_send_sms(channel, phone, text)),
+    ]
+    print(f"Módem simulado: respuesta en {args.latency * 1000:.0f} ms, +CMGS en {args.submit_latency * 1000:.0f} ms")
+    print(f"{'intercambio':<34} {'anterior':>10} {'canal':>10} {'mejora':>8}")
+    for name, legacy, current in cases:
+        legacy_time = measure(legacy, args.rounds)
+        channel_time = measure(current, args.rounds)
+        print(f"{name:<34} {legacy_time * 1000:>8.0f}ms {channel_time * 1000:>8.0f}ms {legacy_time / channel_time:>7.1f}x")
+    channel.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
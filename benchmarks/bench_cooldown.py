@@ -0,0 +1,125 @@
+"""
+Micro-benchmark del cooldown de llamadas: ListaTemporal (implementación
+anterior de call_on_alarm.py, copiada acá) contra cooldown.ExpiringSet.
+
+Simula un ciclo de routine() con N abonados monitoreados: alta de todos,
+N consultas de pertenencia, renovación de la mitad y limpieza con la mitad
+vencida.
+
+Uso:
+    python benchmarks/bench_cooldown.py
+    python benchmarks/bench_cooldown.py --sizes 1000 10000 50000 --legacy-max 20000
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from cooldown import ExpiringSet  # noqa: E402
+
+
+class ListaTemporal:
+    """Copia de la implementación anterior (lista + dict)."""
+    def __init__(self, clock):
+        self.clock = clock
+        self.lista = []
+        self.elementos = {}
+
+    def insert(self, telefono, tiempo_expiracion):
+        self.lista.append(telefono)
+        self.elementos[telefono] = self.clock() + tiempo_expiracion
+
+    def clean(self):
+        tiempo_actual = self.clock()
+        elementos_a_eliminar = []
+        for telefono, tiempo_expiracion in self.elementos.items():
+            if tiempo_actual > tiempo_expiracion:
+                elementos_a_eliminar.append(telefono)
+        for telefono in elementos_a_eliminar:
+            if telefono in self.lista:
+                self.lista.remove(telefono)
+            if telefono in self.elementos:
+                del self.elementos[telefono]
+
+    def get_list(self):
+        return self.lista
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def run_legacy(size):
+    clock = FakeClock()
+    cooldown = ListaTemporal(clock)
+    timings = {}
+    start = time.perf_counter()
+    for client in range(size):
+        # La mitad vence antes de la limpieza
+        cooldown.insert(client, 30 if client % 2 else 90)
+    timings["insert"] = time.perf_counter() - start
+    start = time.perf_counter()
+    for client in range(size):
+        client in cooldown.get_list()
+    timings["contains"] = time.perf_counter() - start
+    start = time.perf_counter()
+    for client in range(0, size, 2):
+        cooldown.insert(client, 90)
+    timings["renew"] = time.perf_counter() - start
+    clock.now += 60
+    start = time.perf_counter()
+    cooldown.clean()
+    timings["clean"] = time.perf_counter() - start
+    return timings
+
+
+def run_expiring_set(size):
+    clock = FakeClock()
+    cooldown = ExpiringSet(clock)
+    timings = {}
+    start = time.perf_counter()
+    for client in range(size):
+        cooldown.add(client, 30 if client % 2 else 90)
+    timings["insert"] = time.perf_counter() - start
+    start = time.perf_counter()
+    for client in range(size):
+        client in cooldown
+    timings["contains"] = time.perf_counter() - start
+    start = time.perf_counter()
+    for client in range(0, size, 2):
+        cooldown.add(client, 90)
+    timings["renew"] = time.perf_counter() - start
+    clock.now += 60
+    start = time.perf_counter()
+    cooldown.clean()
+    timings["clean"] = time.perf_counter() - start
+    assert len(cooldown) == (size + 1) // 2
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del cooldown de llamadas")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--legacy-max", type=int, default=20000,
+                        help="No correr ListaTemporal por encima de este tamaño (es O(n²))")
+    args = parser.parse_args(argv)
+
+    print(f"{'abonados':>9} {'implementación':<14} {'insert':>9} {'contains':>9} {'renew':>9} {'clean':>9} {'total':>9}")
+    for size in args.sizes:
+        runs = [("ExpiringSet", run_expiring_set)]
+        if size <= args.legacy_max:
+            runs.insert(0, ("ListaTemporal", run_legacy))
+        for name, run in runs:
+            timings = run(size)
+            total = sum(timings.values())
+            print(f"{size:>9} {name:<14} " + " ".join(f"{timings[k]:>8.4f}s" for k in ("insert", "contains", "renew", "clean")) + f" {total:>8.4f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
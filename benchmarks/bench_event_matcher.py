@@ -0,0 +1,136 @@
+"""
+Micro-benchmark de is_event_to_call sobre mensajes de panel realistas.
+
+Escenarios:
+  1. Un patrón por mensaje (el del abonado), con más patrones distintos que
+     la caché interna de 're': re.search(texto) como antes contra
+     PatternCache.
+  2. Todos los patrones distintos contra cada mensaje (tormenta de
+     alarmas): un regex compilado por patrón en un bucle, un único regex
+     con un lookahead con nombre por patrón (descartado, queda como
+     referencia) y EventMatcher.match_all (bucle + memo por texto).
+  3. EVENT_MATCHER: cada mensaje contra el patrón de su abonado, con
+     textos casi todos distintos (lotes normales) y con pocos textos
+     repetidos (tormenta): PatternCache ("single") contra
+     EventMatcher.matches ("batch").
+
+Uso:
+    python benchmarks/bench_event_matcher.py
+    python benchmarks/bench_event_matcher.py --clients 5000 --messages 20000 --patterns 40
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from event_matcher import PatternCache, EventMatcher  # noqa: E402
+
+PANEL_MESSAGES = [
+    "ALARMA ROBO ZONA {z} - PUERTA PRINCIPAL",
+    "ALARMA ROBO ZONA {z} - VENTANA COCINA",
+    "ASALTO USUARIO {u}",
+    "PANICO TECLADO {u}",
+    "INCENDIO ZONA {z}",
+    "CORTE DE ENERGIA AC",
+    "RESTAURACION DE ENERGIA AC",
+    "BATERIA BAJA PANEL",
+    "APERTURA USUARIO {u}",
+    "CIERRE USUARIO {u}",
+    "FALLA DE COMUNICACION LINEA TELEFONICA",
+    "TAMPER ZONA {z}",
+    "PRUEBA PERIODICA",
+]
+BASE_PATTERNS = [
+    "robo", "asalto", "panico|p[aá]nico", "incendio|fuego", "robo|asalto",
+    "alarma robo zona [0-9]+", "corte de energia", "tamper", "(robo|intrusion) zona (1|2|3)",
+    "bateria baja", r"\bpanico\b", "falla de comunicacion",
+]
+
+
+def build_patterns(count):
+    """Patrones base más variantes por zona, como los cargan los clientes con reglas propias."""
+    patterns = list(BASE_PATTERNS)
+    zone = 1
+    while len(patterns) < count:
+        patterns.append(f"robo zona {zone}\\b")
+        zone += 1
+    return patterns[:count]
+
+
+def build_messages(count, rng):
+    return [rng.choice(PANEL_MESSAGES).format(z=rng.randint(1, 64), u=rng.randint(1, 20)) for _ in range(count)]
+
+
+def build_lookahead(patterns):
+    """Todos los patrones en un solo regex: match() en 0 y se miran los grupos que participaron."""
+    names = {f"e{i}": pattern for i, pattern in enumerate(patterns)}
+    combined = re.compile("".join(f"(?:(?=[\\s\\S]*?(?P<{name}>{pattern})))?" for name, pattern in names.items()))
+
+    def match_all(message):
+        match = combined.match(message.lower())
+        return {pattern for name, pattern in names.items() if match.start(name) != -1}
+    return match_all
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de patrones de evento")
+    parser.add_argument("--clients", type=int, default=5000, help="Abonados (y patrones distintos en el escenario 1)")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--patterns", type=int, default=40, help="Patrones distintos en el escenario 2")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args(argv)
+    rng = random.Random(args.seed)
+    messages = build_messages(args.messages, rng)
+
+    # Escenario 1: cada abonado con su patrón, más distintos que re._MAXCACHE
+    client_patterns = build_patterns(args.clients)
+    pairs = [(rng.choice(client_patterns), message) for message in messages]
+    re.purge()
+    legacy_time, legacy = timed(lambda: [bool(re.search(pattern, message.lower())) for pattern, message in pairs])
+    cache = PatternCache(max_size=args.clients * 2)
+    cache.validate(client_patterns)  # Validación al cargar los clientes
+    cached_time, cached = timed(lambda: [bool(cache.get(pattern).search(message.lower())) for pattern, message in pairs])
+    assert legacy == cached
+    print(f"Escenario 1: {len(pairs)} mensajes, {len(client_patterns)} patrones distintos")
+    print(f"  re.search(texto)     {legacy_time:8.4f}s  ({len(pairs) / legacy_time:>10.0f} msg/s)")
+    print(f"  PatternCache         {cached_time:8.4f}s  ({len(pairs) / cached_time:>10.0f} msg/s)")
+
+    # Escenario 2: todos los patrones distintos contra cada mensaje
+    patterns = build_patterns(args.patterns)
+    compiled = [(pattern, re.compile(pattern)) for pattern in patterns]
+    loop_time, loop = timed(lambda: [{p for p, regex in compiled if regex.search(message.lower())} for message in messages])
+    lookahead = build_lookahead(patterns)
+    lookahead_time, combined = timed(lambda: [lookahead(message) for message in messages])
+    matcher = EventMatcher(patterns)
+    matcher_time, memoized = timed(lambda: [matcher.match_all(message) for message in messages])
+    assert loop == combined == memoized
+    print(f"Escenario 2: {len(messages)} mensajes ({len(set(messages))} textos distintos) x {len(patterns)} patrones")
+    print(f"  bucle de regex       {loop_time:8.4f}s  ({len(messages) / loop_time:>10.0f} msg/s)")
+    print(f"  regex con lookaheads {lookahead_time:8.4f}s  ({len(messages) / lookahead_time:>10.0f} msg/s)")
+    print(f"  EventMatcher         {matcher_time:8.4f}s  ({len(messages) / matcher_time:>10.0f} msg/s)")
+
+    # Escenario 3: el patrón de cada abonado, con textos distintos y en tormenta
+    distinct = [(rng.choice(patterns), f"{message} #{i}") for i, message in enumerate(messages)]
+    storm_texts = [rng.choice(PANEL_MESSAGES).format(z=1, u=1) for _ in range(5)]
+    storm = [(rng.choice(patterns), rng.choice(storm_texts)) for _ in messages]
+    print(f"Escenario 3: {len(messages)} mensajes, patrón del abonado entre {len(patterns)}")
+    for name, batch in (("textos distintos", distinct), ("tormenta", storm)):
+        single_time, single = timed(lambda: [bool(cache.get(pattern).search(message.lower())) for pattern, message in batch])
+        matcher = EventMatcher(patterns, cache=cache, memo_size=len(batch))
+        batch_time, batched = timed(lambda: [matcher.matches(pattern, message) for pattern, message in batch])
+        assert single == batched
+        print(f"  {name:<17}    single {single_time:8.4f}s   batch {batch_time:8.4f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
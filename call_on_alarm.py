@@ -4,13 +4,19 @@ import requests
 import time
 import signal
 import sys
-from dbSigesmen import Database
+import socket
+from archive_messages import ArchiveJob
+from poller import AdaptivePoller, Waker
+from cooldown import ExpiringSet, PersistentCooldown, SharedCooldown
+from dbSigesmen import Database, ConnectionPool, MarkBuffer, HighWaterMark, CallClientDirectory, get_statement_stats
 import json
 import traceback
 import re
-from twilio.rest import Client
-from flask import Flask, jsonify
+from twilio_calls import TwilioClientHolder
+from event_matcher import PatternCache, EventMatcher
+from flask import Flask, jsonify, request
 from threading import Thread, Timer
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -26,15 +32,52 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = int(os.getenv("DB_PORT", 3306))
 DB_DATABASE = os.getenv("DB_DATABASE")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "2"))
+DB_POOL_MAX_IDLE = int(os.getenv("DB_POOL_MAX_IDLE", "300"))  # Segundos ociosa antes de descartar una conexión
+MARK_FLUSH_EVERY = int(os.getenv("MARK_FLUSH_EVERY", "5"))  # Bajo: un reinicio a mitad de lote no debe repetir muchas llamadas
+BATCH_SIZE = 100  # Mensajes por ciclo
+# Reparto con leases (SELECT ... FOR UPDATE SKIP LOCKED) para correr varias instancias en paralelo
+CLAIM_LEASES = os.getenv("CLAIM_LEASES", "0") == "1"
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", "300"))  # Debe superar lo que tarda un lote completo
+WORKER_ID = os.getenv("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+# Lectura incremental por id (con barrido completo cada SWEEP_INTERVAL segundos para rezagados)
+INCREMENTAL_FETCH = os.getenv("INCREMENTAL_FETCH", "1") == "1"
+SWEEP_INTERVAL = int(os.getenv("SWEEP_INTERVAL", "60"))
+# Archivado opcional en segundo plano de las filas procesadas (ver archive_messages.py)
+ARCHIVE_IN_WORKER = os.getenv("ARCHIVE_IN_WORKER", "0") == "1"
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "30"))
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", "3600"))
 TOKEN = os.getenv("TOKEN")
 SLEEP = int(os.getenv("SLEEP", "60"))
+# Sondeo adaptativo: inmediato con lote lleno, POLL_MIN_INTERVAL con mensajes y backoff hasta SLEEP sin ellos
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "0.5"))
+POLL_BACKOFF = float(os.getenv("POLL_BACKOFF", "2"))
+# Si se define, /kick exige el header X-Kick-Token o ?token= con este valor
+KICK_TOKEN = os.getenv("KICK_TOKEN")
 REBOOT_AFTER_ATTEMPS = int(os.getenv("REBOOT_AFTER_ATTEMPS", "60"))
 TIME_BETWEEN_CALL = int(os.getenv("TIME_BETWEEN_CALL", "60"))
+# Archivo SQLite local con el cooldown y las consultas cacheadas (vacío = sólo en memoria)
+COOLDOWN_DB = os.getenv("COOLDOWN_DB", "call_cooldown.sqlite3")
+# clientes_llamada en memoria: cada cuánto se compara su checksum y cuánto se recuerda un abonado ausente
+CLIENT_DIRECTORY_REFRESH = int(os.getenv("CLIENT_DIRECTORY_REFRESH", "30"))
+CLIENT_NEGATIVE_TTL = int(os.getenv("CLIENT_NEGATIVE_TTL", "60"))
+# "local": cooldown por proceso; "mysql": tabla call_cooldown compartida para correr varias instancias
+COOLDOWN_BACKEND = os.getenv("COOLDOWN_BACKEND", "local")
 ACCOUNT_SID = os.getenv("ACCOUNT_SID")
 TWILIO_TOKEN = os.getenv("TWILIO_TOKEN")
 TWILIO_NUMBER = os.getenv("TWILIO_NUMBER")
 TWILIO_IVR = os.getenv("TWILIO_IVR")
 REQUEST_TIMEOUT = 30  # Timeout para peticiones HTTP en segundos
+# Timeouts de la API de Twilio (conexión y lectura por separado)
+TWILIO_CONNECT_TIMEOUT = float(os.getenv("TWILIO_CONNECT_TIMEOUT", "5"))
+TWILIO_READ_TIMEOUT = float(os.getenv("TWILIO_READ_TIMEOUT", "30"))
+CALL_CONCURRENCY = int(os.getenv("CALL_CONCURRENCY", "8"))  # Llamadas simultáneas a la API de Twilio
+# "single": cada mensaje contra el patrón de su abonado; "batch": lo mismo, pero recordando el resultado por
+# (texto, patrón) durante el lote. Sólo conviene si los textos se repiten mucho (tormentas) o los patrones
+# son caros: con textos casi todos distintos el memo no ahorra búsquedas y su costo hace a "batch" ~2x más
+# lento que "single" (escenario 3 de benchmarks/bench_event_matcher.py)
+EVENT_MATCHER = os.getenv("EVENT_MATCHER", "single")
+EVENT_PATTERN_CACHE_SIZE = int(os.getenv("EVENT_PATTERN_CACHE_SIZE", "4096"))
 API = f"https://api.telegram.org/bot{TOKEN}"
 
 
@@ -59,42 +102,106 @@ logging.basicConfig(level=logging.INFO, handlers=[handler])
 
 logger = logging.getLogger(__name__)
 
-class ListaTemporal:
-    def __init__(self):
-        self.lista = []
-        self.elementos = {}  # Diccionario para almacenar el tiempo de inserción de cada elemento
+def open_cooldown():
+    """Cooldown persistente si hay archivo configurado y usable; si no, en memoria."""
+    if COOLDOWN_DB:
+        try:
+            store = PersistentCooldown(COOLDOWN_DB)
+            logger.info(f"Cooldown cargado desde {COOLDOWN_DB}: {store.loaded} abonados todavía en espera")
+            return store
+        except Exception as e:
+            logger.error(f"No se pudo abrir {COOLDOWN_DB}, el cooldown queda sólo en memoria: {e}")
+    return ExpiringSet()
+
+# Un solo cliente Twilio con conexiones keep-alive para todas las llamadas
+twilio_client = TwilioClientHolder(ACCOUNT_SID, TWILIO_TOKEN, connect_timeout=TWILIO_CONNECT_TIMEOUT,
+                                   read_timeout=TWILIO_READ_TIMEOUT, pool_size=CALL_CONCURRENCY)
+# Hilos para colocar varias llamadas a la vez (una tormenta de alarmas no se disca en serie)
+call_executor = ThreadPoolExecutor(max_workers=CALL_CONCURRENCY, thread_name_prefix="twilio")
+
+# Abonados llamados recientemente (cooldown de TIME_BETWEEN_CALL segundos), persiste entre reinicios
+tmp_list = open_cooldown()
+
+# Con varias instancias el cooldown se reserva en MySQL; tmp_list queda como near-cache
+shared_cooldown = SharedCooldown(tmp_list, WORKER_ID) if COOLDOWN_BACKEND == "mysql" else None
+
+# Patrones de evento compilados una sola vez por texto (re recompila pasados 512 distintos)
+event_patterns = PatternCache(max_size=EVENT_PATTERN_CACHE_SIZE)
 
-    def insert(self, telefono, tiempo_expiracion):
-        tiempo_actual = time.time()
-        self.lista.append(telefono)
-        self.elementos[telefono] = tiempo_actual + tiempo_expiracion
+# Configuración de llamadas de todos los abonados; routine() no consulta la DB salvo abonados nuevos
+call_clients = CallClientDirectory(refresh_interval=CLIENT_DIRECTORY_REFRESH, negative_ttl=CLIENT_NEGATIVE_TTL)
 
-    def clean(self):
-        tiempo_actual = time.time()
-        elementos_a_eliminar = []
-        for telefono, tiempo_expiracion in self.elementos.items():
-            if tiempo_actual > tiempo_expiracion:
-                elementos_a_eliminar.append(telefono)
+def restore_call_clients():
+    """Arranque en caliente con la última copia guardada en el archivo del cooldown."""
+    if not isinstance(tmp_list, PersistentCooldown):
+        return
+    try:
+        rows = {key: row for key, row in tmp_list.load_lookups("clientes_llamada").items() if row}
+        _, checksum = tmp_list.get_lookup("directorio", "clientes_llamada")
+        if rows:
+            call_clients.restore(rows, checksum)
+            logger.info(f"Directorio de clientes restaurado desde {COOLDOWN_DB}: {len(rows)} abonados")
+    except Exception as e:
+        logger.warning(f"No se pudo restaurar el directorio de clientes: {e}")
+
+restore_call_clients()
 
-        for telefono in elementos_a_eliminar:
-            if telefono in self.lista:
-                self.lista.remove(telefono)
-            if telefono in self.elementos:
-                del self.elementos[telefono]
+def refresh_call_clients(db):
+    """Recarga clientes_llamada si cambió; ante un error se sigue con la copia actual."""
+    try:
+        if not call_clients.refresh(db):
+            return
+    except Exception as e:
+        logger.warning(f"No se pudo refrescar el directorio de clientes, se usa la copia actual: {e}")
+        return
+    rows = call_clients.rows()
+    # Validar los patrones al cargar, no recién cuando llega una alarma
+    invalid = event_patterns.validate(row[-1] for row in rows)
+    for row in rows:
+        if row[-1] in invalid:
+            logger.warning(f"Cliente {row[1]}: patrón de evento inválido '{row[-1]}', sus mensajes no generarán llamadas")
+    logger.info(f"Directorio de clientes recargado: {len(rows)} abonados, {len(invalid)} patrones inválidos")
+    if isinstance(tmp_list, PersistentCooldown):
+        snapshot, checksum = call_clients.snapshot()
+        tmp_list.replace_lookups("clientes_llamada", snapshot)
+        tmp_list.put_lookup("directorio", "clientes_llamada", checksum)
 
-    def get_list(self):
-        return self.lista
+def claim_call(db, client):
+    """Reserva el derecho a llamar al abonado. False si sigue en cooldown."""
+    if shared_cooldown:
+        return shared_cooldown.claim(db, client, TIME_BETWEEN_CALL)
+    return tmp_list.claim(client, TIME_BETWEEN_CALL)
 
-tmp_list = ListaTemporal()
+def get_call_client(db, code_cli):
+    """Fila de clientes_llamada del abonado desde el directorio en memoria (la DB sólo si falta)."""
+    return call_clients.get(db, code_cli)
 
-def is_event_to_call(event: str, msg: str) -> bool:
+def is_event_to_call(event: str, msg: str, matcher: EventMatcher = None) -> bool:
     """Verifica si el mensaje contiene el evento que requiere llamada"""
     try:
-        return bool(re.search(event, msg.lower()))
+        if matcher is not None:
+            return matcher.matches(event, msg)
+        compiled = event_patterns.get(event)
+        return compiled is not None and compiled.search(msg.lower()) is not None
     except Exception as e:
         logger.error(f"Error al verificar evento '{event}' en mensaje: {e}")
         return False
 
+def resolve_batch_clients(db, messages):
+    """
+    Filas de clientes_llamada de los abonados distintos del lote y un
+    EventMatcher con sus patrones. Un abonado que falla acá se vuelve a
+    buscar (con su manejo de errores) al procesar su mensaje.
+    """
+    clients = {}
+    for code_cli in {msg[3] for msg in messages}:
+        try:
+            clients[code_cli] = get_call_client(db, code_cli)
+        except Exception as e:
+            logger.warning(f"No se pudo resolver el cliente {code_cli} antes del lote: {e}")
+    events = [row[-1] for row in clients.values() if row]
+    return clients, EventMatcher(events, cache=event_patterns)
+
 def remove_non_alphanumeric(input_string):
     """Removes any character from a string that is not a letter, number, or space."""
     try:
@@ -106,16 +213,28 @@ def remove_non_alphanumeric(input_string):
         logger.error(f"Error al limpiar texto: {e}")
         return input_string
 
+# Pool compartido entre ciclos: evita el handshake TCP+auth en cada routine()
+db_pool = ConnectionPool(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE, size=DB_POOL_SIZE, max_idle=DB_POOL_MAX_IDLE)
+
+# Posición de lectura incremental, compartida entre ciclos
+fetch_position = HighWaterMark("mensaje_llamada_por_robo", sweep_interval=SWEEP_INTERVAL)
+
+# Intervalo entre ciclos según cuántos mensajes trajo el último lote
+poller = AdaptivePoller(BATCH_SIZE, min_interval=POLL_MIN_INTERVAL, max_interval=SLEEP, factor=POLL_BACKOFF, name="alarmas")
+
+# Los productores pueden despertar el bucle principal para no esperar al próximo sondeo
+waker = Waker()
+
 def with_db_connection(func):
     """
-    Decorador para abrir la conexión antes de ejecutar la función
-    y cerrarla después. Maneja reintentos si la conexión falla.
+    Decorador que toma prestada una conexión del pool antes de ejecutar
+    la función y la devuelve después. Maneja reintentos si la conexión falla.
     """
     def wrapper(*args, **kwargs):
         retries = 3
         for attempt in range(retries):
             try:
-                with Database(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE) as db:
+                with Database(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE, pool=db_pool) as db:
                     return func(db, *args, **kwargs)
             except Exception as e:
                 logger.error(f"Error de conexión a la DB (intento {attempt + 1} de {retries}): {e}", exc_info=True)
@@ -143,11 +262,8 @@ def call_to_phone(message, phone):
         full_message = f"Este es un mensaje de integralcom. {clean_message}"
         encoded_message = requests.utils.quote(full_message)
 
-        # Crear cliente Twilio con timeout
-        client = Client(ACCOUNT_SID, TWILIO_TOKEN)
-        
-        # Realizar llamada
-        call = client.calls.create(
+        # Realizar llamada con el cliente compartido
+        call = twilio_client.create_call(
             to=phone,
             from_=TWILIO_NUMBER,
             url=f'{TWILIO_IVR}{encoded_message}',
@@ -162,24 +278,41 @@ def call_to_phone(message, phone):
         logger.error(error, exc_info=True)
         return False, error
 
+def rewind_fetch_position(db, ids):
+    """Devuelve a la lectura incremental los mensajes que quedaron sin marcar"""
+    if not INCREMENTAL_FETCH or CLAIM_LEASES or not ids:
+        return  # Con leases, los vencidos se reclaman solos
+    try:
+        fetch_position.rewind(db, ids)
+    except Exception as e:
+        logger.error(f"No se pudo retroceder la posición de lectura: {e}")
+
 @with_db_connection
 def routine(db):
     """Rutina principal que procesa mensajes de alarma y realiza llamadas"""
+    unsent_messages = []
     try:
         logger.info("Iniciando rutina de procesamiento de alarmas")
         start_time = time.time()
         
         # Limpiar lista temporal
         tmp_list.clean()
+        refresh_call_clients(db)
         
         # Recuperar mensajes no procesados con límite para evitar sobrecarga
-        query = "SELECT * FROM mensaje_llamada_por_robo WHERE men_status = 0 LIMIT 100"
-        unsent_messages = db.get_unsent(query)
+        if CLAIM_LEASES:
+            # Cada instancia reserva su propio lote; los leases vencidos de instancias caídas se reclaman solos
+            unsent_messages = db.claim_batch("mensaje_llamada_por_robo", WORKER_ID, BATCH_SIZE, LEASE_SECONDS)
+        elif INCREMENTAL_FETCH:
+            unsent_messages = fetch_position.fetch(db, BATCH_SIZE)
+        else:
+            query = f"SELECT * FROM mensaje_llamada_por_robo WHERE men_status = 0 LIMIT {BATCH_SIZE}"
+            unsent_messages = db.get_unsent(query)
         
         message_count = len(unsent_messages)
         if message_count == 0:
             logger.info("No hay mensajes de alarma pendientes para procesar")
-            return
+            return 0
             
         logger.info(f"Procesando {message_count} mensajes de alarma pendientes")
         
@@ -187,41 +320,72 @@ def routine(db):
         calls_made = 0
         calls_failed = 0
         
-        for msg in unsent_messages:
-            try:
-                msg_id, message, _, code_cli, _, _, _, _ = msg
-                logger.info(f"Procesando mensaje de alarma ID {msg_id} para cliente {code_cli}")
+        # En modo batch cada par (texto, patrón de su abonado) se evalúa una sola vez en el lote
+        clients, matcher = resolve_batch_clients(db, unsent_messages) if EVENT_MATCHER == "batch" else ({}, None)
+        
+        pending_calls = {}  # future -> (msg_id, teléfono, evento)
+        with MarkBuffer(db, "mensaje_llamada_por_robo", MARK_FLUSH_EVERY, worker_id=WORKER_ID if CLAIM_LEASES else None) as marks:
+            for msg in unsent_messages:
+                try:
+                    msg_id, message, _, code_cli, _, _, _, _ = msg
+                    logger.info(f"Procesando mensaje de alarma ID {msg_id} para cliente {code_cli}")
                 
-                # Obtener información del cliente
-                query = f"SELECT * FROM clientes_llamada WHERE abonado = {code_cli}"
-                row = db.get_one_row(query)
+                    # Obtener información del cliente
+                    row = clients[code_cli] if code_cli in clients else get_call_client(db, code_cli)
                 
-                if not row:
-                    logger.warning(f"No se encontró información de llamada para el cliente {code_cli}")
-                    db.mark_as_process("mensaje_llamada_por_robo", msg_id)
-                    messages_processed += 1
-                    continue
+                    if not row:
+                        logger.warning(f"No se encontró información de llamada para el cliente {code_cli}")
+                        marks.add(msg_id)
+                        messages_processed += 1
+                        continue
                 
-                id, client, name, phone, event = row
-                logger.info(f"Cliente encontrado: {name} ({phone}), Evento: {event}")
+                    id, client, name, phone, event = row
+                    logger.info(f"Cliente encontrado: {name} ({phone}), Evento: {event}")
                 
-                # Verificar si el cliente ya está en la lista temporal
-                if client in tmp_list.get_list():
-                    logger.info(f"Cliente {client} ya fue llamado recientemente, saltando...")
-                    db.mark_as_process("mensaje_llamada_por_robo", msg_id)
-                    messages_processed += 1
-                    continue
+                    # Verificar si el cliente ya está en la lista temporal
+                    if client in tmp_list:
+                        logger.info(f"Cliente {client} ya fue llamado recientemente, saltando...")
+                        marks.add(msg_id)
+                        messages_processed += 1
+                        continue
                 
-                # Verificar si el mensaje contiene el evento que requiere llamada
-                if is_event_to_call(event, message):
-                    logger.info(f"Evento '{event}' detectado en mensaje, realizando llamada...")
-                    
-                    # Agregar cliente a lista temporal
-                    tmp_list.insert(client, TIME_BETWEEN_CALL)
-                    
-                    # Realizar llamada
-                    success, result = call_to_phone(message, phone)
+                    # Verificar si el mensaje contiene el evento que requiere llamada
+                    if is_event_to_call(event, message, matcher):
+                        # Reservar el cooldown antes de llamar (con COOLDOWN_BACKEND=mysql, frente a todas las instancias)
+                        if not claim_call(db, client):
+                            logger.info(f"Cliente {client} ya fue llamado por otra instancia, saltando...")
+                            marks.add(msg_id)
+                            messages_processed += 1
+                            continue
+                        logger.info(f"Evento '{event}' detectado en mensaje, realizando llamada...")
                     
+                        # Realizar llamada en paralelo; se marca al completarse
+                        future = call_executor.submit(call_to_phone, message, phone)
+                        pending_calls[future] = (msg_id, phone, event)
+                        continue
+                    else:
+                        logger.info(f"Evento '{event}' no detectado en mensaje, saltando llamada...")
+                
+                    # Marcar mensaje como procesado
+                    marks.add(msg_id)
+                    messages_processed += 1
+                
+                except Exception as msg_error:
+                    logger.exception(f"Error al procesar mensaje de alarma {msg}: {str(msg_error)}")
+                    # Intentar marcar como procesado para evitar reprocesamiento infinito
+                    try:
+                        marks.add(msg_id)
+                    except Exception:
+                        pass
+                    calls_failed += 1
+
+            # Resultados de las llamadas a medida que terminan (DB sólo desde este hilo)
+            if pending_calls:
+                logger.info(f"{len(pending_calls)} llamadas en curso con concurrencia {CALL_CONCURRENCY}")
+            for future in as_completed(pending_calls):
+                msg_id, phone, event = pending_calls[future]
+                try:
+                    success, result = future.result()
                     if success:
                         calls_made += 1
                         logger.info(f"ALARMA: Llamada exitosa al teléfono {phone} por evento {event}. SID: {result}")
@@ -230,21 +394,15 @@ def routine(db):
                         logger.error(f"ALARMA: Error en llamada al teléfono {phone} por evento {event}. Error: {result}")
                         # Guardar observación de error
                         db.insert_obs(f"Error en llamada: {result[:500]}")
-                else:
-                    logger.info(f"Evento '{event}' no detectado en mensaje, saltando llamada...")
-                
-                # Marcar mensaje como procesado
-                db.mark_as_process("mensaje_llamada_por_robo", msg_id)
-                messages_processed += 1
-                
-            except Exception as msg_error:
-                logger.exception(f"Error al procesar mensaje de alarma {msg}: {str(msg_error)}")
-                # Intentar marcar como procesado para evitar reprocesamiento infinito
+                except Exception as call_error:
+                    logger.exception(f"Error al registrar la llamada del mensaje {msg_id}: {str(call_error)}")
+                    calls_failed += 1
+                # Marcar mensaje como procesado aunque la llamada haya fallado
                 try:
-                    db.mark_as_process("mensaje_llamada_por_robo", msg_id)
-                except Exception:
-                    pass
-                calls_failed += 1
+                    marks.add(msg_id)
+                    messages_processed += 1
+                except Exception as mark_error:
+                    logger.error(f"No se pudo marcar mensaje {msg_id} como procesado: {mark_error}")
         
         # Limpiar lista temporal al final
         tmp_list.clean()
@@ -252,9 +410,12 @@ def routine(db):
         # Resumen de la ejecución
         execution_time = time.time() - start_time
         logger.info(f"Rutina de alarmas completada en {execution_time:.2f} segundos. Procesados: {messages_processed}, Llamadas: {calls_made}, Fallidas: {calls_failed}")
+        return message_count
     
     except Exception as routine_error:
         logger.exception(f"Error general en la rutina de alarmas: {str(routine_error)}")
+        # Los mensajes marcados no se releen (men_status = 1); el resto del lote vuelve en el próximo ciclo
+        rewind_fetch_position(db, [msg[0] for msg in unsent_messages])
         raise  # Re-lanzamos la excepción para que se maneje en el bucle principal
 
 def send_message_to_phone(db, phone, message):
@@ -312,7 +473,16 @@ def health_check():
             return jsonify({
                 "status": "warning",
                 "last_success": LAST_SUCCESSFUL_RUN.isoformat(),
-                "seconds_since_success": time_since_last_success
+                "seconds_since_success": time_since_last_success,
+                "db_pool": db_pool.get_stats(),
+                "statements": get_statement_stats(),
+                "poller": poller.get_stats(),
+                "kicks": waker.get_stats(),
+                "cooldown_size": len(tmp_list),
+                "shared_cooldown": shared_cooldown.get_stats() if shared_cooldown else None,
+                "twilio": twilio_client.get_stats(),
+                "event_patterns": event_patterns.get_stats(),
+                "call_clients": call_clients.get_stats()
             }), 200  # Seguimos devolviendo 200 para no reiniciar el servicio automáticamente
         
         # Para pruebas, mantenemos el contador
@@ -322,12 +492,30 @@ def health_check():
         return jsonify({
             "status": "ok",
             "last_success": LAST_SUCCESSFUL_RUN.isoformat(),
-            "seconds_since_success": time_since_last_success
+            "seconds_since_success": time_since_last_success,
+            "db_pool": db_pool.get_stats(),
+            "statements": get_statement_stats(),
+            "poller": poller.get_stats(),
+            "kicks": waker.get_stats(),
+            "cooldown_size": len(tmp_list),
+            "shared_cooldown": shared_cooldown.get_stats() if shared_cooldown else None,
+            "twilio": twilio_client.get_stats(),
+            "event_patterns": event_patterns.get_stats(),
+            "call_clients": call_clients.get_stats()
         }), 200
     except Exception as e:
         logger.error(f"Error en health check: {str(e)}", exc_info=True)
         return jsonify({"status": "error", "error": str(e)}), 500
 
+@app.route("/kick", methods=['POST', 'GET'])
+def kick():
+    """Despierta el bucle principal para que consulte la tabla sin esperar el próximo sondeo"""
+    if KICK_TOKEN and request.headers.get("X-Kick-Token", request.args.get("token")) != KICK_TOKEN:
+        return jsonify({"status": "forbidden"}), 403
+    queued = waker.kick()
+    # Si ya había un kick pendiente éste se coalesce con aquél
+    return jsonify({"status": "ok", "coalesced": not queued}), 202
+
 def watchdog_check():
     """Comprueba si el programa está funcionando correctamente y lo reinicia si es necesario"""
     global LAST_SUCCESSFUL_RUN
@@ -347,7 +535,10 @@ def watchdog_check():
 # Maneja señales de terminación para limpieza
 def signal_handler(sig, frame):
     logger.info("Señal de terminación recibida. Limpiando recursos...")
-    # Aquí podríamos realizar tareas de limpieza si fuera necesario
+    call_executor.shutdown(wait=False)
+    if isinstance(tmp_list, PersistentCooldown):
+        tmp_list.close()
+    db_pool.close_all()
     sys.exit(0)
 
 if __name__ == '__main__':
@@ -367,16 +558,22 @@ if __name__ == '__main__':
     watchdog_thread.start()
     logger.info("Watchdog iniciado")
     
+    if ARCHIVE_IN_WORKER:
+        archive_job = ArchiveJob(lambda: Database(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE, pool=db_pool),
+                                 tables=["mensaje_llamada_por_robo"], retention_days=ARCHIVE_RETENTION_DAYS)
+        archive_job.start(ARCHIVE_INTERVAL)
+        logger.info(f"Archivado en segundo plano iniciado (retención {ARCHIVE_RETENTION_DAYS} días)")
+    
     # Bucle principal mejorado
     consecutive_errors = 0
     max_consecutive_errors = 5
     
-    logger.info(f"Iniciando bucle principal con intervalo de {SLEEP} segundos")
+    logger.info(f"Iniciando bucle principal con intervalo adaptativo entre {POLL_MIN_INTERVAL} y {SLEEP} segundos")
     while True:
         try:
             start_time = time.time()
             logger.info(f"Ejecutando rutina de verificación de alarmas...")
-            routine()
+            fetched = routine()
             
             # Actualiza el timestamp de última ejecución exitosa
             LAST_SUCCESSFUL_RUN = datetime.now()
@@ -386,9 +583,10 @@ if __name__ == '__main__':
             execution_time = time.time() - start_time
             logger.info(f"Rutina completada en {execution_time:.2f} segundos")
             
-            # Asegura un intervalo constante ajustando el tiempo de espera
-            sleep_time = max(0.1, SLEEP - execution_time)  # Al menos 0.1 segundos
-            time.sleep(sleep_time)
+            # Intervalo adaptativo: sin espera si hay cola, backoff si no hay mensajes
+            sleep_time = poller.next_sleep(fetched, execution_time)
+            if waker.wait(sleep_time):
+                logger.info("Kick recibido: consultando en el acto")
             
         except Exception as e:
             consecutive_errors += 1
@@ -0,0 +1,242 @@
+"""
+Cooldown de llamadas: conjunto de claves que vencen solas.
+
+Reemplaza a ListaTemporal (lista + dict), donde la pertenencia era un
+recorrido O(n) de la lista, clean() hacía list.remove por cada vencido
+(O(n²) en el peor caso) y reinsertar un abonado duplicaba la entrada.
+
+PersistentCooldown guarda además el estado en un archivo SQLite local
+(WAL, una transacción corta por cambio), así un reinicio del worker no
+vuelve a llamar a los abonados que siguen en cooldown. En el mismo archivo
+se guardan consultas cacheadas (tabla lookups) para arrancar en caliente.
+"""
+import heapq
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiringSet(object):
+    """
+    Claves con vencimiento: dict clave -> vence más un min-heap de
+    (vence, clave) con borrado perezoso. Pertenencia O(1), alta O(log n) y
+    limpieza O(log n) amortizada por clave vencida. Reinsertar una clave
+    sólo cambia su vencimiento; la entrada vieja del heap se descarta al
+    llegar al tope. No es thread-safe.
+    """
+    def __init__(self, clock=time.time):
+        self.__clock = clock
+        self.__expiry = {}  # clave -> instante de vencimiento
+        self.__heap = []    # (vence, clave), puede tener entradas obsoletas
+
+    def add(self, key, ttl):
+        """Agrega (o renueva) la clave por 'ttl' segundos. Devuelve el vencimiento."""
+        return self.add_until(key, self.__clock() + ttl)
+
+    def add_until(self, key, expires):
+        """Agrega (o renueva) la clave hasta el instante 'expires'."""
+        self.__expiry[key] = expires
+        heapq.heappush(self.__heap, (expires, key))
+        # Muchas renovaciones dejan entradas obsoletas: se compacta el heap
+        if len(self.__heap) > 2 * len(self.__expiry) + 64:
+            self.__heap = [(expires, key) for key, expires in self.__expiry.items()]
+            heapq.heapify(self.__heap)
+        return expires
+
+    def __contains__(self, key):
+        expires = self.__expiry.get(key)
+        return expires is not None and expires > self.__clock()
+
+    def expires_at(self, key):
+        """Vencimiento de la clave o None si no está (o ya venció)."""
+        expires = self.__expiry.get(key)
+        return expires if expires is not None and expires > self.__clock() else None
+
+    def remove(self, key):
+        """Quita la clave antes de su vencimiento (su entrada del heap queda obsoleta)."""
+        self.__expiry.pop(key, None)
+
+    def clean(self):
+        """Descarta las claves vencidas. Devuelve cuántas se quitaron."""
+        now = self.__clock()
+        removed = 0
+        heap = self.__heap
+        while heap and heap[0][0] <= now:
+            expires, key = heapq.heappop(heap)
+            # Sólo cuenta si es la entrada vigente de la clave (no una renovada o quitada)
+            if self.__expiry.get(key) == expires:
+                del self.__expiry[key]
+                removed += 1
+        return removed
+
+    def claim(self, key, ttl):
+        """Agrega la clave si no está vigente. Devuelve True si la reservó."""
+        if key in self:
+            return False
+        self.add(key, ttl)
+        return True
+
+    def items(self):
+        """Pares (clave, vence) vigentes."""
+        now = self.__clock()
+        return [(key, expires) for key, expires in self.__expiry.items() if expires > now]
+
+    def __len__(self):
+        """Claves guardadas, incluidas las vencidas que todavía no limpió clean()."""
+        return len(self.__expiry)
+
+
+class PersistentCooldown(ExpiringSet):
+    """
+    ExpiringSet respaldado en SQLite. Al abrir se cargan las claves vigentes
+    (O(entradas)); cada add/remove se confirma enseguida con un upsert de una
+    fila. En modo WAL una caída del proceso (os._exit incluido) no pierde
+    lo ya confirmado. Las claves se guardan como texto.
+    """
+    def __init__(self, path, clock=time.time):
+        super().__init__(clock)
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS cooldown (clave TEXT PRIMARY KEY, vence REAL NOT NULL)")
+        self.__db.execute("""CREATE TABLE IF NOT EXISTS lookups (
+            espacio TEXT NOT NULL, clave TEXT NOT NULL, valor TEXT, actualizado REAL NOT NULL,
+            PRIMARY KEY (espacio, clave))""")
+        self.__db.commit()
+        self.loaded = self.__load()
+
+    def __load(self):
+        now = self.__clock()
+        with self.__lock:
+            self.__db.execute("DELETE FROM cooldown WHERE vence <= ?", (now,))
+            self.__db.commit()
+            rows = self.__db.execute("SELECT clave, vence FROM cooldown").fetchall()
+        for key, expires in rows:
+            super().add_until(key, expires)
+        return len(rows)
+
+    def __write(self, statement, params):
+        """Escribe y confirma; si el archivo falla se sigue sólo en memoria."""
+        try:
+            with self.__lock:
+                self.__db.execute(statement, params)
+                self.__db.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"No se pudo persistir el cooldown: {e}")
+
+    def add_until(self, key, expires):
+        key = str(key)
+        super().add_until(key, expires)
+        self.__write("INSERT INTO cooldown(clave, vence) VALUES(?, ?) "
+                     "ON CONFLICT(clave) DO UPDATE SET vence = excluded.vence", (key, expires))
+        return expires
+
+    def __contains__(self, key):
+        return super().__contains__(str(key))
+
+    def expires_at(self, key):
+        return super().expires_at(str(key))
+
+    def remove(self, key):
+        key = str(key)
+        super().remove(key)
+        self.__write("DELETE FROM cooldown WHERE clave = ?", (key,))
+
+    def clean(self):
+        removed = super().clean()
+        if removed:
+            self.__write("DELETE FROM cooldown WHERE vence <= ?", (self.__clock(),))
+        return removed
+
+    def get_lookup(self, namespace, key, max_age=None):
+        """Valor cacheado (deserializado de JSON) como (encontrado, valor)."""
+        with self.__lock:
+            row = self.__db.execute("SELECT valor, actualizado FROM lookups WHERE espacio = ? AND clave = ?",
+                                    (namespace, str(key))).fetchone()
+        if row is None or (max_age is not None and row[1] < self.__clock() - max_age):
+            return False, None
+        return True, json.loads(row[0])
+
+    def put_lookup(self, namespace, key, value):
+        self.__write("INSERT INTO lookups(espacio, clave, valor, actualizado) VALUES(?, ?, ?, ?) "
+                     "ON CONFLICT(espacio, clave) DO UPDATE SET valor = excluded.valor, actualizado = excluded.actualizado",
+                     (namespace, str(key), json.dumps(value, default=str), self.__clock()))
+
+    def replace_lookups(self, namespace, items):
+        """Reemplaza todo el espacio por items {clave: valor} en una sola transacción."""
+        now = self.__clock()
+        rows = [(namespace, str(key), json.dumps(value, default=str), now) for key, value in items.items()]
+        try:
+            with self.__lock:
+                with self.__db:
+                    self.__db.execute("DELETE FROM lookups WHERE espacio = ?", (namespace,))
+                    self.__db.executemany("INSERT INTO lookups(espacio, clave, valor, actualizado) VALUES(?, ?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            logger.warning(f"No se pudo guardar la caché '{namespace}': {e}")
+
+    def load_lookups(self, namespace):
+        """Todo el espacio como {clave: valor}."""
+        with self.__lock:
+            rows = self.__db.execute("SELECT clave, valor FROM lookups WHERE espacio = ?", (namespace,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+
+class SharedCooldown(object):
+    """
+    Cooldown compartido entre instancias en la tabla MySQL call_cooldown.
+    'local' (ExpiringSet o PersistentCooldown) hace de near-cache: lo que
+    ya se sabe en cooldown no consulta la base. Cada reserva es un único
+    upsert atómico, así dos instancias nunca llaman al mismo abonado
+    dentro del mismo período.
+    """
+    def __init__(self, local, worker_id):
+        self.local = local
+        self.__worker_id = worker_id
+        self.__lock = threading.Lock()
+        self.__stats = {"claims": 0, "granted": 0, "denied": 0, "near_cache_hits": 0, "db_errors": 0}
+
+    def __count(self, name):
+        with self.__lock:
+            self.__stats[name] += 1
+
+    def __contains__(self, key):
+        return key in self.local
+
+    def claim(self, db, key, ttl):
+        """Reserva el derecho a llamar a 'key' por 'ttl' segundos. False si otro lo tiene."""
+        self.__count("claims")
+        if key in self.local:
+            self.__count("near_cache_hits")
+            return False
+        try:
+            claimed, remaining = db.claim_cooldown(key, ttl, self.__worker_id)
+        except Exception as e:
+            # Ante la duda se llama: perder una alarma es peor que duplicar una llamada
+            logger.warning(f"No se pudo reservar el cooldown de {key} en la base, se usa sólo el local: {e}")
+            self.__count("db_errors")
+            return self.local.claim(key, ttl)
+        self.local.add(key, remaining)
+        self.__count("granted" if claimed else "denied")
+        return claimed
+
+    def clean(self):
+        return self.local.clean()
+
+    def __len__(self):
+        return len(self.local)
+
+    def get_stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+        stats["local_size"] = len(self.local)
+        return stats
@@ -1,41 +1,381 @@
 import mysql.connector as MySQLdb
 import json
 import time
+import threading
+import weakref
+import uuid
+from collections import OrderedDict
 DATABASE_FILE = "dbConf.json"
 
 
-INSERT_MESSAGE = "INSERT INTO mea_mensajes_alarma(mea_codigo_cliente, mea_grupo, mea_fecha, mea_hora, mea_contenido, mea_codigo_accion, mea_estado, mea_verificado) VALUES ({0}, 1, CURRENT_DATE(), CURRENT_TIME(), '{1}', 0, 0, 0)"
-GET_CLIENT = "SELECT EXISTS(SELECT * FROM cli_clientes WHERE cli_codigo =  {0} )"
-GET_CLIENT_PHONE = "SELECT CLI_CELULAR FROM cli_clientes WHERE cli_codigo = {0}" ###
-GET_CLAIM_ID = "SELECT men_id from men_mensajes WHERE men_origen_id = {0}"
+# Todas las consultas usan parámetros enlazados (%s) y se ejecutan como sentencias preparadas
+INSERT_MESSAGE = "INSERT INTO mea_mensajes_alarma(mea_codigo_cliente, mea_grupo, mea_fecha, mea_hora, mea_contenido, mea_codigo_accion, mea_estado, mea_verificado) VALUES (%s, 1, CURRENT_DATE(), CURRENT_TIME(), %s, 0, 0, 0)"
+GET_CLIENT = "SELECT EXISTS(SELECT * FROM cli_clientes WHERE cli_codigo = %s)"
+GET_CLIENT_PHONE = "SELECT CLI_CELULAR FROM cli_clientes WHERE cli_codigo = %s" ###
+GET_CLAIM_ID = "SELECT men_id from men_mensajes WHERE men_origen_id = %s"
 GET_UNSENT = "SELECT * FROM mensaje_a_telegram WHERE men_status = 0" ###
-MARK_AS_SENT = "UPDATE mensaje_a_telegram SET men_status = 1 WHERE id = {0}" ###
-GET_CHAT_ID = "SELECT chat_id FROM telegram_chat WHERE telefono like '%{0}'" ###
-INSERT_CHAT_ID = "INSERT INTO telegram_chat(telefono, chat_id) VALUES({0}, {1})"
-UPDATE_CHAT_ID = "UPDATE telegram_chat SET chat_id = {0} WHERE telefono = {1}"
-INSERT_OBS = "INSERT INTO telegram_observaciones(fecha, observacion) VALUES(now(), '{0}')" ###
+MARK_AS_SENT = "UPDATE mensaje_a_telegram SET men_status = 1 WHERE id = %s" ###
+MARK_AS_PROCESS = "UPDATE {0} SET men_status = 1 WHERE id = %s"
+# telefono_suffix7 (últimos 7 dígitos, indexado) reemplaza al LIKE '%xxxxxxx' que recorría toda la tabla.
+# Es una columna generada (RIGHT(telefono, 7)): la mantiene MySQL, nunca se escribe desde acá
+GET_CHAT_ID = "SELECT chat_id FROM telegram_chat WHERE telefono_suffix7 = %s" ###
+GET_CHAT_ID_BY_PHONE = "SELECT chat_id FROM telegram_chat WHERE telefono_suffix7 = %s AND telefono = %s"
+INSERT_CHAT_ID = "INSERT INTO telegram_chat(telefono, chat_id) VALUES(%s, %s)"
+UPDATE_CHAT_ID = "UPDATE telegram_chat SET chat_id = %s WHERE telefono_suffix7 = %s AND telefono = %s"
+INSERT_OBS = "INSERT INTO telegram_observaciones(fecha, observacion) VALUES(now(), %s)" ###
+MARK_MANY_PROCESSED = "UPDATE {0} SET men_status = 1 WHERE id IN ({1})"
+GET_CLIENT_PHONES = "SELECT cli_codigo, CLI_CELULAR FROM cli_clientes WHERE cli_codigo IN ({0})"
+GET_CHAT_IDS = "SELECT telefono_suffix7, chat_id FROM telegram_chat WHERE telefono_suffix7 IN ({0})"
+# Avisos de alta/cambio de chat_id para invalidar las cachés de los senders
+INSERT_CHAT_EVENT = "INSERT INTO telegram_chat_evento(telefono_suffix7, creado) VALUES(%s, NOW())"
+GET_CHAT_EVENTS_SINCE = "SELECT id, telefono_suffix7 FROM telegram_chat_evento WHERE id > %s ORDER BY id LIMIT %s"
+GET_MAX_CHAT_EVENT = "SELECT COALESCE(MAX(id), 0) FROM telegram_chat_evento"
+PURGE_CHAT_EVENTS = "DELETE FROM telegram_chat_evento WHERE creado < NOW() - INTERVAL %s SECOND LIMIT %s"
+
+# Reparto entre varios workers: leases en una tabla aparte para no alterar el SELECT * de las tablas de salida.
+# Requiere MySQL 8.0.1+ (FOR UPDATE OF ... SKIP LOCKED).
+CLAIM_CANDIDATES = """SELECT t.* FROM {0} t
+LEFT JOIN mensaje_lease l ON l.tabla = %s AND l.msg_id = t.id
+WHERE t.men_status = 0 AND (l.msg_id IS NULL OR l.expira < NOW())
+ORDER BY t.id LIMIT %s
+FOR UPDATE OF t SKIP LOCKED"""
+LEASE_ROW = "(%s, %s, %s, %s, NOW() + INTERVAL %s SECOND)"
+# Solo se pisa un lease vencido; expira se asigna al final porque MySQL evalúa las asignaciones en orden
+UPSERT_LEASES = """INSERT INTO mensaje_lease(tabla, msg_id, worker_id, token, expira) VALUES {0}
+ON DUPLICATE KEY UPDATE
+worker_id = IF(expira < NOW(), VALUES(worker_id), worker_id),
+token = IF(expira < NOW(), VALUES(token), token),
+expira = IF(expira < NOW(), VALUES(expira), expira)"""
+GET_LEASES_BY_TOKEN = "SELECT msg_id FROM mensaje_lease WHERE tabla = %s AND token = %s"
+DELETE_LEASES = "DELETE FROM mensaje_lease WHERE tabla = %s AND worker_id = %s AND msg_id IN ({0})"
+PURGE_EXPIRED_LEASES = "DELETE FROM mensaje_lease WHERE expira < NOW() - INTERVAL %s SECOND LIMIT %s"
+
+# Cooldown de llamadas compartido entre instancias de call_on_alarm.
+# Sin CLIENT_FOUND_ROWS, rowcount es 1 (alta), 2 (cooldown vencido, reservado de nuevo) o 0 (sigue vigente).
+# worker_id se asigna antes que vence porque MySQL evalúa las asignaciones en orden.
+CLAIM_COOLDOWN = """INSERT INTO call_cooldown(abonado, vence, worker_id) VALUES(%s, NOW(3) + INTERVAL %s SECOND, %s)
+ON DUPLICATE KEY UPDATE
+worker_id = IF(vence <= NOW(3), VALUES(worker_id), worker_id),
+vence = IF(vence <= NOW(3), VALUES(vence), vence)"""
+GET_COOLDOWN_REMAINING = "SELECT TIMESTAMPDIFF(MICROSECOND, NOW(3), vence) / 1000000 FROM call_cooldown WHERE abonado = %s"
+PURGE_CALL_COOLDOWN = "DELETE FROM call_cooldown WHERE vence < NOW() - INTERVAL %s SECOND LIMIT %s"
+
+# Configuración de llamadas por abonado (ver CallClientDirectory)
+GET_CALL_CLIENT = "SELECT * FROM clientes_llamada WHERE abonado = %s"
+GET_ALL_CALL_CLIENTS = "SELECT * FROM clientes_llamada"
+CHECKSUM_CALL_CLIENTS = "CHECKSUM TABLE clientes_llamada"
+
+# Lectura incremental por clave primaria a partir de la última posición vista
+GET_UNSENT_SINCE = "SELECT * FROM {0} WHERE id > %s AND men_status = 0 ORDER BY id LIMIT %s"
+GET_UNSENT_SWEEP = "SELECT * FROM {0} WHERE men_status = 0 LIMIT %s"
+GET_MAX_ID = "SELECT COALESCE(MAX(id), 0) FROM {0}"
+GET_FETCH_POSITION = "SELECT last_id FROM fetch_position WHERE nombre = %s"
+SAVE_FETCH_POSITION = """INSERT INTO fetch_position(nombre, last_id, actualizado) VALUES(%s, %s, NOW())
+ON DUPLICATE KEY UPDATE last_id = GREATEST(last_id, VALUES(last_id)), actualizado = NOW()"""
+REWIND_FETCH_POSITION = "UPDATE fetch_position SET last_id = LEAST(last_id, %s), actualizado = NOW() WHERE nombre = %s"
+
+# Archivado: mueve filas viejas a <tabla>_archivo por bloques
+ARCHIVE_SELECT = "SELECT `{key}` FROM {table} WHERE {where} ORDER BY `{key}` LIMIT %s FOR UPDATE"
+ARCHIVE_COPY = "INSERT IGNORE INTO {archive} SELECT * FROM {table} WHERE `{key}` IN ({ids})"
+ARCHIVE_DELETE = "DELETE FROM {table} WHERE `{key}` IN ({ids})"
+
+# Tablas de salida que aceptan actualizaciones de estado por lote
+MESSAGE_TABLES = ("mensaje_a_telegram", "mensaje_a_sms", "mensaje_llamada_por_robo")
+MARK_CHUNK_SIZE = 500
+IN_CHUNK_SIZE = 512
+STATEMENT_CACHE_SIZE = 64  # Sentencias preparadas por conexión (max_prepared_stmt_count es global en el servidor)
+
+
+def phone_suffix(phone):
+    """Clave de búsqueda de telegram_chat: los últimos 7 caracteres del teléfono."""
+    return str(phone)[-7:]
+
+
+def split_phones(phones):
+    """Separa el campo CLI_CELULAR ('tel1;tel2;...') en una lista de teléfonos."""
+    if not phones:
+        return []
+    return [phone.strip() for phone in phones.split(";") if phone.strip()]
+
+
+def pad_to_power_of_two(values):
+    """
+    Completa la lista hasta la potencia de 2 siguiente repitiendo el último
+    valor, para que lotes de distinto tamaño compartan unas pocas sentencias
+    preparadas.
+    """
+    values = list(values)
+    size = 1
+    while size < len(values):
+        size *= 2
+    return values + values[-1:] * (size - len(values))
+
+
+def in_clause(values):
+    """Arma los placeholders y parámetros de un IN (...) de tamaño redondeado."""
+    values = pad_to_power_of_two(values)
+    return ", ".join(["%s"] * len(values)), tuple(values)
+
+
+def connect(user, password, host, port, database):
+    """Abre una conexión MySQL nueva con los parámetros del servicio."""
+    return MySQLdb.connect(
+        host=host,
+        user=user,
+        passwd=password,
+        db=database,
+        port=port,
+        use_pure=True  # Los cursores preparados requieren la implementación en Python
+    )
+
+
+_STATEMENT_STATS = {"prepared": 0, "reused": 0, "evicted": 0}
+_STATEMENT_STATS_LOCK = threading.Lock()
+_STATEMENT_CACHES = weakref.WeakKeyDictionary()
+
+
+def get_statement_stats():
+    """Devuelve cuántas sentencias se prepararon y cuántas veces se reutilizaron en el proceso."""
+    with _STATEMENT_STATS_LOCK:
+        stats = dict(_STATEMENT_STATS)
+    executions = stats["prepared"] + stats["reused"]
+    stats["reuse_ratio"] = round(stats["reused"] / executions, 3) if executions else 0.0
+    return stats
+
+
+def _count_statement(key, amount=1):
+    with _STATEMENT_STATS_LOCK:
+        _STATEMENT_STATS[key] += amount
+
+
+class StatementCache(object):
+    """
+    Sentencias preparadas del lado del servidor para una conexión, una por
+    plantilla de consulta, con desalojo LRU. Se descarta al reconectar.
+    Guarda sólo una referencia débil a la conexión: es la clave de
+    _STATEMENT_CACHES y una referencia fuerte impediría liberarla.
+    """
+    def __init__(self, connection, max_size=STATEMENT_CACHE_SIZE):
+        self.__connection = weakref.ref(connection)
+        self.__max_size = max_size
+        self.__cursors = OrderedDict()  # plantilla -> (cursor preparado, plantilla canónica)
+
+    def get(self, query):
+        """
+        Devuelve (cursor, query) para la plantilla. Se debe ejecutar con la
+        query devuelta: el cursor solo reutiliza la sentencia si recibe el
+        mismo objeto str con el que se preparó.
+        """
+        entry = self.__cursors.get(query)
+        if entry is not None:
+            self.__cursors.move_to_end(query)
+            _count_statement("reused")
+            return entry
+        connection = self.__connection()
+        if connection is None:
+            raise ReferenceError("La conexión del StatementCache ya fue liberada")
+        entry = (connection.cursor(prepared=True), query)
+        self.__cursors[query] = entry
+        _count_statement("prepared")
+        if len(self.__cursors) > self.__max_size:
+            _, (old_cursor, _) = self.__cursors.popitem(last=False)
+            _count_statement("evicted")
+            try:
+                old_cursor.close()
+            except MySQLdb.Error:
+                pass
+        return entry
+
+    def clear(self):
+        """Olvida las sentencias (tras una reconexión ya no existen en el servidor)."""
+        self.__cursors.clear()
+
+    def close(self):
+        """Cierra los cursores preparados y los olvida."""
+        for cursor, _ in self.__cursors.values():
+            try:
+                cursor.close()
+            except MySQLdb.Error:
+                pass
+        self.__cursors.clear()
+
+
+def statement_cache(connection):
+    """Devuelve el StatementCache asociado a la conexión, creándolo si hace falta."""
+    cache = _STATEMENT_CACHES.get(connection)
+    if cache is None:
+        cache = StatementCache(connection)
+        _STATEMENT_CACHES[connection] = cache
+    return cache
+
+
+def drop_statement_cache(connection):
+    """Cierra y descarta el StatementCache de una conexión que se va a cerrar."""
+    cache = _STATEMENT_CACHES.pop(connection, None)
+    if cache is not None:
+        cache.close()
+
+
+def _decode_row(row, charset):
+    """El protocolo binario devuelve los textos como bytes; se convierten a str."""
+    return tuple(value.decode(charset, errors="replace") if isinstance(value, (bytes, bytearray)) else value for value in row)
+
+
+class ConnectionPool(object):
+    """
+    Pool acotado de conexiones MySQL reutilizadas entre ciclos de routine().
+    Valida cada conexión con ping al prestarla, descarta las que llevan más
+    de max_idle segundos ociosas y reconecta en forma transparente.
+    """
+    def __init__(self, user, password, host, port, database, size=2, max_idle=300, checkout_timeout=30):
+        self.__user = user
+        self.__password = password
+        self.__host = host
+        self.__port = port
+        self.__database = database
+        self.__size = max(1, size)
+        self.__max_idle = max_idle
+        self.__checkout_timeout = checkout_timeout
+        self.__cond = threading.Condition()
+        self.__idle = []  # Pila LIFO de (conexion, instante_de_devolucion)
+        self.__opened = 0  # Conexiones vivas: ociosas + prestadas
+        self.__stats = {
+            "checkouts": 0,
+            "checkout_waits": 0,
+            "checkout_wait_seconds": 0.0,
+            "connects": 0,
+            "reconnects": 0,
+            "evicted": 0,
+            "discarded": 0,
+        }
+
+    def __evict_idle(self):
+        """Retira (sin cerrar) las conexiones ociosas vencidas. Llamar con el lock tomado."""
+        now = time.time()
+        expired = [conn for conn, last_used in self.__idle if now - last_used > self.__max_idle]
+        if expired:
+            self.__idle = [(conn, last_used) for conn, last_used in self.__idle if now - last_used <= self.__max_idle]
+            self.__opened -= len(expired)
+            self.__stats["evicted"] += len(expired)
+        return expired
+
+    def __validate(self, conn):
+        """Hace ping a la conexión y la reconecta si el servidor la cerró."""
+        try:
+            conn.ping(reconnect=False)
+            return conn
+        except MySQLdb.Error:
+            with self.__cond:
+                self.__stats["reconnects"] += 1
+            conn.reconnect(attempts=1, delay=0)
+            statement_cache(conn).clear()
+            return conn
+
+    def acquire(self, timeout=None):
+        """Presta una conexión válida, esperando si el pool está lleno."""
+        if timeout is None:
+            timeout = self.__checkout_timeout
+        start = time.time()
+        conn = None
+        with self.__cond:
+            expired = self.__evict_idle()
+            waited = False
+            while not self.__idle and self.__opened >= self.__size:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    raise MySQLdb.errors.PoolError(f"No hay conexiones libres en el pool tras {timeout} segundos")
+                waited = True
+                self.__cond.wait(remaining)
+            if self.__idle:
+                conn, _ = self.__idle.pop()
+            else:
+                self.__opened += 1
+            self.__stats["checkouts"] += 1
+            if waited:
+                self.__stats["checkout_waits"] += 1
+                self.__stats["checkout_wait_seconds"] += time.time() - start
+        for old in expired:
+            self.__close_quietly(old)
+
+        try:
+            if conn is None:
+                conn = connect(self.__user, self.__password, self.__host, self.__port, self.__database)
+                with self.__cond:
+                    self.__stats["connects"] += 1
+            else:
+                conn = self.__validate(conn)
+        except Exception:
+            if conn is not None:
+                self.__close_quietly(conn)
+            with self.__cond:
+                self.__opened -= 1
+                self.__cond.notify()
+            raise
+        return conn
+
+    def release(self, conn, discard=False):
+        """Devuelve una conexión al pool; con discard=True se cierra y se descarta."""
+        if discard:
+            self.__close_quietly(conn)
+        with self.__cond:
+            if discard:
+                self.__opened -= 1
+                self.__stats["discarded"] += 1
+            else:
+                self.__idle.append((conn, time.time()))
+            self.__cond.notify()
+
+    def close_all(self):
+        """Cierra todas las conexiones ociosas del pool."""
+        with self.__cond:
+            idle = self.__idle
+            self.__idle = []
+            self.__opened -= len(idle)
+        for conn, _ in idle:
+            self.__close_quietly(conn)
+
+    def get_stats(self):
+        """Devuelve contadores del pool (esperas al prestar, reconexiones, etc.)."""
+        with self.__cond:
+            stats = dict(self.__stats)
+            stats["size"] = self.__size
+            stats["open"] = self.__opened
+            stats["idle"] = len(self.__idle)
+        stats["checkout_wait_seconds"] = round(stats["checkout_wait_seconds"], 3)
+        return stats
+
+    @staticmethod
+    def __close_quietly(conn):
+        drop_statement_cache(conn)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
 class Database(object):
-    def __init__(self, user, password, host, port, database):
+    def __init__(self, user, password, host, port, database, pool=None):
         self.__user = user
         self.__password = password
         self.__host = host
         self.__port = port
         self.__database = database
+        self.__pool = pool
         self.__connection = None
-        self.__session = None
+        self.__statements = None
+        self.__session = None  # Último cursor ejecutado (para lastrowid/rowcount)
     ## End def __init__
 
     def open(self, retries=3, delay=5):
+        if self.__pool is not None:
+            # Modo pool: se toma prestada una conexión ya validada
+            self.__connection = self.__pool.acquire()
+            self.__statements = statement_cache(self.__connection)
+            return
         for attempt in range(retries):
             try:
-                self.__connection = MySQLdb.connect(
-                    host=self.__host,
-                    user=self.__user,
-                    passwd=self.__password,
-                    db=self.__database,
-                    port=self.__port
-                )
-                self.__session = self.__connection.cursor()
+                self.__connection = connect(self.__user, self.__password, self.__host, self.__port, self.__database)
+                self.__statements = statement_cache(self.__connection)
                 return
             except MySQLdb.Error as e:
                 print(f"Intento {attempt+1} - Error conectando a MySQL: {e}")
@@ -44,71 +384,322 @@ class Database(object):
                 else:
                     raise
 
-    def close(self):
-        if self.__session:
-            self.__session.close()
+    def close(self, discard=False):
+        # Los cursores preparados quedan asociados a la conexión para el próximo préstamo
         if self.__connection:
-            self.__connection.close()
+            if self.__pool is not None:
+                self.__pool.release(self.__connection, discard=discard)
+            else:
+                drop_statement_cache(self.__connection)
+                self.__connection.close()
+        self.__session = None
+        self.__statements = None
+        self.__connection = None
+
+    def __execute(self, query, params=None):
+        cursor, query = self.__statements.get(query)
+        cursor.execute(query, tuple(params or ()))
+        self.__session = cursor
+        return cursor
     
-    def __selectOneRow(self, query):
-        self.__session.execute(query)
-        result = self.__session.fetchone()
-        
-        return result
+    def __selectOneRow(self, query, params=None):
+        rows = self.__selectAll(query, params)
+        # Se leen todas las filas para no dejar resultados pendientes en la conexión
+        return rows[0] if rows else None
+
+    def __selectAll(self, query, params=None):
+        cursor = self.__execute(query, params)
+        charset = self.__connection.python_charset
+        return [_decode_row(row, charset) for row in cursor.fetchall()]
 
-    def __selectAll(self, query):
-        self.__session.execute(query)
-        return self.__session.fetchall()
+    def __selectAllIn(self, query, values, chunk_size=IN_CHUNK_SIZE):
+        """Ejecuta query con un IN (...) parametrizado, por bloques de chunk_size."""
+        values = list(values)
+        rows = []
+        for start in range(0, len(values), chunk_size):
+            placeholders, params = in_clause(values[start:start + chunk_size])
+            rows.extend(self.__selectAll(query.format(placeholders), params))
+        return rows
 
     def isCodeExists(self, code):
-        return self.__selectOneRow(GET_CLIENT.format(code))
+        return self.__selectOneRow(GET_CLIENT, (code,))
 
     def sendMessage(self, code, message):
-        self.__session.execute(INSERT_MESSAGE.format(code, message))
+        self.__execute(INSERT_MESSAGE, (code, message))
         self.__connection.commit()
         return self.__session.lastrowid
 
     def mark_as_sent(self, client_id):
-        self.__session.execute(MARK_AS_SENT.format(client_id))
+        self.__execute(MARK_AS_SENT, (client_id,))
         self.__connection.commit()
     
     def mark_as_process(self, table, id):
-        query = f"UPDATE {table} SET men_status = 1 WHERE id = {id}"
-        self.__session.execute(query)
+        if table not in MESSAGE_TABLES:
+            raise ValueError(f"Tabla no permitida para marcar mensajes: {table}")
+        self.__execute(MARK_AS_PROCESS.format(table), (id,))
         self.__connection.commit()
 
+    def mark_many_processed(self, table, ids, chunk_size=MARK_CHUNK_SIZE):
+        """
+        Marca como procesados todos los ids en una sola transacción,
+        con UPDATE ... WHERE id IN (...) por bloques de chunk_size.
+        """
+        if table not in MESSAGE_TABLES:
+            raise ValueError(f"Tabla no permitida para marcar mensajes: {table}")
+        ids = list(dict.fromkeys(ids))  # Sin duplicados, respetando el orden
+        if not ids:
+            return 0
+        try:
+            self.__mark_processed(table, ids, chunk_size)
+            self.__connection.commit()
+        except MySQLdb.Error:
+            self.__connection.rollback()
+            raise
+        return len(ids)
+
+    def __mark_processed(self, table, ids, chunk_size=MARK_CHUNK_SIZE):
+        for start in range(0, len(ids), chunk_size):
+            placeholders, params = in_clause(ids[start:start + chunk_size])
+            self.__execute(MARK_MANY_PROCESSED.format(table, placeholders), params)
+
+    def __delete_leases(self, table, worker_id, ids, chunk_size=MARK_CHUNK_SIZE):
+        for start in range(0, len(ids), chunk_size):
+            placeholders, params = in_clause(ids[start:start + chunk_size])
+            self.__execute(DELETE_LEASES.format(placeholders), (table, worker_id) + params)
+
+    def claim_batch(self, table, worker_id, limit=100, lease_seconds=300):
+        """
+        Reserva atómicamente hasta 'limit' mensajes pendientes para worker_id
+        durante lease_seconds. Las filas bloqueadas por otro worker se saltan
+        (SKIP LOCKED) y los leases vencidos de workers caídos se reclaman solos.
+        Devuelve las filas completas (SELECT *) efectivamente reservadas.
+        """
+        if table not in MESSAGE_TABLES:
+            raise ValueError(f"Tabla no permitida para reservar mensajes: {table}")
+        token = uuid.uuid4().hex
+        try:
+            rows = self.__selectAll(CLAIM_CANDIDATES.format(table), (table, limit))
+            if not rows:
+                self.__connection.commit()
+                return []
+            ids = pad_to_power_of_two(row[0] for row in rows)
+            params = []
+            for msg_id in ids:
+                params.extend((table, msg_id, worker_id, token, lease_seconds))
+            self.__execute(UPSERT_LEASES.format(", ".join([LEASE_ROW] * len(ids))), params)
+            # El upsert resuelve la carrera con otro worker: solo quedan los leases con nuestro token
+            won = {row[0] for row in self.__selectAll(GET_LEASES_BY_TOKEN, (table, token))}
+            self.__connection.commit()
+        except MySQLdb.Error:
+            self.__connection.rollback()
+            raise
+        return [row for row in rows if row[0] in won]
+
+    def release_leases(self, table, worker_id, ids):
+        """Libera leases sin marcar los mensajes, para que otro worker los tome de inmediato."""
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return 0
+        try:
+            self.__delete_leases(table, worker_id, ids)
+            self.__connection.commit()
+        except MySQLdb.Error:
+            self.__connection.rollback()
+            raise
+        return len(ids)
+
+    def complete_leases(self, table, worker_id, ids):
+        """Marca como procesados los mensajes reservados y borra sus leases en una transacción."""
+        if table not in MESSAGE_TABLES:
+            raise ValueError(f"Tabla no permitida para marcar mensajes: {table}")
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return 0
+        try:
+            self.__mark_processed(table, ids)
+            self.__delete_leases(table, worker_id, ids)
+            self.__connection.commit()
+        except MySQLdb.Error:
+            self.__connection.rollback()
+            raise
+        return len(ids)
+
+    def purge_expired_leases(self, older_than=3600, limit=1000):
+        """Borra leases vencidos hace más de older_than segundos (mensajes ya completados por otro worker)."""
+        return self.execute(PURGE_EXPIRED_LEASES, (older_than, limit))
+
+    def get_chat_events_since(self, last_id, limit=1000):
+        """Avisos de telegram_chat_evento posteriores a last_id: [(id, sufijo), ...]."""
+        return self.__selectAll(GET_CHAT_EVENTS_SINCE, (last_id, limit))
+
+    def get_max_chat_event_id(self):
+        return self.__selectOneRow(GET_MAX_CHAT_EVENT)[0]
+
+    def purge_chat_events(self, older_than=86400, limit=1000):
+        """Borra avisos de chat con más de older_than segundos (ya los leyeron todos los senders)."""
+        return self.execute(PURGE_CHAT_EVENTS, (older_than, limit))
+
+    def claim_cooldown(self, key, seconds, worker_id):
+        """
+        Reserva el cooldown de 'key' por 'seconds' segundos con un único upsert.
+        Devuelve (reservado, segundos_restantes); si otro lo tiene vigente,
+        los segundos que le quedan.
+        """
+        for _ in range(2):
+            cursor = self.__execute(CLAIM_COOLDOWN, (str(key), seconds, worker_id))
+            claimed = cursor.rowcount in (1, 2)
+            self.__connection.commit()
+            if claimed:
+                return True, float(seconds)
+            row = self.__selectOneRow(GET_COOLDOWN_REMAINING, (str(key),))
+            remaining = float(row[0]) if row and row[0] is not None else 0.0
+            if remaining > 0:
+                return False, remaining
+            # Venció entre el upsert y la consulta: se intenta una vez más
+        return False, 0.0
+
+    def purge_call_cooldown(self, older_than=86400, limit=1000):
+        """Borra cooldowns vencidos hace más de older_than segundos."""
+        return self.execute(PURGE_CALL_COOLDOWN, (older_than, limit))
+
+    def get_call_client(self, code):
+        """Fila de clientes_llamada del abonado o None."""
+        return self.__selectOneRow(GET_CALL_CLIENT, (code,))
+
+    def get_all_call_clients(self):
+        return self.__selectAll(GET_ALL_CALL_CLIENTS)
+
+    def get_call_clients_checksum(self):
+        """CHECKSUM TABLE de clientes_llamada (None si la tabla no existe)."""
+        row = self.__selectOneRow(CHECKSUM_CALL_CLIENTS)
+        return row[1] if row else None
+
     def insert_obs(self, obs):
-        self.__session.execute(INSERT_OBS.format(obs))
+        self.__execute(INSERT_OBS, (obs,))
         self.__connection.commit()
 
     def getClaimId(self, messageId):
-        return self.__selectOneRow(GET_CLAIM_ID.format(messageId))
+        return self.__selectOneRow(GET_CLAIM_ID, (messageId,))
     
-    def get_one_row(self, query):
-        return self.__selectOneRow(query)
+    def get_one_row(self, query, params=None):
+        return self.__selectOneRow(query, params)
         
-    def get_unsent(self, query):
-        return self.__selectAll(query)
+    def get_unsent(self, query, params=None):
+        return self.__selectAll(query, params)
+
+    def get_unsent_since(self, table, last_id, limit=100):
+        """Mensajes pendientes con id > last_id, recorriendo solo la cola de la clave primaria."""
+        if table not in MESSAGE_TABLES:
+            raise ValueError(f"Tabla no permitida: {table}")
+        return self.__selectAll(GET_UNSENT_SINCE.format(table), (last_id, limit))
+
+    def get_unsent_sweep(self, table, limit=100):
+        """Barrido completo de men_status = 0 (la consulta original), para rezagados."""
+        if table not in MESSAGE_TABLES:
+            raise ValueError(f"Tabla no permitida: {table}")
+        return self.__selectAll(GET_UNSENT_SWEEP.format(table), (limit,))
+
+    def get_max_id(self, table):
+        if table not in MESSAGE_TABLES:
+            raise ValueError(f"Tabla no permitida: {table}")
+        return self.__selectOneRow(GET_MAX_ID.format(table))[0]
+
+    def get_fetch_position(self, name):
+        row = self.__selectOneRow(GET_FETCH_POSITION, (name,))
+        return row[0] if row else None
+
+    def save_fetch_position(self, name, last_id):
+        """Persiste la posición; nunca retrocede aunque dos procesos la escriban."""
+        self.__execute(SAVE_FETCH_POSITION, (name, last_id))
+        self.__connection.commit()
+
+    def rewind_fetch_position(self, name, last_id):
+        """Retrocede la posición guardada (para releer mensajes que quedaron sin marcar)."""
+        self.__execute(REWIND_FETCH_POSITION, (last_id, name))
+        self.__connection.commit()
+
+    def move_rows(self, table, archive_table, key_column, where, params, limit):
+        """
+        Mueve hasta 'limit' filas que cumplen 'where' de table a archive_table
+        en una sola transacción. Los nombres y el 'where' deben venir de
+        configuración interna, nunca de datos externos.
+        Devuelve (filas_movidas, segundos_con_filas_bloqueadas).
+        """
+        lock_start = time.time()
+        try:
+            select = ARCHIVE_SELECT.format(key=key_column, table=table, where=where)
+            ids = [row[0] for row in self.__selectAll(select, tuple(params) + (limit,))]
+            if ids:
+                placeholders, id_params = in_clause(ids)
+                self.__execute(ARCHIVE_COPY.format(archive=archive_table, table=table, key=key_column, ids=placeholders), id_params)
+                self.__execute(ARCHIVE_DELETE.format(table=table, key=key_column, ids=placeholders), id_params)
+            self.__connection.commit()
+        except MySQLdb.Error:
+            self.__connection.rollback()
+            raise
+        return len(ids), time.time() - lock_start
+
+    def get_all_rows(self, query, params=None):
+        return self.__selectAll(query, params)
 
     def get_phone_from_code(self, code):
-        return self.__selectOneRow(GET_CLIENT_PHONE.format(code))
+        return self.__selectOneRow(GET_CLIENT_PHONE, (code,))
+
+    def get_phones_for_clients(self, codes):
+        """
+        Devuelve {str(cli_codigo): CLI_CELULAR} para todos los códigos
+        distintos con una sola consulta IN (...).
+        """
+        codes = {str(code) for code in codes if code is not None}
+        if not codes:
+            return {}
+        rows = self.__selectAllIn(GET_CLIENT_PHONES, sorted(codes))
+        return {str(code): phones for code, phones in rows}
+
+    def get_chat_ids(self, suffixes):
+        """
+        Devuelve {ultimos_7_digitos: chat_id} para todos los sufijos pedidos
+        con una sola consulta. Si hay varios registros gana el primero.
+        """
+        suffixes = {str(suffix) for suffix in suffixes if suffix}
+        if not suffixes:
+            return {}
+        chat_ids = {}
+        for suffix, chat_id in self.__selectAllIn(GET_CHAT_IDS, sorted(suffixes)):
+            chat_ids.setdefault(str(suffix), chat_id)
+        return chat_ids
 
     def insert_chat_id(self, phone, chat_id):
-        value = self.get_chat_id(phone)
+        # Se guardan solo los dígitos, igual que hacía el INSERT numérico anterior
+        phone = "".join(c for c in str(phone) if c.isdigit())
+        value = self.__selectOneRow(GET_CHAT_ID_BY_PHONE, (phone_suffix(phone), phone))
+        lastrowid = None
         if value:
             self.update_chat_id(phone, chat_id)
         else:
-            self.__session.execute(INSERT_CHAT_ID.format(phone, chat_id))
+            self.__execute(INSERT_CHAT_ID, (phone, chat_id))
+            lastrowid = self.__session.lastrowid
+            # El aviso va en la misma transacción que el alta
+            self.__execute(INSERT_CHAT_EVENT, (phone_suffix(phone),))
             self.__connection.commit()
 
-        return self.__session.lastrowid
+        return lastrowid
 
     def update_chat_id(self, phone, chat_id):
-        self.__session.execute(UPDATE_CHAT_ID.format(chat_id, phone))
+        phone = "".join(c for c in str(phone) if c.isdigit())
+        self.__execute(UPDATE_CHAT_ID, (chat_id, phone_suffix(phone), phone))
+        self.__execute(INSERT_CHAT_EVENT, (phone_suffix(phone),))
         self.__connection.commit()
     
     def get_chat_id(self, phone):
-        return self.__selectOneRow(GET_CHAT_ID.format(phone))
+        """Busca el chat_id por igualdad sobre los últimos 7 dígitos (acepta el teléfono completo o el sufijo)."""
+        return self.__selectOneRow(GET_CHAT_ID, (phone_suffix(phone),))
+
+    def execute(self, query, params=None):
+        """Ejecuta una sentencia de escritura/DDL, confirma y devuelve las filas afectadas."""
+        cursor = self.__execute(query, params)
+        self.__connection.commit()
+        return cursor.rowcount
         
     def __enter__(self):
         """Para usar con 'with'."""
@@ -117,8 +708,306 @@ class Database(object):
 
     def __exit__(self, exc_type, exc_value, traceback):
         """Para usar con 'with'. Maneja commit/rollback."""
-        if exc_type is not None:
-            self.__connection.rollback()
+        # Una conexión que falló a nivel MySQL no se devuelve al pool
+        discard = exc_type is not None and issubclass(exc_type, MySQLdb.Error)
+        try:
+            if exc_type is not None:
+                self.__connection.rollback()
+            else:
+                self.__connection.commit()
+        except MySQLdb.Error:
+            discard = True
+            raise
+        finally:
+            self.close(discard=discard)
+
+
+class MarkBuffer(object):
+    """
+    Acumula los ids ya despachados y los marca como procesados en lote
+    cada flush_every elementos y al salir del bloque 'with'.
+    """
+    def __init__(self, db, table, flush_every=20, worker_id=None):
+        self.__db = db
+        self.__table = table
+        self.__flush_every = max(1, flush_every)
+        self.__worker_id = worker_id  # Con leases: completa el lease además de marcar
+        self.__pending = []
+        self.flushed = 0
+
+    def add(self, msg_id):
+        self.__pending.append(msg_id)
+        if len(self.__pending) >= self.__flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.__pending:
+            return
+        if self.__worker_id is not None:
+            self.flushed += self.__db.complete_leases(self.__table, self.__worker_id, self.__pending)
         else:
-            self.__connection.commit()
-        self.close()
\ No newline at end of file
+            self.flushed += self.__db.mark_many_processed(self.__table, self.__pending)
+        self.__pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+            return
+        # Con una excepción en curso se intenta igual no perder lo ya enviado
+        try:
+            self.flush()
+        except MySQLdb.Error:
+            pass
+
+
+class HighWaterMark(object):
+    """
+    Lectura incremental de una tabla de salida. Recuerda el último id visto y
+    consulta WHERE id > último por clave primaria, en lugar de re-escanear
+    men_status = 0 sobre todo el histórico. Cada sweep_interval segundos hace
+    el barrido completo para recoger rezagados (ids menores confirmados
+    tarde); los mensajes que el worker deja sin marcar se devuelven con
+    rewind(). La posición se guarda en fetch_position para que un reinicio
+    no vuelva a escanear la tabla.
+    """
+    def __init__(self, table, name=None, sweep_interval=60):
+        self.__table = table
+        self.__name = name or table
+        self.__sweep_interval = sweep_interval
+        self.__last_sweep = time.monotonic()
+        self.__sweep_pending = False
+        self.last_id = None
+
+    def fetch(self, db, limit=100):
+        """Devuelve el próximo lote de mensajes pendientes y avanza la posición."""
+        if self.last_id is None:
+            self.last_id = db.get_fetch_position(self.__name)
+            if self.last_id is None:
+                # Sin posición guardada: se barre todo una vez y se arranca desde la cola actual
+                self.__sweep_pending = True
+                self.last_id = db.get_max_id(self.__table)
+
+        sweep = self.__sweep_pending or time.monotonic() - self.__last_sweep >= self.__sweep_interval
+        if sweep:
+            self.__last_sweep = time.monotonic()
+            rows = db.get_unsent_sweep(self.__table, limit)
+            # Si el barrido vino lleno quedan rezagados: se repite en el próximo ciclo
+            self.__sweep_pending = len(rows) >= limit
+        else:
+            rows = db.get_unsent_since(self.__table, self.last_id, limit)
+
+        newest = max((row[0] for row in rows), default=None)
+        if newest is not None and newest > self.last_id:
+            self.last_id = newest
+            db.save_fetch_position(self.__name, self.last_id)
+        return rows
+
+    def rewind(self, db, ids):
+        """
+        Retrocede la posición para que los mensajes 'ids' (leídos pero que
+        quedaron sin marcar: lote abortado, plazo vencido, envío diferido)
+        se vuelvan a leer en el próximo ciclo.
+        """
+        ids = [row_id for row_id in ids if row_id is not None]
+        if self.last_id is None or not ids or min(ids) > self.last_id:
+            return
+        self.last_id = min(ids) - 1
+        db.rewind_fetch_position(self.__name, self.last_id)
+
+
+class ChatIdCache(object):
+    """
+    Caché LRU con TTL de chat_id por sufijo de 7 dígitos, delante de
+    get_chat_ids/get_chat_id. También recuerda los teléfonos sin registrar
+    (caché negativa, con un TTL más corto). Las altas y cambios hechos por
+    telegram_server dejan un aviso en telegram_chat_evento; sync() los lee
+    por id y descarta las entradas afectadas.
+    """
+    def __init__(self, max_size=10000, ttl=3600, negative_ttl=300):
+        self.__max_size = max(1, max_size)
+        self.__ttl = ttl
+        self.__negative_ttl = negative_ttl
+        self.__entries = OrderedDict()  # sufijo -> (chat_id o None, vence)
+        self.__lock = threading.Lock()
+        self.__last_event_id = None
+        self.__stats = {"hits": 0, "negative_hits": 0, "misses": 0, "expired": 0, "evicted": 0, "invalidated": 0}
+
+    def __lookup(self, suffix, now):
+        """Devuelve (encontrado, chat_id). Llamar con el lock tomado."""
+        entry = self.__entries.get(suffix)
+        if entry is None:
+            return False, None
+        chat_id, expires = entry
+        if expires <= now:
+            del self.__entries[suffix]
+            self.__stats["expired"] += 1
+            return False, None
+        self.__entries.move_to_end(suffix)
+        self.__stats["hits" if chat_id is not None else "negative_hits"] += 1
+        return True, chat_id
+
+    def __store(self, suffix, chat_id, now):
+        """Guarda una entrada. Llamar con el lock tomado."""
+        self.__entries[suffix] = (chat_id, now + (self.__ttl if chat_id is not None else self.__negative_ttl))
+        self.__entries.move_to_end(suffix)
+        while len(self.__entries) > self.__max_size:
+            self.__entries.popitem(last=False)
+            self.__stats["evicted"] += 1
+
+    def get_many(self, db, suffixes):
+        """Como Database.get_chat_ids, pero sólo consulta la DB por los sufijos que no están en caché."""
+        result = {}
+        missing = set()
+        now = time.monotonic()
+        with self.__lock:
+            for suffix in {str(suffix) for suffix in suffixes if suffix}:
+                found, chat_id = self.__lookup(suffix, now)
+                if not found:
+                    missing.add(suffix)
+                elif chat_id is not None:
+                    result[suffix] = chat_id
+            self.__stats["misses"] += len(missing)
+        if missing:
+            loaded = db.get_chat_ids(missing)
+            with self.__lock:
+                for suffix in missing:
+                    self.__store(suffix, loaded.get(suffix), now)
+            result.update(loaded)
+        return result
+
+    def get(self, db, phone):
+        """chat_id del teléfono (completo o sufijo) o None si no está registrado."""
+        suffix = phone_suffix(phone)
+        return self.get_many(db, [suffix]).get(suffix)
+
+    def invalidate(self, suffix):
+        with self.__lock:
+            if self.__entries.pop(str(suffix), None) is not None:
+                self.__stats["invalidated"] += 1
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def sync(self, db, limit=1000):
+        """Aplica los avisos de telegram_chat_evento nuevos. Devuelve cuántos se leyeron."""
+        if self.__last_event_id is None:
+            # Al arrancar la caché está vacía: sólo interesan los avisos futuros
+            self.__last_event_id = db.get_max_chat_event_id()
+            return 0
+        total = 0
+        while True:
+            events = db.get_chat_events_since(self.__last_event_id, limit)
+            for event_id, suffix in events:
+                self.invalidate(suffix)
+                self.__last_event_id = max(self.__last_event_id, event_id)
+            total += len(events)
+            if len(events) < limit:
+                return total
+
+    def get_stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats["size"] = len(self.__entries)
+        lookups = stats["hits"] + stats["negative_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((stats["hits"] + stats["negative_hits"]) / lookups, 3) if lookups else 0.0
+        return stats
+
+
+class CallClientDirectory(object):
+    """
+    Copia en memoria de clientes_llamada, indexada por abonado. La tabla
+    cambia muy poco y no tiene columna de modificación, así que refresh()
+    compara CHECKSUM TABLE cada refresh_interval segundos y sólo recarga
+    la tabla cuando cambió. Un abonado que no está se busca en la DB (por
+    si se dio de alta entre refrescos) y la ausencia se recuerda
+    negative_ttl segundos.
+    """
+    def __init__(self, refresh_interval=30, negative_ttl=60):
+        self.__refresh_interval = refresh_interval
+        self.__negative_ttl = negative_ttl
+        self.__rows = {}      # str(abonado) -> fila
+        self.__missing = {}   # str(abonado) -> vence la ausencia
+        self.__checksum = None
+        self.__next_check = 0.0
+        self.__lock = threading.Lock()
+        self.__stats = {"hits": 0, "misses": 0, "negative_hits": 0, "reloads": 0, "checks": 0}
+
+    def __replace(self, rows, checksum):
+        with self.__lock:
+            self.__rows = {str(row[1]): tuple(row) for row in rows}
+            self.__missing = {}
+            self.__checksum = checksum
+
+    def load(self, db, checksum=None):
+        """Carga la tabla completa. Devuelve cuántos abonados quedaron."""
+        if checksum is None:
+            checksum = db.get_call_clients_checksum()
+        rows = db.get_all_call_clients()
+        self.__replace(rows, checksum)
+        self.__next_check = time.monotonic() + self.__refresh_interval
+        with self.__lock:
+            self.__stats["reloads"] += 1
+        return len(rows)
+
+    def refresh(self, db, force=False):
+        """Recarga si cambió el checksum (consultado cada refresh_interval). True si recargó."""
+        now = time.monotonic()
+        if not force and now < self.__next_check:
+            return False
+        self.__next_check = now + self.__refresh_interval
+        checksum = db.get_call_clients_checksum()
+        with self.__lock:
+            self.__stats["checks"] += 1
+            unchanged = checksum is not None and checksum == self.__checksum
+        if unchanged:
+            return False
+        self.load(db, checksum)
+        return True
+
+    def get(self, db, code):
+        """Fila del abonado; sólo consulta la DB si no está en memoria."""
+        key = str(code)
+        now = time.monotonic()
+        with self.__lock:
+            row = self.__rows.get(key)
+            if row is not None:
+                self.__stats["hits"] += 1
+                return row
+            if self.__missing.get(key, 0) > now:
+                self.__stats["negative_hits"] += 1
+                return None
+            self.__stats["misses"] += 1
+        row = db.get_call_client(code)
+        with self.__lock:
+            if row:
+                self.__rows[key] = tuple(row)
+            else:
+                if len(self.__missing) >= 10000:
+                    self.__missing = {k: v for k, v in self.__missing.items() if v > now}
+                self.__missing[key] = now + self.__negative_ttl
+        return tuple(row) if row else None
+
+    def rows(self):
+        with self.__lock:
+            return list(self.__rows.values())
+
+    def snapshot(self):
+        """(filas, checksum) para guardar y arrancar en caliente con restore()."""
+        with self.__lock:
+            return {key: list(row) for key, row in self.__rows.items()}, self.__checksum
+
+    def restore(self, rows, checksum):
+        """Carga una copia guardada; el primer refresh() la valida contra el checksum actual."""
+        self.__replace(rows.values(), checksum)
+        self.__next_check = 0.0
+
+    def get_stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats["size"] = len(self.__rows)
+            stats["checksum"] = self.__checksum
+        return stats
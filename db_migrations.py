@@ -0,0 +1,147 @@
+"""
+Migraciones de esquema para la base de Sigesmen.
+
+Uso:
+    python db_migrations.py status                 # Lista migraciones aplicadas/pendientes
+    python db_migrations.py apply                  # Aplica las migraciones pendientes
+
+Las migraciones se registran en la tabla schema_migrations, por lo que
+'apply' se puede ejecutar las veces que haga falta.
+
+Al actualizar desde una versión anterior, correr 'apply' (001 a 006) ANTES
+de desplegar los workers y telegram_server: las búsquedas de chat_id filtran
+por telegram_chat.telefono_suffix7, que no existe hasta aplicar la 001. El
+código anterior sigue funcionando con el esquema nuevo (su INSERT no escribe
+el sufijo). La 006 reconstruye telegram_chat y la bloquea mientras corre:
+aplicarla en un momento de poco tráfico.
+"""
+import os
+import sys
+import logging
+import argparse
+from dotenv import load_dotenv
+from dbSigesmen import Database
+
+# Cargar variables de entorno desde .env
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+DB_USER = os.getenv("DB_USER")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT = int(os.getenv("DB_PORT", 3306))
+DB_DATABASE = os.getenv("DB_DATABASE")
+
+CREATE_SCHEMA_MIGRATIONS = """CREATE TABLE IF NOT EXISTS schema_migrations (
+    nombre VARCHAR(100) NOT NULL PRIMARY KEY,
+    aplicada DATETIME NOT NULL
+)"""
+GET_APPLIED = "SELECT nombre FROM schema_migrations"
+INSERT_APPLIED = "INSERT INTO schema_migrations(nombre, aplicada) VALUES(%s, NOW())"
+
+# Lista ordenada de (nombre, [sentencias]). Nunca modificar una migración ya aplicada: agregar una nueva.
+MIGRATIONS = [
+    ("001_telegram_chat_suffix7", [
+        "ALTER TABLE telegram_chat ADD COLUMN telefono_suffix7 VARCHAR(7) NULL",
+        "CREATE INDEX idx_telegram_chat_suffix7 ON telegram_chat (telefono_suffix7)",
+    ]),
+    ("002_mensaje_lease", [
+        """CREATE TABLE IF NOT EXISTS mensaje_lease (
+            tabla VARCHAR(64) NOT NULL,
+            msg_id BIGINT NOT NULL,
+            worker_id VARCHAR(64) NOT NULL,
+            token CHAR(32) NOT NULL,
+            expira DATETIME NOT NULL,
+            PRIMARY KEY (tabla, msg_id),
+            KEY idx_mensaje_lease_token (tabla, token),
+            KEY idx_mensaje_lease_expira (expira)
+        )""",
+    ]),
+    ("003_fetch_position", [
+        """CREATE TABLE IF NOT EXISTS fetch_position (
+            nombre VARCHAR(100) NOT NULL PRIMARY KEY,
+            last_id BIGINT NOT NULL,
+            actualizado DATETIME NOT NULL
+        )""",
+    ]),
+    ("004_telegram_chat_evento", [
+        """CREATE TABLE IF NOT EXISTS telegram_chat_evento (
+            id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            telefono_suffix7 VARCHAR(7) NOT NULL,
+            creado DATETIME NOT NULL,
+            KEY idx_telegram_chat_evento_creado (creado)
+        )""",
+    ]),
+    ("005_call_cooldown", [
+        """CREATE TABLE IF NOT EXISTS call_cooldown (
+            abonado VARCHAR(64) NOT NULL PRIMARY KEY,
+            vence DATETIME(3) NOT NULL,
+            worker_id VARCHAR(64) NOT NULL,
+            KEY idx_call_cooldown_vence (vence)
+        )""",
+    ]),
+    # El sufijo lo calcula MySQL en cada INSERT/UPDATE, escriba quien escriba la tabla (el índice se conserva).
+    # MODIFY ... STORED copia la tabla completa (ALGORITHM=COPY) y bloquea las escrituras mientras dura.
+    ("006_telegram_chat_suffix7_generated", [
+        "ALTER TABLE telegram_chat MODIFY COLUMN telefono_suffix7 VARCHAR(7) GENERATED ALWAYS AS (RIGHT(telefono, 7)) STORED",
+    ]),
+]
+
+
+def open_database():
+    return Database(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE)
+
+
+def get_applied(db):
+    db.execute(CREATE_SCHEMA_MIGRATIONS)
+    return {row[0] for row in db.get_all_rows(GET_APPLIED)}
+
+
+def status():
+    """Muestra el estado de cada migración"""
+    with open_database() as db:
+        applied = get_applied(db)
+    for name, _ in MIGRATIONS:
+        logger.info(f"{'[x]' if name in applied else '[ ]'} {name}")
+
+
+def apply():
+    """Aplica en orden las migraciones pendientes"""
+    with open_database() as db:
+        applied = get_applied(db)
+        pending = [(name, statements) for name, statements in MIGRATIONS if name not in applied]
+        if not pending:
+            logger.info("No hay migraciones pendientes")
+            return
+        for name, statements in pending:
+            logger.info(f"Aplicando {name}...")
+            for statement in statements:
+                db.execute(statement)
+            db.execute(INSERT_APPLIED, (name,))
+            logger.info(f"✅ {name} aplicada")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migraciones de esquema de Sigesmen")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("status", help="Lista migraciones aplicadas y pendientes")
+    subparsers.add_parser("apply", help="Aplica las migraciones pendientes")
+    args = parser.parse_args(argv)
+
+    if args.command == "status":
+        status()
+    elif args.command == "apply":
+        apply()
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
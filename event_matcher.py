@@ -0,0 +1,137 @@
+"""
+Patrones de evento de clientes_llamada compilados una sola vez.
+
+is_event_to_call hacía re.search(patrón, mensaje) con el texto del patrón:
+con más patrones distintos que la caché interna de 're' (512) se
+recompilaba todo el tiempo, y un patrón mal escrito recién fallaba al
+llegar un mensaje. PatternCache compila y valida por texto de patrón;
+EventMatcher recuerda por texto el resultado de cada patrón del lote, así
+que cada par (patrón, texto) se evalúa una sola vez (útil en tormentas de
+alarmas, donde muchos abonados reciben el mismo texto).
+"""
+import re
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+class PatternCache(object):
+    """Patrón -> regex compilado (o None si es inválido), con desalojo LRU."""
+    def __init__(self, max_size=4096):
+        self.__max_size = max_size
+        self.__compiled = OrderedDict()
+        self.__errors = {}  # patrón inválido -> motivo
+        self.__lock = Lock()
+        self.__stats = {"hits": 0, "compiled": 0, "invalid": 0}
+
+    def get(self, pattern):
+        """Regex compilado del patrón, o None si no compila (se loguea una sola vez)."""
+        with self.__lock:
+            if pattern in self.__compiled:
+                self.__compiled.move_to_end(pattern)
+                self.__stats["hits"] += 1
+                return self.__compiled[pattern]
+        try:
+            compiled = re.compile(pattern)
+        except (re.error, TypeError) as e:
+            logger.error(f"Patrón de evento inválido '{pattern}': {e}")
+            compiled = None
+            with self.__lock:
+                self.__errors[pattern] = str(e)
+        with self.__lock:
+            self.__stats["compiled" if compiled is not None else "invalid"] += 1
+            self.__compiled[pattern] = compiled
+            if len(self.__compiled) > self.__max_size:
+                self.__compiled.popitem(last=False)
+        return compiled
+
+    def validate(self, patterns):
+        """Compila los patrones y devuelve {patrón: error} de los inválidos."""
+        invalid = [pattern for pattern in set(patterns) if self.get(pattern) is None]
+        with self.__lock:
+            return {pattern: self.__errors.get(pattern, "") for pattern in invalid}
+
+    def get_stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats["size"] = len(self.__compiled)
+        return stats
+
+
+class EventMatcher(object):
+    """
+    Patrones distintos de un lote con el resultado recordado por texto (en
+    minúsculas) y patrón: en una tormenta de alarmas el mismo texto llega
+    para cientos de abonados y cada patrón se evalúa una sola vez contra
+    él. matches() evalúa sólo el patrón pedido, así que con textos casi
+    todos distintos cuesta lo mismo que buscar el patrón del abonado sin
+    memo. El memo está acotado a 'memo_size' textos (FIFO).
+
+    Se probó combinar todos los patrones en un único regex con lookaheads
+    con nombre, pero en 're' resultó varias veces más lento que recorrer
+    los regex compilados (se pierde la búsqueda rápida por prefijo literal);
+    ver benchmarks/bench_event_matcher.py.
+    """
+    def __init__(self, patterns, cache=None, memo_size=1024):
+        self.__cache = cache or PatternCache()
+        self.__compiled = []
+        for pattern in sorted(set(patterns)):
+            compiled = self.__cache.get(pattern)
+            if compiled is not None:
+                self.__compiled.append((pattern, compiled))
+        self.__by_pattern = dict(self.__compiled)
+        self.patterns = set(self.__by_pattern)
+        self.__memo_size = memo_size
+        self.__memo = OrderedDict()  # texto -> {patrón: aparece}
+        self.__lock = Lock()
+        self.__stats = {"evaluated": 0, "memo_hits": 0}
+
+    def __known(self, text):
+        """{patrón: aparece} recordado para el texto (lo crea si falta). Llamar con el lock tomado."""
+        known = self.__memo.get(text)
+        if known is None:
+            known = self.__memo[text] = {}
+            if len(self.__memo) > self.__memo_size:
+                self.__memo.popitem(last=False)
+        return known
+
+    def match_all(self, msg):
+        """Conjunto (inmutable) de patrones del lote que aparecen en el mensaje."""
+        text = msg.lower()
+        with self.__lock:
+            known = self.__known(text)
+            if len(known) == len(self.__compiled):
+                self.__stats["memo_hits"] += 1
+                return frozenset(pattern for pattern, found in known.items() if found)
+            missing = [(pattern, regex) for pattern, regex in self.__compiled if pattern not in known]
+        found = {pattern: regex.search(text) is not None for pattern, regex in missing}
+        with self.__lock:
+            known.update(found)
+            self.__stats["evaluated"] += len(found)
+            return frozenset(pattern for pattern, found in known.items() if found)
+
+    def matches(self, pattern, msg):
+        """True si 'pattern' aparece en el mensaje. Un patrón ajeno al lote se busca en la caché."""
+        regex = self.__by_pattern.get(pattern)
+        if regex is None:
+            compiled = self.__cache.get(pattern)
+            return compiled is not None and compiled.search(msg.lower()) is not None
+        text = msg.lower()
+        with self.__lock:
+            known = self.__known(text)
+            if pattern in known:
+                self.__stats["memo_hits"] += 1
+                return known[pattern]
+        found = regex.search(text) is not None
+        with self.__lock:
+            known[pattern] = found
+            self.__stats["evaluated"] += 1
+        return found
+
+    def get_stats(self):
+        """evaluated: búsquedas de regex (patrón x texto); memo_hits: consultas resueltas por el memo."""
+        with self.__lock:
+            stats = dict(self.__stats)
+        stats["patterns"] = len(self.__compiled)
+        return stats
@@ -0,0 +1,316 @@
+"""
+Pool de módems GSM con un hilo de envío por módem.
+
+send_to_sms_modem.py manejaba un único módem (MODEM_PORT) y un módem GSM
+envía del orden de 6 a 20 SMS por minuto: eso era el techo de todo el
+canal SMS. ModemPool reparte los envíos de una cola compartida entre
+varias ModemSession:
+
+- Cada módem toma trabajo cuando está libre (el menos cargado es el que
+  pide). Un módem con señal débil sólo toma trabajos que ya esperaron
+  weak_delay segundos, o si no hay otro módem sano.
+- Un reintento va preferentemente a un módem que todavía no lo intentó.
+- Un módem que falla (sondeo no ok, canal caído o failure_threshold
+  fallas seguidas) queda en cuarentena: se cierra y se reinicializa solo,
+  con espera exponencial, sin afectar a los demás.
+- get_stats() informa el rendimiento por módem (SMS/minuto, latencia).
+"""
+import time
+import logging
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Event, Lock, Thread
+
+logger = logging.getLogger(__name__)
+
+ACTIVE = "active"
+QUARANTINED = "quarantined"
+STARTING = "starting"
+
+
+def parse_modem_ports(value, default_baudrate=115200):
+    """
+    'COM3,COM4:9600' o '/dev/ttyUSB0:115200,/dev/ttyUSB1' -> [(puerto, baudios), ...].
+    Los baudios van después del último ':' y son opcionales.
+    """
+    ports = []
+    for item in (value or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        port, _, baudrate = item.rpartition(":")
+        if port and baudrate.isdigit():
+            ports.append((port, int(baudrate)))
+        else:
+            ports.append((item, default_baudrate))
+    return ports
+
+
+class _Job(object):
+    def __init__(self, args):
+        self.args = args
+        self.future = Future()
+        self.enqueued = time.monotonic()
+        self.not_before = 0.0   # Reintentos: no antes de este instante
+        self.attempts = 0
+        self.tried = set()      # Módems que ya lo intentaron
+
+
+class _ModemWorker(object):
+    def __init__(self, session):
+        self.session = session
+        self.name = session.name
+        self.state = STARTING
+        self.busy = False
+        self.consecutive_failures = 0
+        self.backoff = 0
+        self.ready = Event()
+        self.thread = None
+        self.completed = deque()  # Instantes de envíos exitosos (ventana de rendimiento)
+        self.stats = {"sent": 0, "failed": 0, "quarantines": 0, "reinits": 0, "latency_total": 0.0}
+
+
+class ModemPool(object):
+    """
+    send_func(session, *args) -> (ok, detalle) hace un envío sobre una
+    ModemSession abierta. submit(*args) devuelve un Future con
+    (ok, detalle, nombre_del_módem).
+    """
+    def __init__(self, sessions, send_func, max_attempts=3, retry_delay=2.0, min_rssi=5, weak_delay=2.0,
+                 failure_threshold=5, quarantine_base=30, quarantine_max=600, throughput_window=600,
+                 on_quarantine=None):
+        self.__workers = [_ModemWorker(session) for session in sessions]
+        self.__send = send_func
+        self.__max_attempts = max_attempts
+        self.__retry_delay = retry_delay
+        self.__min_rssi = min_rssi
+        self.__weak_delay = weak_delay
+        self.__failure_threshold = failure_threshold
+        self.__quarantine_base = quarantine_base
+        self.__quarantine_max = quarantine_max
+        self.__window = throughput_window
+        self.__on_quarantine = on_quarantine
+        self.__queue = deque()
+        self.__cond = Condition(Lock())
+        self.__stop = Event()
+
+    # --- Ciclo de vida ---
+
+    def start(self, ready_timeout=30):
+        """Abre todos los módems en paralelo y arranca sus hilos. Devuelve cuántos quedaron activos."""
+        for worker in self.__workers:
+            worker.thread = Thread(target=self.__run, args=(worker,), name=f"sms-{worker.name}", daemon=True)
+            worker.thread.start()
+        deadline = time.monotonic() + ready_timeout
+        for worker in self.__workers:
+            worker.ready.wait(max(0.0, deadline - time.monotonic()))
+        return self.healthy_count()
+
+    def close(self, timeout=5):
+        """Deja de tomar trabajos, cancela los pendientes y cierra los módems."""
+        self.__stop.set()
+        with self.__cond:
+            pending = list(self.__queue)
+            self.__queue.clear()
+            self.__cond.notify_all()
+        for job in pending:
+            if job.attempts:
+                job.future.set_result((False, "Pool de módems detenido", None))
+            else:
+                job.future.cancel()
+        for worker in self.__workers:
+            if worker.thread is not None:
+                worker.thread.join(timeout)
+            worker.session.close()
+
+    def submit(self, *args):
+        if self.__stop.is_set():
+            raise RuntimeError("Pool de módems detenido")
+        job = _Job(args)
+        with self.__cond:
+            self.__queue.append(job)
+            self.__cond.notify_all()
+        return job.future
+
+    # --- Reparto ---
+
+    def __is_weak(self, worker):
+        rssi = worker.session.status().get("rssi")
+        return rssi is not None and (rssi == 99 or rssi < self.__min_rssi)
+
+    def __can_take(self, worker, job, now, weak, strong_free, untried_active):
+        if job.future.cancelled() or job.not_before > now:
+            return False
+        # Un reintento espera a un módem que no lo haya intentado, si lo hay
+        if worker.name in job.tried and untried_active(job):
+            return False
+        # Con señal débil se cede el trabajo a los módems fuertes libres
+        if weak and strong_free and now - job.enqueued < self.__weak_delay:
+            return False
+        return True
+
+    def __take(self, worker, timeout=0.5):
+        """Próximo trabajo para este módem, o None si no hay (o no le corresponde) en 'timeout'."""
+        weak = self.__is_weak(worker)
+        with self.__cond:
+            if not self.__queue:
+                self.__cond.wait(timeout)
+            now = time.monotonic()
+            active = [other for other in self.__workers if other.state == ACTIVE and other is not worker]
+            strong_free = any(not other.busy and not self.__is_weak(other) for other in active)
+
+            def untried_active(job):
+                return any(other.name not in job.tried for other in active)
+
+            for job in self.__queue:
+                if self.__can_take(worker, job, now, weak, strong_free, untried_active):
+                    self.__queue.remove(job)
+                    worker.busy = True
+                    return job
+            # Sacar de la cola los cancelados para que no crezca
+            self.__queue = deque(job for job in self.__queue if not job.future.cancelled())
+        if self.__queue:
+            self.__stop.wait(0.1)  # Trabajos que no le corresponden todavía: no girar en vacío
+        return None
+
+    def __requeue(self, job):
+        job.not_before = time.monotonic() + self.__retry_delay
+        with self.__cond:
+            self.__queue.appendleft(job)
+            self.__cond.notify_all()
+
+    # --- Hilo por módem ---
+
+    def __run(self, worker):
+        self.__open(worker)
+        worker.ready.set()
+        while not self.__stop.is_set():
+            if worker.state == QUARANTINED:
+                if self.__stop.wait(worker.backoff):
+                    break
+                worker.stats["reinits"] += 1
+                self.__open(worker)
+                continue
+            job = self.__take(worker)
+            if job is None:
+                continue
+            try:
+                self.__execute(worker, job)
+            finally:
+                worker.busy = False
+
+    def __open(self, worker):
+        try:
+            opened = worker.session.open()
+        except Exception as e:
+            logger.error(f"[{worker.name}] No se pudo abrir el módem: {e}")
+            opened = False
+        if opened and worker.session.status().get("status") == "ok":
+            if worker.state == QUARANTINED:
+                logger.info(f"[{worker.name}] Módem reinicializado, vuelve al reparto")
+            worker.state = ACTIVE
+            worker.consecutive_failures = 0
+            worker.backoff = 0
+        else:
+            self.__quarantine(worker, "no se pudo inicializar")
+
+    def __quarantine(self, worker, reason):
+        # Los otros módems activos, contados antes de cambiar el estado (al arrancar 'worker' está STARTING)
+        remaining = sum(1 for other in self.__workers if other.state == ACTIVE and other is not worker)
+        worker.backoff = min(self.__quarantine_max, worker.backoff * 2 if worker.backoff else self.__quarantine_base)
+        if worker.state != QUARANTINED:
+            worker.stats["quarantines"] += 1
+            logger.error(f"[{worker.name}] Módem en cuarentena por {worker.backoff}s: {reason}")
+            if self.__on_quarantine:
+                try:
+                    self.__on_quarantine(worker.name, reason, remaining)
+                except Exception as e:
+                    logger.error(f"[{worker.name}] Error en el aviso de cuarentena: {e}")
+        worker.state = QUARANTINED
+        worker.session.close()
+        if not self.healthy_count():
+            self.__fail_retries("Ningún módem disponible para reintentar")
+
+    def __fail_retries(self, reason):
+        """Sin módems activos, los reintentos en cola (ya no cancelables) se dan por fallidos."""
+        with self.__cond:
+            retries = [job for job in self.__queue if job.attempts]
+            self.__queue = deque(job for job in self.__queue if not job.attempts)
+        for job in retries:
+            job.future.set_result((False, reason, None))
+
+    def __execute(self, worker, job):
+        # Desde el primer intento el Future queda RUNNING: ya no se puede cancelar
+        if job.attempts == 0 and not job.future.set_running_or_notify_cancel():
+            return
+        job.attempts += 1
+        job.tried.add(worker.name)
+        start_time = time.monotonic()
+        try:
+            ok, detail = self.__send(worker.session, *job.args)
+        except Exception as e:
+            logger.exception(f"[{worker.name}] Excepción enviando: {e}")
+            ok, detail = False, str(e)
+        elapsed = time.monotonic() - start_time
+        if ok:
+            worker.consecutive_failures = 0
+            worker.stats["sent"] += 1
+            worker.stats["latency_total"] += elapsed
+            now = time.monotonic()
+            worker.completed.append(now)
+            while worker.completed and worker.completed[0] < now - self.__window:
+                worker.completed.popleft()
+            job.future.set_result((True, detail, worker.name))
+            return
+        worker.stats["failed"] += 1
+        worker.consecutive_failures += 1
+        # ¿Falla del módem o del mensaje? Un sondeo fresco lo decide
+        status = worker.session.probe() if worker.session.connected else {"status": "disconnected"}
+        if status.get("status") != "ok":
+            self.__quarantine(worker, f"{status.get('error', status.get('status'))} tras: {detail}")
+        elif worker.consecutive_failures >= self.__failure_threshold:
+            self.__quarantine(worker, f"{worker.consecutive_failures} fallas seguidas, última: {detail}")
+        if job.attempts < self.__max_attempts and self.healthy_count() and not self.__stop.is_set():
+            logger.warning(f"[{worker.name}] Intento {job.attempts}/{self.__max_attempts} falló: {detail}")
+            self.__requeue(job)
+            return
+        job.future.set_result((False, detail, worker.name))
+
+    # --- Estado ---
+
+    @property
+    def sessions(self):
+        return [worker.session for worker in self.__workers]
+
+    def healthy_count(self):
+        return sum(1 for worker in self.__workers if worker.state == ACTIVE)
+
+    def status(self):
+        """Estado agregado, con la forma de check_modem_status()."""
+        modems = {worker.name: dict(worker.session.status(), state=worker.state) for worker in self.__workers}
+        healthy = self.healthy_count()
+        status = {"status": "ok" if healthy else "error", "healthy": healthy, "total": len(self.__workers), "modems": modems}
+        if not healthy:
+            status["error"] = "Ningún módem disponible"
+        return status
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self.__cond:
+            queued = len(self.__queue)
+        modems = {}
+        for worker in self.__workers:
+            stats = dict(worker.stats)
+            total = stats.pop("latency_total")
+            recent = [when for when in list(worker.completed) if when >= now - self.__window]
+            stats.update({
+                "state": worker.state,
+                "busy": worker.busy,
+                "sent_last_minute": sum(1 for when in recent if when >= now - 60),
+                "per_minute": round(len(recent) * 60 / self.__window, 2),
+                "latency_avg_ms": round(total / stats["sent"] * 1000) if stats["sent"] else 0,
+                "rssi": worker.session.status().get("rssi"),
+            })
+            modems[worker.name] = stats
+        return {"queued": queued, "healthy": self.healthy_count(), "modems": modems}
+
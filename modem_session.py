@@ -0,0 +1,286 @@
+"""
+Sesión con un módem GSM: puerto, canal AT y estado configurado.
+
+send_sms_via_modem vaciaba los buffers y mandaba AT+CMGF=1 antes de cada
+SMS, y routine() llamaba a check_modem_status() (AT + AT+CSQ) al comienzo
+de cada ciclo. ModemSession aplica la configuración (modo texto/PDU,
+juego de caracteres, CNMI, ...) una vez y la repite sólo después de
+reconectar o de detectar un reinicio del módem (RDY, +CPIN: READY, SMS
+Ready, o un AT+CMGF? que ya no coincide). El estado de salud y señal lo
+mantiene un hilo de sondeo en segundo plano: status() no toca el puerto y
+enviar un SMS cuesta sólo el intercambio de AT+CMGS.
+"""
+import re
+import time
+import logging
+import serial
+from threading import Event, Lock, Thread
+from at_modem import ModemChannel
+from sms_pdu import build_submit_pdus
+
+logger = logging.getLogger(__name__)
+
+MODES = {"text": "1", "pdu": "0"}
+# Líneas que indican que el módem se reinició y perdió la configuración
+RESET_URCS = ("RDY", "+CPIN: READY", "SMS READY", "CALL READY", "PB DONE", "+CFUN: 1")
+# +CMS ERROR que suelen deberse a un modo distinto del esperado (302: no permitido, 303: no soportado, 304: parámetro PDU)
+MODE_ERRORS = ("+CMS ERROR: 302", "+CMS ERROR: 303", "+CMS ERROR: 304")
+# Estados de +CREG/+CGREG/+CEREG que cuentan como registrado (1: red propia, 5: roaming)
+REGISTERED = ("1", "5")
+
+CSQ = re.compile(r"\+CSQ:\s*(\d+)\s*,\s*(\d+)")
+CREG = re.compile(r"\+C(?:E|G)?REG:\s*(?:\d+\s*,\s*)?(\d+)")
+CMGF = re.compile(r"\+CMGF:\s*(\d)")
+
+
+def rssi_to_dbm(rssi):
+    """+CSQ rssi (0-31, 99 = desconocido) a dBm."""
+    return None if rssi == 99 else -113 + 2 * rssi
+
+
+class ModemSession(object):
+    """
+    init_commands se aplican en orden después de AT+CMGF (ej. 'AT+CSCS="GSM"',
+    'AT+CNMI=2,1,0,1,0'). Thread-safe: los comandos pasan por la cola FIFO
+    del ModemChannel.
+    """
+    def __init__(self, port_name, baudrate=115200, mode="text", init_commands=(), probe_interval=30,
+                 probe_timeout=2, name=None, opener=serial.Serial):
+        if mode not in MODES:
+            raise ValueError(f"Modo de módem inválido: {mode}")
+        self.port_name = port_name
+        self.name = name or port_name
+        self.__baudrate = baudrate
+        self.__default_mode = mode
+        self.__init_commands = [command for command in init_commands if command]
+        self.__probe_interval = probe_interval
+        self.__probe_timeout = probe_timeout
+        self.__opener = opener
+        self.__lock = Lock()
+        self.port = None
+        self.channel = None
+        self.__mode = None          # Modo aplicado (None = sin configurar)
+        self.__needs_config = True
+        self.__registration = None  # Último estado conocido por URC o sondeo
+        self.__cmms_supported = True  # AT+CMMS=2 (enlace abierto entre segmentos); False si el módem lo rechazó
+        self.__status = {"status": "disconnected", "error": "Módem no inicializado"}
+        self.__stop = Event()
+        self.__prober = None
+        self.__stats = {"opens": 0, "configs": 0, "resets_detected": 0, "probes": 0, "probe_failures": 0,
+                        "segments": 0, "multipart": 0}
+
+    # --- Ciclo de vida ---
+
+    def open(self, ready_timeout=5):
+        """Abre el puerto, arranca el canal, configura y lanza el sondeo. True si el módem respondió."""
+        self.close()
+        logger.info(f"[{self.name}] Abriendo puerto a {self.__baudrate} baudios")
+        self.port = self.__opener(self.port_name, self.__baudrate, timeout=3)
+        self.channel = ModemChannel(self.port, name=self.name).start()
+        self.channel.subscribe("", self.__on_urc)
+        self.__stats["opens"] += 1
+        if not self.channel.wait_ready(timeout=ready_timeout):
+            self.__set_status({"status": "error", "error": "Módem no responde"})
+            return False
+        with self.__lock:
+            self.__needs_config = True
+        if not self.ensure_configured():
+            return False
+        self.probe()
+        self.__stop.clear()
+        self.__prober = Thread(target=self.__probe_loop, name=f"{self.name}-prober", daemon=True)
+        self.__prober.start()
+        return True
+
+    def close(self):
+        self.__stop.set()
+        if self.__prober is not None:
+            # Un sondeo en curso hace hasta tres comandos de probe_timeout cada uno
+            self.__prober.join(self.__probe_timeout * 4)
+            if self.__prober.is_alive():
+                logger.warning(f"[{self.name}] El sondeo no terminó a tiempo; se cierra el canal igual")
+            self.__prober = None
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+        if self.port is not None:
+            try:
+                self.port.close()
+            except Exception as e:
+                logger.warning(f"[{self.name}] Error cerrando el puerto: {e}")
+            self.port = None
+        with self.__lock:
+            self.__mode = None
+            self.__needs_config = True
+        self.__set_status({"status": "disconnected", "error": "Puerto cerrado"})
+
+    def reconnect(self, pause=2):
+        """Cierra y vuelve a abrir el puerto (la configuración se reaplica al abrir)."""
+        self.close()
+        time.sleep(pause)
+        return self.open()
+
+    @property
+    def connected(self):
+        return self.channel is not None and self.channel.alive
+
+    # --- Configuración ---
+
+    def __on_urc(self, line, body):
+        """Corre en el hilo lector: sólo marca estado, nunca envía comandos."""
+        logger.info(f"[{self.name}] {line}" + (f" | {body}" if body else ""))
+        upper = line.upper()
+        if upper.startswith(RESET_URCS):
+            with self.__lock:
+                if not self.__needs_config:
+                    self.__stats["resets_detected"] += 1
+                    logger.warning(f"[{self.name}] Reinicio del módem detectado ({line}): se reaplicará la configuración")
+                self.__needs_config = True
+        match = CREG.match(line)
+        if match:
+            with self.__lock:
+                self.__registration = match.group(1)
+
+    def __apply(self, command):
+        response = self.channel.command(command)
+        if not response.ok:
+            raise RuntimeError(f"'{command}' respondió {response.text or 'nada'}")
+
+    def ensure_configured(self, mode=None):
+        """Aplica la configuración si hace falta (o si cambia el modo). Devuelve True si quedó aplicada."""
+        mode = mode or self.__mode or self.__default_mode
+        with self.__lock:
+            if not self.__needs_config and self.__mode == mode:
+                return True
+            full = self.__needs_config
+        try:
+            self.__apply(f"AT+CMGF={MODES[mode]}")
+            if full:
+                for command in self.__init_commands:
+                    self.__apply(command)
+        except (RuntimeError, OSError) as e:
+            logger.error(f"[{self.name}] No se pudo configurar el módem: {e}")
+            self.__set_status({"status": "error", "error": f"Configuración fallida: {e}"})
+            return False
+        with self.__lock:
+            self.__mode = mode
+            self.__needs_config = False
+            self.__stats["configs"] += 1
+        if full:
+            logger.info(f"[{self.name}] Módem configurado (modo {mode}, {len(self.__init_commands)} comandos extra)")
+        return True
+
+    # --- Envío ---
+
+    def command(self, command, timeout=None):
+        if not self.connected:
+            raise ConnectionError(f"[{self.name}] Módem no conectado")
+        return self.channel.command(command, timeout)
+
+    def send_sms_text(self, number, text, **kwargs):
+        """AT+CMGS en modo texto. La configuración sólo se reenvía si el módem la perdió."""
+        if not self.connected:
+            return False, "Módem no inicializado"
+        if not self.ensure_configured("text"):
+            return False, "Módem no configurado (modo texto)"
+        ok, result = self.channel.send_sms_text(number, text, **kwargs)
+        if not ok and any(code in result for code in MODE_ERRORS):
+            self.mark_unconfigured(result)
+        return ok, result
+
+    def send_sms_pdu(self, number, text, **kwargs):
+        """
+        AT+CMGS en modo PDU: GSM-7 (UCS-2 si hace falta) y, si el texto no
+        entra en un SMS, segmentos concatenados enviados en secuencia con
+        AT+CMMS=2 para que el enlace de radio no se cierre entre uno y otro.
+        """
+        if not self.connected:
+            return False, "Módem no inicializado"
+        try:
+            pdus = build_submit_pdus(number, text)
+        except ValueError as e:
+            return False, str(e)
+        if not self.ensure_configured("pdu"):
+            return False, "Módem no configurado (modo PDU)"
+        if len(pdus) > 1:
+            self.__stats["multipart"] += 1
+            # Con modo 2 el módem no cierra el enlace entre envíos; se reenvía por si se reinició
+            if self.__cmms_supported and not self.channel.command("AT+CMMS=2").ok:
+                self.__cmms_supported = False
+                logger.info(f"[{self.name}] El módem no soporta AT+CMMS, los segmentos se envían sin él")
+        self.__stats["segments"] += len(pdus)
+        ok, result = self.channel.send_sms_pdu(pdus, **kwargs)
+        if not ok and any(code in result for code in MODE_ERRORS):
+            self.mark_unconfigured(result)
+        return ok, result
+
+    def mark_unconfigured(self, reason):
+        with self.__lock:
+            self.__needs_config = True
+        logger.warning(f"[{self.name}] Se reaplicará la configuración: {reason}")
+
+    # --- Sondeo ---
+
+    def __set_status(self, status):
+        with self.__lock:
+            self.__status = dict(status, checked=time.time())
+
+    def probe(self):
+        """AT+CSQ, AT+CREG? y AT+CMGF? (este último detecta reinicios silenciosos). Actualiza status()."""
+        self.__stats["probes"] += 1
+        # Referencia local: close() puede dejar self.channel en None mientras el prober sondea
+        channel = self.channel
+        try:
+            if channel is None or not channel.alive:
+                raise ConnectionError("canal detenido")
+            start_time = time.monotonic()
+            csq = channel.command("AT+CSQ", timeout=self.__probe_timeout)
+            if not csq.ok:
+                raise RuntimeError("Módem no responde" if csq.timed_out else f"AT+CSQ: {csq.text}")
+            latency = time.monotonic() - start_time
+            creg = channel.command("AT+CREG?", timeout=self.__probe_timeout)
+            cmgf = channel.command("AT+CMGF?", timeout=self.__probe_timeout)
+        except (OSError, RuntimeError) as e:
+            self.__stats["probe_failures"] += 1
+            self.__set_status({"status": "disconnected" if not self.connected else "error", "error": str(e)})
+            return self.status()
+        signal = CSQ.search(csq.text)
+        registration = CREG.search(creg.text)
+        mode = CMGF.search(cmgf.text)
+        with self.__lock:
+            if registration:
+                self.__registration = registration.group(1)
+            if mode and self.__mode is not None and mode.group(1) != MODES[self.__mode] and not self.__needs_config:
+                self.__stats["resets_detected"] += 1
+                logger.warning(f"[{self.name}] AT+CMGF? devolvió {mode.group(1)}: se reaplicará la configuración")
+                self.__needs_config = True
+            registered = self.__registration in REGISTERED if self.__registration is not None else None
+        rssi = int(signal.group(1)) if signal else None
+        self.__set_status({
+            "status": "ok",
+            "signal_info": csq.text,
+            "rssi": rssi,
+            "signal_dbm": rssi_to_dbm(rssi) if rssi is not None else None,
+            "registration": self.__registration,
+            "registered": registered,
+            "network_info": "Verificado",
+            "latency_ms": round(latency * 1000),
+        })
+        return self.status()
+
+    def __probe_loop(self):
+        while not self.__stop.wait(self.__probe_interval):
+            self.probe()
+
+    def status(self):
+        """Último resultado del sondeo (no accede al puerto)."""
+        with self.__lock:
+            return dict(self.__status)
+
+    def get_stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats["mode"] = self.__mode
+            stats["needs_config"] = self.__needs_config
+        stats["channel"] = self.channel.get_stats() if self.channel else None
+        return stats
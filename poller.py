@@ -0,0 +1,181 @@
+"""
+Intervalo de sondeo adaptativo para los bucles principales de los workers.
+
+En lugar de dormir siempre SLEEP segundos:
+- si el lote vino lleno se vuelve a consultar enseguida (hay cola),
+- si vino con algo se consulta al intervalo mínimo,
+- si vino vacío el intervalo crece exponencialmente hasta el techo.
+El primer lote con mensajes vuelve al intervalo mínimo.
+
+Además un productor puede "patear" al worker (Waker.kick(), vía /kick en
+los workers con Flask o un datagrama local en el de SMS) para que salga de
+la espera y consulte en el acto.
+
+Uso como cliente (p.ej. desde el proceso que inserta en mensaje_a_sms):
+    python poller.py --socket /tmp/send_to_sms_modem.kick
+    python poller.py --port 8765
+"""
+import os
+import sys
+import socket
+import logging
+import argparse
+from threading import Lock, Event, Thread
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptivePoller(object):
+    """
+    batch_size: tamaño de lote que pide routine(); un lote de ese tamaño
+    se considera "lleno". El intervalo efectivo se mide desde el inicio del
+    ciclo, así que el tiempo de ejecución se descuenta de la espera.
+    """
+    def __init__(self, batch_size, min_interval=0.5, max_interval=10, factor=2.0, name="poller"):
+        self.__batch_size = batch_size
+        self.__min_interval = min_interval
+        self.__max_interval = max(min_interval, max_interval)
+        self.__factor = max(1.0, factor)
+        self.__name = name
+        self.__lock = Lock()
+        self.interval = min_interval
+        self.__stats = {"polls": 0, "empty_polls": 0, "full_polls": 0, "last_batch": 0}
+
+    def next_sleep(self, fetched, execution_time=0.0):
+        """Registra cuántas filas trajo el ciclo y devuelve cuántos segundos dormir."""
+        fetched = fetched or 0
+        with self.__lock:
+            self.__stats["polls"] += 1
+            self.__stats["last_batch"] = fetched
+            if fetched >= self.__batch_size:
+                self.__stats["full_polls"] += 1
+                self.interval = 0.0
+            elif fetched > 0:
+                self.interval = self.__min_interval
+            else:
+                self.__stats["empty_polls"] += 1
+                self.interval = min(self.__max_interval, max(self.__min_interval, self.interval * self.__factor))
+            interval = self.interval
+        sleep_time = max(0.0, interval - execution_time)
+        if fetched >= self.__batch_size:
+            logger.info(f"{self.__name}: lote lleno ({fetched} mensajes, puede haber más en cola); nuevo sondeo inmediato")
+        else:
+            logger.info(f"{self.__name}: {fetched} mensajes en el lote; próximo sondeo en {sleep_time:.2f} segundos (intervalo {interval:.2f}s)")
+        return sleep_time
+
+    def reset(self):
+        """Vuelve al intervalo mínimo (p.ej. ante un aviso de mensajes nuevos)."""
+        with self.__lock:
+            self.interval = self.__min_interval
+
+    def get_stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats["interval"] = round(self.interval, 2)
+        return stats
+
+
+class Waker(object):
+    """
+    Despierta al bucle principal antes de que termine su espera. Los avisos
+    que llegan mientras ya hay uno pendiente se coalescen en uno solo.
+    """
+    def __init__(self):
+        self.__event = Event()
+        self.__lock = Lock()
+        self.__stats = {"kicks": 0, "coalesced": 0, "wakeups": 0}
+
+    def kick(self):
+        """Pide un sondeo inmediato. Devuelve False si se sumó a uno ya pendiente."""
+        with self.__lock:
+            self.__stats["kicks"] += 1
+            if self.__event.is_set():
+                self.__stats["coalesced"] += 1
+                return False
+            self.__event.set()
+            return True
+
+    def wait(self, timeout):
+        """Duerme hasta 'timeout' segundos o hasta un kick. Devuelve True si lo despertaron."""
+        woken = self.__event.wait(timeout)
+        # Un kick que llegue durante la rutina queda pendiente para el próximo wait
+        self.__event.clear()
+        if woken:
+            with self.__lock:
+                self.__stats["wakeups"] += 1
+        return woken
+
+    def get_stats(self):
+        with self.__lock:
+            return dict(self.__stats)
+
+
+class KickListener(object):
+    """
+    Recibe kicks como datagramas locales: socket UNIX en 'path' si la
+    plataforma lo soporta, si no UDP en 127.0.0.1:'port' (Windows).
+    El contenido del datagrama se ignora.
+    """
+    def __init__(self, waker, path=None, port=None):
+        self.__waker = waker
+        self.__path = path if path and hasattr(socket, "AF_UNIX") else None
+        self.__port = port
+        self.__sock = None
+        self.address = None
+
+    def start(self):
+        if self.__path:
+            if os.path.exists(self.__path):
+                os.unlink(self.__path)  # Socket viejo de una ejecución anterior
+            self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.__sock.bind(self.__path)
+            self.address = self.__path
+        elif self.__port:
+            self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.__sock.bind(("127.0.0.1", self.__port))
+            self.address = f"127.0.0.1:{self.__sock.getsockname()[1]}"
+        else:
+            raise ValueError("KickListener necesita un path de socket UNIX o un puerto UDP")
+        thread = Thread(target=self.__run, name="kick-listener", daemon=True)
+        thread.start()
+        logger.info(f"Escuchando kicks en {self.address}")
+        return thread
+
+    def __run(self):
+        while True:
+            try:
+                self.__sock.recv(64)
+            except OSError:
+                return  # Socket cerrado
+            self.__waker.kick()
+
+    def close(self):
+        if self.__sock is not None:
+            self.__sock.close()
+        if self.__path and os.path.exists(self.__path):
+            os.unlink(self.__path)
+
+
+def send_kick(path=None, port=None):
+    """Envía un kick a un KickListener local (mismo criterio de path/puerto que el listener)."""
+    if path and hasattr(socket, "AF_UNIX"):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b"kick", path)
+    else:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b"kick", ("127.0.0.1", port))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Despierta a un worker para que consulte su tabla en el acto")
+    parser.add_argument("--socket", default=os.getenv("KICK_SOCKET"), help="Socket UNIX del worker")
+    parser.add_argument("--port", type=int, default=int(os.getenv("KICK_PORT", "0")), help="Puerto UDP local (Windows)")
+    args = parser.parse_args(argv)
+    if not args.socket and not args.port:
+        parser.error("indicar --socket o --port")
+    send_kick(args.socket, args.port)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
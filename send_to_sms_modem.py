@@ -3,13 +3,19 @@ import logging
 import time
 import signal
 import sys
-from dbSigesmen import Database
+import socket
+from archive_messages import ArchiveJob
+from poller import AdaptivePoller, Waker, KickListener
+from modem_session import ModemSession
+from modem_pool import ModemPool, parse_modem_ports
+from sms_pdu import to_gsm7
+from concurrent.futures import CancelledError, TimeoutError as FutureTimeoutError
+from dbSigesmen import Database, ConnectionPool, MarkBuffer, HighWaterMark, get_statement_stats, split_phones
 import json
 import traceback
 import smtplib
 from email.mime.text import MIMEText
 from dotenv import load_dotenv
-import serial
 import unicodedata
 
 # Cargar variables de entorno
@@ -26,11 +32,38 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = int(os.getenv("DB_PORT", 3306))
 DB_DATABASE = os.getenv("DB_DATABASE")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "2"))
+DB_POOL_MAX_IDLE = int(os.getenv("DB_POOL_MAX_IDLE", "300"))  # Segundos ociosa antes de descartar una conexión
+MARK_FLUSH_EVERY = int(os.getenv("MARK_FLUSH_EVERY", "20"))  # Ids a acumular antes de marcarlos en lote
+BATCH_SIZE = 100  # Mensajes por ciclo
+# Reparto con leases (SELECT ... FOR UPDATE SKIP LOCKED) para correr varias instancias en paralelo
+CLAIM_LEASES = os.getenv("CLAIM_LEASES", "0") == "1"
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", "300"))  # Debe superar lo que tarda un lote completo
+WORKER_ID = os.getenv("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+# Lectura incremental por id (con barrido completo cada SWEEP_INTERVAL segundos para rezagados)
+INCREMENTAL_FETCH = os.getenv("INCREMENTAL_FETCH", "1") == "1"
+SWEEP_INTERVAL = int(os.getenv("SWEEP_INTERVAL", "60"))
+# Archivado opcional en segundo plano de las filas procesadas (ver archive_messages.py)
+ARCHIVE_IN_WORKER = os.getenv("ARCHIVE_IN_WORKER", "0") == "1"
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "30"))
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", "3600"))
 
 # Configuración del Módem GSM
 MODEM_PORT = os.getenv("MODEM_PORT")
 MODEM_BAUDRATE = int(os.getenv("MODEM_BAUDRATE", "115200"))
 MODEM_PIN = os.getenv("MODEM_PIN", None)
+# Comandos extra de configuración separados por ';' (ej. AT+CSCS="GSM";AT+CNMI=2,1,0,1,0), se aplican una vez por sesión
+MODEM_INIT_COMMANDS = [command.strip() for command in os.getenv("MODEM_INIT_COMMANDS", "").split(";") if command.strip()]
+MODEM_PROBE_INTERVAL = int(os.getenv("MODEM_PROBE_INTERVAL", "30"))  # Segundos entre sondeos de señal/registro
+# "pdu": GSM-7/UCS-2 con mensajes largos en segmentos concatenados; "text": AT+CMGF=1, sólo ASCII y un único SMS
+SMS_MODE = os.getenv("SMS_MODE", "pdu").lower()
+# Varios módems separados por coma, con baudios opcionales (ej. /dev/ttyUSB0,/dev/ttyUSB1:9600); por defecto MODEM_PORT
+MODEM_PORTS = parse_modem_ports(os.getenv("MODEM_PORTS") or MODEM_PORT or "", MODEM_BAUDRATE)
+MODEM_MAX_ATTEMPTS = int(os.getenv("MODEM_MAX_ATTEMPTS", "3"))  # Intentos por teléfono (cada reintento prefiere otro módem)
+MODEM_MIN_RSSI = int(os.getenv("MODEM_MIN_RSSI", "5"))  # Por debajo, el módem cede trabajos a los de mejor señal
+MODEM_FAILURE_THRESHOLD = int(os.getenv("MODEM_FAILURE_THRESHOLD", "5"))  # Fallas seguidas antes de la cuarentena
+MODEM_QUARANTINE = int(os.getenv("MODEM_QUARANTINE", "30"))  # Primera espera de cuarentena (se duplica hasta 600 s)
+BATCH_SEND_TIMEOUT = int(os.getenv("BATCH_SEND_TIMEOUT", "240"))  # Espera máxima de los envíos de un lote (< WATCHDOG_TIMEOUT)
 
 # Configuración de Email para Alertas
 SMTP_HOST = os.getenv("SMTP_HOST")
@@ -41,10 +74,17 @@ ALERT_EMAIL_TO = os.getenv("ALERT_EMAIL_TO")
 
 # Configuración del Servicio
 SLEEP = int(os.getenv("SLEEP", "10"))  # 10 segundos por defecto
+# Sondeo adaptativo: inmediato con lote lleno, POLL_MIN_INTERVAL con mensajes y backoff hasta SLEEP sin ellos
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "0.5"))
+POLL_BACKOFF = float(os.getenv("POLL_BACKOFF", "2"))
+# Kicks locales: socket UNIX (Linux) o UDP en 127.0.0.1 (Windows); KICK_PORT=0 lo desactiva en Windows
+KICK_SOCKET = os.getenv("KICK_SOCKET", "/tmp/send_to_sms_modem.kick")
+KICK_PORT = int(os.getenv("KICK_PORT", "8765"))
 REBOOT_AFTER_ATTEMPS = int(os.getenv("REBOOT_AFTER_ATTEMPS", "10"))
 
-# Variable global para el módem (será un objeto serial.Serial)
-modem = None
+# Pool de módems (una ModemSession y un hilo de envío por puerto), se crea en init_modem
+modem_pool = None
+kick_listener = None  # Se inicia en __main__
 
 class SimpleFormatter(logging.Formatter):
     def format(self, record):
@@ -98,121 +138,62 @@ def send_alert_email(subject, body):
         logger.error(f"Error enviando email de alerta: {e}")
         return False
 
-def send_at_command(ser, command, timeout=5):
-    """Envía un comando AT y espera respuesta completa"""
-    ser.reset_input_buffer()
-    
-    ser.write((command + '\r\n').encode('utf-8'))
-    time.sleep(0.5)
-    
-    response = b''
-    start_time = time.time()
-    
-    while time.time() - start_time < timeout:
-        if ser.in_waiting:
-            new_data = ser.read(ser.in_waiting)
-            response += new_data
-            
-            if b'OK' in response or b'ERROR' in response:
-                time.sleep(0.3)
-                if ser.in_waiting:
-                    response += ser.read(ser.in_waiting)
-                break
-        
-        time.sleep(0.1)
-    
-    return response.decode('utf-8', errors='ignore').strip()
+def on_modem_quarantine(name, reason, remaining):
+    """Aviso de cuarentena de un módem; el email sólo cuando no queda ninguno activo"""
+    if remaining > 0:
+        logger.warning(f"Módem {name} en cuarentena ({reason}); quedan {remaining} activos")
+        return
+    error_msg = f"Ningún módem GSM disponible: {name} en cuarentena ({reason}). Se reintentará la inicialización automáticamente."
+    logger.critical(error_msg)
+    send_alert_email("Fallo de Módem GSM", error_msg)
 
 def init_modem():
-    """Inicializa y conecta el módem GSM usando pyserial"""
-    global modem
+    """Abre un pool con una sesión por módem (configuración una sola vez y sondeo en segundo plano)"""
+    global modem_pool
     try:
-        if not MODEM_PORT:
-            raise ValueError("MODEM_PORT no configurado")
-        
-        logger.info(f"Inicializando módem en puerto {MODEM_PORT}, baudrate {MODEM_BAUDRATE}")
-        modem = serial.Serial(MODEM_PORT, MODEM_BAUDRATE, timeout=3)
-        time.sleep(2)  # Dar tiempo al módem para iniciar
-        logger.info("✅ Puerto abierto")
-        
-        # Verificar que el módem responda
-        logger.info("Verificando módem (AT)...")
-        response = send_at_command(modem, 'AT')
-        logger.info(f"Respuesta: {response}")
-        
-        #if 'OK' not in response:
-        #    raise Exception("El módem no responde a comandos AT")
-        
-        # Verificar señal GSM
-        logger.info("Verificando señal GSM...")
-        response = send_at_command(modem, 'AT+CSQ')
-        logger.info(f"Señal: {response}")
-        
-        # Verificar red
-        logger.info("Verificando red...")
-        response = send_at_command(modem, 'AT+COPS?')
-        logger.info(f"Red: {response}")
-        
-        logger.info("✅ Módem conectado exitosamente")
+        if not MODEM_PORTS:
+            raise ValueError("MODEM_PORT / MODEM_PORTS no configurado")
+        
+        sessions = []
+        for port, baudrate in MODEM_PORTS:
+            logger.info(f"Inicializando módem en puerto {port}, baudrate {baudrate}")
+            sessions.append(ModemSession(port, baudrate, mode=SMS_MODE, init_commands=MODEM_INIT_COMMANDS,
+                                         probe_interval=MODEM_PROBE_INTERVAL))
+        modem_pool = ModemPool(sessions, lambda session, phone, message: send_sms_via_modem(phone, message, session),
+                               max_attempts=MODEM_MAX_ATTEMPTS, min_rssi=MODEM_MIN_RSSI,
+                               failure_threshold=MODEM_FAILURE_THRESHOLD, quarantine_base=MODEM_QUARANTINE,
+                               on_quarantine=on_modem_quarantine)
+        healthy = modem_pool.start()
+        
+        # Señal y registro ya los midió el primer sondeo de cada sesión
+        for session in sessions:
+            status = session.status()
+            if status.get("status") != "ok":
+                logger.warning(f"[{session.name}] No respondió a la configuración inicial ({status.get('error')}); se reintentará solo")
+                continue
+            logger.info(f"[{session.name}] Señal: {status.get('signal_info')} ({status.get('signal_dbm')} dBm), registro: {status.get('registration')}")
+            logger.info(f"[{session.name}] Red: {session.command('AT+COPS?').text}")
+        
+        if not healthy:
+            logger.warning("Ningún módem respondió a la configuración inicial; el pool reintentará en segundo plano")
+            return True
+        logger.info(f"✅ {healthy}/{len(sessions)} módems conectados exitosamente")
         return True
     except Exception as e:
         logger.error(f"Error inicializando módem: {e}")
-        if modem:
-            try:
-                modem.close()
-            except:
-                pass
+        if modem_pool:
+            modem_pool.close()
         return False
 
-def reconnect_modem(max_attempts=3):
-    """Reconecta el módem después de una falla"""
-    global modem
-    logger.info(f"Intentando reconectar módem ({max_attempts} intentos)")
-    
-    for attempt in range(max_attempts):
-        try:
-            if modem:
-                try:
-                    modem.close()
-                except:
-                    pass
-                time.sleep(2)
-            
-            if init_modem():
-                logger.info("Módem reconectado exitosamente")
-                return True
-                
-        except Exception as e:
-            logger.error(f"Intento {attempt+1} de reconexión falló: {e}")
-            time.sleep(5)  # Esperar entre intentos
-    
-    # Si falla después de todos los intentos, enviar email de alerta
-    error_msg = f"Módem GSM no responde después de {max_attempts} intentos de reconexión"
-    logger.critical(error_msg)
-    send_alert_email("Fallo de Módem GSM", error_msg)
-    return False
-
 def check_modem_status():
-    """Verifica el estado actual del módem usando pyserial"""
-    global modem
+    """
+    Estado agregado de los módems según el último sondeo de cada sesión (no
+    toca los puertos): 'ok' mientras al menos uno esté activo.
+    """
     try:
-        if not modem or not modem.is_open:
-            return {"status": "disconnected", "error": "Módem no inicializado o puerto cerrado"}
-        
-        # Intentar enviar comando AT
-        response = send_at_command(modem, 'AT', timeout=2)
-        
-        if 'OK' not in response:
-            return {"status": "error", "error": "Módem no responde"}
-        
-        # Verificar señal
-        signal_response = send_at_command(modem, 'AT+CSQ', timeout=2)
-        
-        return {
-            "signal_info": signal_response,
-            "network_info": "Verificado",
-            "status": "ok"
-        }
+        if not modem_pool:
+            return {"status": "disconnected", "error": "Módem no inicializado"}
+        return modem_pool.status()
     except Exception as e:
         logger.error(f"Error verificando estado del módem: {e}")
         return {"status": "error", "error": str(e)}
@@ -302,15 +283,17 @@ def format_phone_number(phone):
 
     return clean_phone
 
-def send_sms_via_modem(phone, message):
-    """Envía un SMS usando el módem GSM con pyserial"""
-    global modem
+def is_valid_phone(phone):
+    """El teléfono debe tener al menos 7 dígitos"""
+    return bool(phone) and len(phone) >= 7
+
+def send_sms_via_modem(phone, message, session):
+    """Envía un SMS por una sesión de módem (la elige el pool)"""
     try:
-        if not modem or not modem.is_open:
+        if not session or not session.connected:
             raise Exception("Módem no inicializado")
 
-        # Validar que el teléfono tenga al menos 7 dígitos
-        if not phone or len(phone) < 7:
+        if not is_valid_phone(phone):
             error = f"Teléfono inválido: {phone}"
             logger.error(error)
             return False, error
@@ -318,67 +301,22 @@ def send_sms_via_modem(phone, message):
         # Formatear número de teléfono
         clean_phone = format_phone_number(phone)
 
-        # Limpiar mensaje de caracteres especiales, acentos, ñ, etc.
-        clean_message = clean_sms_message(message)
-        logger.info(f"Enviando SMS a {clean_phone}")
+        # Limpiar mensaje: en modo PDU se conserva lo que existe en GSM-7 (ñ, é, ¿, €); en modo texto sólo ASCII
+        clean_message = to_gsm7(message) if SMS_MODE == "pdu" else clean_sms_message(message)
+        logger.info(f"[{session.name}] Enviando SMS a {clean_phone}")
         logger.debug(f"Mensaje original: {message}")
         logger.debug(f"Mensaje limpio: {clean_message}")
 
-        # Limpiar buffer antes de enviar para evitar datos residuales
-        modem.reset_input_buffer()
-        modem.reset_output_buffer()
-
-        # Configurar modo texto
-        response = send_at_command(modem, 'AT+CMGF=1')
-        if 'OK' not in response:
-            raise Exception("No se pudo configurar modo texto")
-
-        # Enviar SMS
+        # Enviar SMS: el modo ya está aplicado en la sesión, sólo se hace el intercambio de AT+CMGS
         logger.debug(f"Enviando comando AT+CMGS a {clean_phone}")
-        modem.write(f'AT+CMGS="{clean_phone}"\r\n'.encode('utf-8'))
-        time.sleep(1)
-        
-        # Esperar prompt '>'
-        timeout = 10
-        start_time = time.time()
-        prompt_received = False
-        while time.time() - start_time < timeout:
-            if modem.in_waiting:
-                data = modem.read(modem.in_waiting)
-                if b'>' in data:
-                    prompt_received = True
-                    logger.debug("Prompt '>' recibido")
-                    break
-            time.sleep(0.1)
-        
-        if not prompt_received:
-            raise Exception("Timeout esperando prompt '>' del módem")
-
-        # Enviar mensaje limpio y Ctrl+Z (0x1A)
-        modem.write(clean_message.encode('utf-8'))
-        modem.write(b'\x1A')  # Ctrl+Z
-        
-        # Esperar respuesta final
-        response = b''
-        start_time = time.time()
-        while time.time() - start_time < 30:
-            if modem.in_waiting:
-                response += modem.read(modem.in_waiting)
-                if b'+CMGS:' in response or b'OK' in response:
-                    break
-            time.sleep(0.5)
-        
-        result = response.decode('utf-8', errors='ignore')
-        logger.info(f"SMS enviado exitosamente. Respuesta: {result}")
-        
-        # Extraer referencia si existe
-        reference = "unknown"
-        if '+CMGS:' in result:
-            try:
-                reference = result.split('+CMGS:')[1].split('\n')[0].strip()
-            except:
-                pass
-        
+        if SMS_MODE == "pdu":
+            success, reference = session.send_sms_pdu(clean_phone, clean_message)
+        else:
+            success, reference = session.send_sms_text(clean_phone, clean_message)
+        if not success:
+            raise Exception(reference)
+
+        logger.info(f"[{session.name}] SMS enviado exitosamente. Referencia: {reference}")
         return True, reference
         
     except Exception as e:
@@ -386,16 +324,28 @@ def send_sms_via_modem(phone, message):
         logger.error(error, exc_info=True)
         return False, error
 
+# Pool compartido entre ciclos: evita el handshake TCP+auth en cada routine()
+db_pool = ConnectionPool(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE, size=DB_POOL_SIZE, max_idle=DB_POOL_MAX_IDLE)
+
+# Posición de lectura incremental, compartida entre ciclos
+fetch_position = HighWaterMark("mensaje_a_sms", sweep_interval=SWEEP_INTERVAL)
+
+# Intervalo entre ciclos según cuántos mensajes trajo el último lote
+poller = AdaptivePoller(BATCH_SIZE, min_interval=POLL_MIN_INTERVAL, max_interval=SLEEP, factor=POLL_BACKOFF, name="sms")
+
+# Los productores pueden despertar el bucle principal para no esperar al próximo sondeo
+waker = Waker()
+
 def with_db_connection(func):
     """
-    Decorador para abrir la conexión antes de ejecutar la función
-    y cerrarla después. Maneja reintentos si la conexión falla.
+    Decorador que toma prestada una conexión del pool antes de ejecutar
+    la función y la devuelve después. Maneja reintentos si la conexión falla.
     """
     def wrapper(*args, **kwargs):
         retries = 3
         for attempt in range(retries):
             try:
-                with Database(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE) as db:
+                with Database(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE, pool=db_pool) as db:
                     return func(db, *args, **kwargs)
             except Exception as e:
                 logger.error(f"Error de conexión a la DB (intento {attempt + 1} de {retries}): {e}", exc_info=True)
@@ -404,155 +354,175 @@ def with_db_connection(func):
         raise ConnectionError("Fallo la conexión a la base de datos.")
     return wrapper
 
+def rewind_fetch_position(db, ids):
+    """Devuelve a la lectura incremental los mensajes que quedaron sin marcar"""
+    if not INCREMENTAL_FETCH or CLAIM_LEASES or not ids:
+        return  # Con leases, los vencidos se reclaman solos
+    try:
+        fetch_position.rewind(db, ids)
+    except Exception as e:
+        logger.error(f"No se pudo retroceder la posición de lectura: {e}")
+
+def wait_for_send(phone, future, deadline):
+    """
+    Resultado de un envío encolado en el pool: (ok, detalle, módem). ok es
+    None si el envío no llegó a empezar antes de 'deadline' y se canceló. Un
+    envío ya en curso no se puede cancelar: se espera a que termine.
+    """
+    if future is None:
+        return False, f"Teléfono inválido: {phone}", None
+    try:
+        return future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FutureTimeoutError:
+        if future.cancel():
+            return None, "Plazo del lote vencido", None
+        return future.result()
+    except CancelledError:
+        return None, "Envío cancelado", None
+
 @with_db_connection
 def routine(db):
     """Rutina principal que lee mensajes no enviados y los envía por SMS via módem"""
-    global modem
+    unsent_messages = []
     try:
         logger.info("Iniciando rutina de procesamiento de mensajes SMS via módem")
         start_time = time.time()
         
-        # Verificar estado del módem antes de procesar
+        # Verificar estado de los módems antes de procesar (los que están en cuarentena se reinicializan solos)
         modem_status = check_modem_status()
-        if modem_status["status"] == "error":
-            logger.error("Módem no disponible, intentando reconectar...")
-            if not reconnect_modem():
-                logger.error("No se pudo reconectar el módem, saltando esta ejecución")
-                return
+        if modem_status["status"] != "ok":
+            logger.error(f"Ningún módem disponible ({modem_status.get('error')}), saltando esta ejecución")
+            return 0
         
         # Recuperar mensajes no enviados con un límite para evitar sobrecarga
-        query = "SELECT * FROM mensaje_a_sms WHERE men_status = 0 LIMIT 100"
-        unsent_messages = db.get_unsent(query)
+        if CLAIM_LEASES:
+            # Cada instancia reserva su propio lote; los leases vencidos de instancias caídas se reclaman solos
+            unsent_messages = db.claim_batch("mensaje_a_sms", WORKER_ID, BATCH_SIZE, LEASE_SECONDS)
+        elif INCREMENTAL_FETCH:
+            unsent_messages = fetch_position.fetch(db, BATCH_SIZE)
+        else:
+            query = f"SELECT * FROM mensaje_a_sms WHERE men_status = 0 LIMIT {BATCH_SIZE}"
+            unsent_messages = db.get_unsent(query)
         
         message_count = len(unsent_messages)
         if message_count == 0:
             logger.info("No hay mensajes SMS pendientes para enviar")
-            return
+            return 0
             
         logger.info(f"Procesando {message_count} mensajes SMS pendientes via módem")
         
+        # Pre-resolución: teléfonos de todos los clientes del lote en una sola consulta
+        phones_by_client = db.get_phones_for_clients(msg[3] for msg in unsent_messages)
+        
         messages_processed = 0
         messages_sent = 0
         messages_failed = 0
+        left_pending = []  # Mensajes que quedan sin marcar para el próximo ciclo
         
-        for msg in unsent_messages:
-            try:
-                msg_id, message, _, code_cli, _, _, _, _ = msg
-                logger.info(f"Procesando mensaje SMS ID {msg_id} para cliente {code_cli}")
-                
-                # Obtener teléfonos del cliente
-                phones_result = db.get_phone_from_code(code_cli)
+        with MarkBuffer(db, "mensaje_a_sms", MARK_FLUSH_EVERY, worker_id=WORKER_ID if CLAIM_LEASES else None) as marks:
+            # Encolar todos los envíos del lote: cada módem libre toma el siguiente y el pool reintenta
+            submitted = []  # (msg_id, [(teléfono, Future o None si es inválido)])
+            for msg in unsent_messages:
+                try:
+                    msg_id, message, _, code_cli, _, _, _, _ = msg
+                    logger.info(f"Procesando mensaje SMS ID {msg_id} para cliente {code_cli}")
                 
-                if not phones_result or not phones_result[0]:
-                    logger.warning(f"No hay teléfonos registrados para el cliente {code_cli}. Marcando mensaje como enviado.")
-                    db.mark_as_process("mensaje_a_sms", msg_id)
-                    messages_processed += 1
-                    continue
+                    # Teléfonos del cliente (ya resueltos en la pre-resolución)
+                    phones_list = split_phones(phones_by_client.get(str(code_cli)))
                 
-                phones = phones_result[0]
-                phones_list = [phone.strip() for phone in phones.split(";") if phone.strip()]
-                logger.info(f"Encontrados {len(phones_list)} teléfonos para el cliente {code_cli}")
+                    if not phones_list:
+                        logger.warning(f"No hay teléfonos registrados para el cliente {code_cli}. Marcando mensaje como enviado.")
+                        marks.add(msg_id)
+                        messages_processed += 1
+                        continue
                 
-                all_sent = True
-                phones_sent = 0
-                phones_failed = 0
-
-                for phone in phones_list:
-                    max_retries = 3
-                    success = False
-                    last_error = None
-
-                    # Reintentar hasta 3 veces por teléfono
-                    for attempt in range(1, max_retries + 1):
-                        try:
-                            logger.info(f"Intento {attempt}/{max_retries} de envío a {phone}")
-                            success, obs = send_sms_via_modem(phone, message)
-
-                            if success:
-                                phones_sent += 1
-                                logger.info(f"✅ SMS enviado exitosamente a {phone} en intento {attempt}")
-                                break  # Salir del loop de reintentos si fue exitoso
-                            else:
-                                last_error = obs
-                                logger.warning(f"Intento {attempt}/{max_retries} falló para {phone}: {obs}")
-
-                                # Si falla y no es el último intento, verificar si necesita reconexión
-                                if attempt < max_retries:
-                                    # Verificar si el error es de módem (no de red/señal)
-                                    error_str = str(obs).lower()
-                                    if any(keyword in error_str for keyword in ['módem', 'modem', 'puerto', 'port', 'timeout', 'no responde']):
-                                        logger.warning(f"Error de módem detectado, verificando conexión antes del reintento...")
-                                        # Verificar estado del módem
-                                        modem_status = check_modem_status()
-                                        if modem_status["status"] == "error":
-                                            logger.warning("Módem no disponible, intentando reconectar...")
-                                            reconnect_modem()
-
-                                    logger.info(f"Esperando 2 segundos antes del reintento {attempt + 1}...")
-                                    time.sleep(2)
-                        except Exception as phone_error:
-                            last_error = str(phone_error)
-                            logger.exception(f"Excepción en intento {attempt}/{max_retries} para {phone}: {str(phone_error)}")
-
-                            # Si es excepción y no es el último intento, verificar módem
-                            if attempt < max_retries:
-                                logger.warning(f"Excepción detectada, verificando estado del módem...")
-                                modem_status = check_modem_status()
-                                if modem_status["status"] == "error":
-                                    logger.warning("Módem no disponible, intentando reconectar...")
-                                    reconnect_modem()
-
-                                logger.info(f"Esperando 2 segundos antes del reintento {attempt + 1}...")
-                                time.sleep(2)
-
-                    # Si después de todos los intentos no fue exitoso
-                    if not success:
-                        phones_failed += 1
-                        all_sent = False
-                        logger.error(f"❌ TODOS los intentos ({max_retries}) fallaron para {phone}")
-                        # Guardar observación del último error
-                        if last_error:
-                            if isinstance(last_error, Exception):
-                                obs_text = str(last_error)
-                            else:
-                                obs_text = last_error
-                            # Escapar comillas simples para evitar errores SQL
-                            obs_text_escaped = obs_text.replace("'", "''")[:500]
-                            db.insert_obs(f"3 intentos fallidos para {phone}: {obs_text_escaped}")
-
-                # Marcar como procesado después de intentar todos los teléfonos
-                # (ya sea exitoso o fallido, después de 3 reintentos por teléfono)
-                db.mark_as_process("mensaje_a_sms", msg_id)
-                messages_processed += 1
-
-                if phones_sent > 0:
-                    if all_sent:
-                        messages_sent += 1
-                        logger.info(f"Mensaje SMS {msg_id} enviado correctamente a {phones_sent} teléfonos via módem")
-                    else:
-                        messages_failed += 1
-                        logger.warning(f"Mensaje SMS {msg_id}: {phones_sent} enviados, {phones_failed} fallidos via módem")
-                else:
-                    # Si TODOS los teléfonos fallaron después de 3 reintentos, marcar como procesado de todas formas
+                    logger.info(f"Encontrados {len(phones_list)} teléfonos para el cliente {code_cli}")
+                    submitted.append((msg_id, [(phone, modem_pool.submit(phone, message) if is_valid_phone(phone) else None)
+                                               for phone in phones_list]))
+                except Exception as msg_error:
+                    logger.exception(f"Error al procesar mensaje SMS {msg}: {str(msg_error)}")
+                    # Marcar como procesado para evitar reprocesamiento infinito en caso de error estructural
+                    try:
+                        marks.add(msg_id)
+                        logger.warning(f"Mensaje SMS {msg_id} marcado como procesado debido a error de procesamiento")
+                    except Exception as mark_error:
+                        logger.error(f"No se pudo marcar mensaje {msg_id} como procesado: {mark_error}")
                     messages_failed += 1
-                    logger.error(f"Mensaje SMS {msg_id}: TODOS los envíos fallaron ({phones_failed} teléfonos) después de 3 reintentos. Se marca como procesado para evitar bucle infinito.")
             
-            except Exception as msg_error:
-                logger.exception(f"Error al procesar mensaje SMS {msg}: {str(msg_error)}")
-                # Marcar como procesado para evitar reprocesamiento infinito en caso de error estructural
+            # Recoger resultados en orden; lo que no arrancó antes del plazo se cancela y queda para otro ciclo
+            deadline = time.monotonic() + BATCH_SEND_TIMEOUT
+            for msg_id, sends in submitted:
                 try:
-                    db.mark_as_process("mensaje_a_sms", msg_id)
-                    logger.warning(f"Mensaje SMS {msg_id} marcado como procesado debido a error de procesamiento")
-                except Exception as mark_error:
-                    logger.error(f"No se pudo marcar mensaje {msg_id} como procesado: {mark_error}")
-                messages_failed += 1
+                    phones_sent = 0
+                    phones_failed = 0
+                    phones_pending = 0
+                    
+                    for phone, future in sends:
+                        success, obs, modem_name = wait_for_send(phone, future, deadline)
+                        if success is None:
+                            phones_pending += 1
+                        elif success:
+                            phones_sent += 1
+                            logger.info(f"✅ SMS enviado exitosamente a {phone} por {modem_name}")
+                        else:
+                            phones_failed += 1
+                            logger.error(f"❌ TODOS los intentos ({MODEM_MAX_ATTEMPTS}) fallaron para {phone}")
+                            # insert_obs usa parámetros enlazados: no hace falta escapar comillas
+                            db.insert_obs(f"{MODEM_MAX_ATTEMPTS} intentos fallidos para {phone}: {str(obs)[:500]}")
+                    
+                    if phones_pending == len(sends):
+                        # Ningún envío llegó a empezar: sin marcar, se reintenta en el próximo ciclo
+                        logger.warning(f"Mensaje SMS {msg_id}: plazo del lote ({BATCH_SEND_TIMEOUT}s) vencido sin enviar, queda pendiente")
+                        left_pending.append(msg_id)
+                        continue
+                    if phones_pending:
+                        # Con envíos ya hechos no se repite el mensaje: los pendientes se registran como fallidos
+                        phones_failed += phones_pending
+                        db.insert_obs(f"Mensaje {msg_id}: {phones_pending} teléfonos sin enviar por vencer el plazo del lote")
+
+                    # Marcar como procesado después de intentar todos los teléfonos
+                    # (ya sea exitoso o fallido, después de los reintentos del pool)
+                    marks.add(msg_id)
+                    messages_processed += 1
+
+                    if phones_sent > 0:
+                        if not phones_failed:
+                            messages_sent += 1
+                            logger.info(f"Mensaje SMS {msg_id} enviado correctamente a {phones_sent} teléfonos via módem")
+                        else:
+                            messages_failed += 1
+                            logger.warning(f"Mensaje SMS {msg_id}: {phones_sent} enviados, {phones_failed} fallidos via módem")
+                    else:
+                        # Si TODOS los teléfonos fallaron después de los reintentos, marcar como procesado de todas formas
+                        messages_failed += 1
+                        logger.error(f"Mensaje SMS {msg_id}: TODOS los envíos fallaron ({phones_failed} teléfonos) después de {MODEM_MAX_ATTEMPTS} intentos. Se marca como procesado para evitar bucle infinito.")
+            
+                except Exception as msg_error:
+                    logger.exception(f"Error al procesar mensaje SMS {msg_id}: {str(msg_error)}")
+                    try:
+                        marks.add(msg_id)
+                        logger.warning(f"Mensaje SMS {msg_id} marcado como procesado debido a error de procesamiento")
+                    except Exception as mark_error:
+                        logger.error(f"No se pudo marcar mensaje {msg_id} como procesado: {mark_error}")
+                    messages_failed += 1
+        
+        if left_pending:
+            if CLAIM_LEASES:
+                # Soltar el lease para que la fila se vuelva a reservar en el próximo ciclo
+                db.release_leases("mensaje_a_sms", WORKER_ID, left_pending)
+            else:
+                # La lectura incremental ya pasó esos ids: retroceder para releerlos
+                rewind_fetch_position(db, left_pending)
         
         # Resumen de la ejecución
         execution_time = time.time() - start_time
         logger.info(f"Rutina SMS módem completada en {execution_time:.2f} segundos. Procesados: {messages_processed}, Exitosos: {messages_sent}, Fallidos: {messages_failed}")
+        return message_count
     
     except Exception as routine_error:
         logger.exception(f"Error general en la rutina SMS módem: {str(routine_error)}")
+        # Los mensajes marcados no se releen (men_status = 1); el resto del lote vuelve en el próximo ciclo
+        rewind_fetch_position(db, [msg[0] for msg in unsent_messages])
         raise  # Re-lanzamos la excepción para que se maneje en el bucle principal
 
 def health_check():
@@ -571,14 +541,24 @@ def health_check():
                 "status": "warning",
                 "last_success": LAST_SUCCESSFUL_RUN.isoformat(),
                 "seconds_since_success": time_since_last_success,
-                "modem_status": modem_status
+                "modem_status": modem_status,
+                "db_pool": db_pool.get_stats(),
+                "statements": get_statement_stats(),
+                "poller": poller.get_stats(),
+                "kicks": waker.get_stats(),
+                "modem": modem_pool.get_stats() if modem_pool else None
             }
         
         return {
             "status": "ok",
             "last_success": LAST_SUCCESSFUL_RUN.isoformat(),
             "seconds_since_success": time_since_last_success,
-            "modem_status": modem_status
+            "modem_status": modem_status,
+            "db_pool": db_pool.get_stats(),
+            "statements": get_statement_stats(),
+            "poller": poller.get_stats(),
+            "kicks": waker.get_stats(),
+            "modem": modem_pool.get_stats() if modem_pool else None
         }
     except Exception as e:
         logger.error(f"Error en health check: {str(e)}", exc_info=True)
@@ -602,14 +582,13 @@ def watchdog_check():
 
 # Maneja señales de terminación para limpieza
 def signal_handler(sig, frame):
-    global modem
     logger.info("Señal de terminación recibida. Limpiando recursos...")
-    if modem:
-        try:
-            modem.close()
-            logger.info("Puerto serie cerrado correctamente")
-        except Exception as e:
-            logger.error(f"Error cerrando puerto serie: {e}")
+    if modem_pool:
+        modem_pool.close()
+        logger.info("Puertos serie cerrados correctamente")
+    if kick_listener:
+        kick_listener.close()
+    db_pool.close_all()
     sys.exit(0)
 
 if __name__ == '__main__':
@@ -622,24 +601,38 @@ if __name__ == '__main__':
         logger.critical("No se pudo inicializar el módem. Saliendo...")
         sys.exit(1)
     
+    # Escucha kicks locales (no hay servidor HTTP en este worker)
+    try:
+        kick_listener = KickListener(waker, path=KICK_SOCKET, port=KICK_PORT)
+        kick_listener.start()
+    except (OSError, ValueError) as e:
+        kick_listener = None
+        logger.warning(f"No se pudo iniciar el listener de kicks: {e}")
+    
     # Inicia el watchdog
     watchdog_thread = Timer(60, watchdog_check)
     watchdog_thread.daemon = True
     watchdog_thread.start()
     logger.info("Watchdog iniciado")
     
+    if ARCHIVE_IN_WORKER:
+        archive_job = ArchiveJob(lambda: Database(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE, pool=db_pool),
+                                 tables=["mensaje_a_sms"], retention_days=ARCHIVE_RETENTION_DAYS)
+        archive_job.start(ARCHIVE_INTERVAL)
+        logger.info(f"Archivado en segundo plano iniciado (retención {ARCHIVE_RETENTION_DAYS} días)")
+    
     # Bucle principal mejorado
     consecutive_errors = 0
     max_consecutive_errors = 5
     
-    logger.info(f"Iniciando bucle principal SMS módem con intervalo de {SLEEP} segundos")
-    logger.info("El script chequeará la tabla mensaje_a_sms cada {} segundos".format(SLEEP))
+    logger.info(f"Iniciando bucle principal SMS módem con intervalo adaptativo entre {POLL_MIN_INTERVAL} y {SLEEP} segundos")
+    logger.info("El script chequeará la tabla mensaje_a_sms cada {} segundos como máximo".format(SLEEP))
     
     while True:
         try:
             start_time = time.time()
             logger.info(f"Chequeando tabla mensaje_a_sms para mensajes nuevos...")
-            routine()
+            fetched = routine()
             
             # Actualiza el timestamp de última ejecución exitosa
             LAST_SUCCESSFUL_RUN = datetime.now()
@@ -647,11 +640,12 @@ if __name__ == '__main__':
             
             # Calcula el tiempo que tomó la ejecución
             execution_time = time.time() - start_time
-            logger.info(f"Chequeo completado en {execution_time:.2f} segundos. Esperando {SLEEP} segundos...")
+            logger.info(f"Chequeo completado en {execution_time:.2f} segundos")
             
-            # Asegura un intervalo constante ajustando el tiempo de espera
-            sleep_time = max(0.1, SLEEP - execution_time)  # Al menos 0.1 segundos
-            time.sleep(sleep_time)
+            # Intervalo adaptativo: sin espera si hay cola, backoff si no hay mensajes
+            sleep_time = poller.next_sleep(fetched, execution_time)
+            if waker.wait(sleep_time):
+                logger.info("Kick recibido: consultando en el acto")
             
         except Exception as e:
             consecutive_errors += 1
@@ -1,13 +1,16 @@
 import os
 import logging
-import requests
 import time
 import signal
 import sys
-from dbSigesmen import Database
+import socket
+from archive_messages import ArchiveJob
+from poller import AdaptivePoller, Waker
+from dbSigesmen import Database, ConnectionPool, MarkBuffer, HighWaterMark, ChatIdCache, get_statement_stats, split_phones
+from telegram_dispatch import TelegramDispatcher, RateLimiter, DEFERRED
 import json
 import traceback
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 from threading import Thread, Timer
 from datetime import datetime
 from dotenv import load_dotenv
@@ -24,9 +27,38 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = int(os.getenv("DB_PORT", 3306))
 DB_DATABASE = os.getenv("DB_DATABASE")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "2"))
+DB_POOL_MAX_IDLE = int(os.getenv("DB_POOL_MAX_IDLE", "300"))  # Segundos ociosa antes de descartar una conexión
+MARK_FLUSH_EVERY = int(os.getenv("MARK_FLUSH_EVERY", "20"))  # Ids a acumular antes de marcarlos en lote
+BATCH_SIZE = 100  # Mensajes por ciclo
+# Reparto con leases (SELECT ... FOR UPDATE SKIP LOCKED) para correr varias instancias en paralelo
+CLAIM_LEASES = os.getenv("CLAIM_LEASES", "0") == "1"
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", "300"))  # Debe superar lo que tarda un lote completo
+WORKER_ID = os.getenv("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+# Lectura incremental por id (con barrido completo cada SWEEP_INTERVAL segundos para rezagados)
+INCREMENTAL_FETCH = os.getenv("INCREMENTAL_FETCH", "1") == "1"
+SWEEP_INTERVAL = int(os.getenv("SWEEP_INTERVAL", "60"))
+# Archivado opcional en segundo plano de las filas procesadas (ver archive_messages.py)
+ARCHIVE_IN_WORKER = os.getenv("ARCHIVE_IN_WORKER", "0") == "1"
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "30"))
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", "3600"))
+# Caché de chat_id por sufijo (se invalida con los avisos de telegram_chat_evento)
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "10000"))
+CHAT_CACHE_TTL = int(os.getenv("CHAT_CACHE_TTL", "3600"))
+CHAT_CACHE_NEGATIVE_TTL = int(os.getenv("CHAT_CACHE_NEGATIVE_TTL", "300"))  # Teléfonos sin registrar
 TOKEN = os.getenv("TOKEN")
 SLEEP = int(os.getenv("SLEEP", "10"))  # Cambiado a 10 segundos por defecto
+# Sondeo adaptativo: inmediato con lote lleno, POLL_MIN_INTERVAL con mensajes y backoff hasta SLEEP sin ellos
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "0.5"))
+POLL_BACKOFF = float(os.getenv("POLL_BACKOFF", "2"))
+# Si se define, /kick exige el header X-Kick-Token o ?token= con este valor
+KICK_TOKEN = os.getenv("KICK_TOKEN")
 REQUEST_TIMEOUT = 30  # Timeout para peticiones HTTP en segundos
+TELEGRAM_CONCURRENCY = int(os.getenv("TELEGRAM_CONCURRENCY", "8"))  # Envíos simultáneos (y conexiones keep-alive)
+# Límites anti-flood de Telegram: ~30 mensajes/s en total y ~1 mensaje/s por chat
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_MAX_INLINE_WAIT = int(os.getenv("TELEGRAM_MAX_INLINE_WAIT", "5"))  # retry_after mayores se reencolan
 REBOOT_AFTER_ATTEMPS = int(os.getenv("REBOOT_AFTER_ATTEMPS", "60"))
 
 API = f"https://api.telegram.org/bot{TOKEN}"
@@ -52,16 +84,42 @@ logging.basicConfig(level=logging.INFO, handlers=[handler])
 
 logger = logging.getLogger(__name__)
 
+# Pool compartido entre ciclos: evita el handshake TCP+auth en cada routine()
+db_pool = ConnectionPool(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE, size=DB_POOL_SIZE, max_idle=DB_POOL_MAX_IDLE)
+
+# Posición de lectura incremental, compartida entre ciclos
+fetch_position = HighWaterMark("mensaje_a_telegram", sweep_interval=SWEEP_INTERVAL)
+
+# Intervalo entre ciclos según cuántos mensajes trajo el último lote
+poller = AdaptivePoller(BATCH_SIZE, min_interval=POLL_MIN_INTERVAL, max_interval=SLEEP, factor=POLL_BACKOFF, name="telegram")
+
+# Los productores pueden despertar el bucle principal para no esperar al próximo sondeo
+waker = Waker()
+
+# chat_id ya resueltos, compartidos entre ciclos
+chat_cache = ChatIdCache(max_size=CHAT_CACHE_SIZE, ttl=CHAT_CACHE_TTL, negative_ttl=CHAT_CACHE_NEGATIVE_TTL)
+
+# Envíos concurrentes con una sesión HTTP compartida (keep-alive hacia api.telegram.org)
+dispatcher = TelegramDispatcher(API, concurrency=TELEGRAM_CONCURRENCY, timeout=REQUEST_TIMEOUT,
+                                limiter=RateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE),
+                                max_inline_wait=TELEGRAM_MAX_INLINE_WAIT)
+
+# Mensajes que quedaron sin marcar por envíos diferidos: msg_id -> índices de teléfonos ya resueltos,
+# para no repetirlos cuando la fila se vuelve a leer. Sólo vive en la memoria de este proceso: tras un
+# reinicio, o con CLAIM_LEASES si otro worker reserva la fila liberada, esos teléfonos se reenvían
+# (entrega al menos una vez, con posibles duplicados; nunca se pierde un envío).
+resolved_phones = {}
+
 def with_db_connection(func):
     """
-    Decorador para abrir la conexión antes de ejecutar la función
-    y cerrarla después. Maneja reintentos si la conexión falla.
+    Decorador que toma prestada una conexión del pool antes de ejecutar
+    la función y la devuelve después. Maneja reintentos si la conexión falla.
     """
     def wrapper(*args, **kwargs):
         retries = 3
         for attempt in range(retries):
             try:
-                with Database(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE) as db:
+                with Database(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE, pool=db_pool) as db:
                     return func(db, *args, **kwargs)
             except Exception as e:
                 logger.error(f"Error de conexión a la DB (intento {attempt + 1} de {retries}): {e}", exc_info=True)
@@ -71,137 +129,217 @@ def with_db_connection(func):
     return wrapper
 
 
+def rewind_fetch_position(db, ids):
+    """Devuelve a la lectura incremental los mensajes que quedaron sin marcar"""
+    if not INCREMENTAL_FETCH or CLAIM_LEASES or not ids:
+        return  # Con leases, los vencidos se reclaman solos
+    try:
+        fetch_position.rewind(db, ids)
+    except Exception as e:
+        logger.error(f"No se pudo retroceder la posición de lectura: {e}")
+
+
 @with_db_connection
 def routine(db):
     """Rutina principal que lee mensajes no enviados y los envía"""
+    unsent_messages = []
     try:
         logger.info("Iniciando rutina de procesamiento de mensajes")
         start_time = time.time()
         
         # Recuperar mensajes no enviados con un límite para evitar sobrecarga
-        query = "SELECT * FROM mensaje_a_telegram WHERE men_status = 0 LIMIT 100"
-        unsent_messages = db.get_unsent(query)
+        if CLAIM_LEASES:
+            # Cada instancia reserva su propio lote; los leases vencidos de instancias caídas se reclaman solos
+            unsent_messages = db.claim_batch("mensaje_a_telegram", WORKER_ID, BATCH_SIZE, LEASE_SECONDS)
+        elif INCREMENTAL_FETCH:
+            unsent_messages = fetch_position.fetch(db, BATCH_SIZE)
+        else:
+            query = f"SELECT * FROM mensaje_a_telegram WHERE men_status = 0 LIMIT {BATCH_SIZE}"
+            unsent_messages = db.get_unsent(query)
         
         message_count = len(unsent_messages)
         if message_count == 0:
             logger.info("No hay mensajes pendientes para enviar")
-            return
+            return 0
             
         logger.info(f"Procesando {message_count} mensajes pendientes")
         
+        # Pre-resolución: teléfonos de todos los clientes del lote en una sola consulta
+        phones_by_client = db.get_phones_for_clients(msg[3] for msg in unsent_messages)
+        # ... y los chat_id de todos esos teléfonos (sólo los que no están en caché) en otra
+        suffixes = {phone[-7:] for phones in phones_by_client.values() for phone in split_phones(phones) if len(phone) >= 7}
+        sync_chat_cache(db)
+        chat_ids = chat_cache.get_many(db, suffixes)
+        logger.info(f"Pre-resolución: {len(phones_by_client)} clientes, {len(chat_ids)}/{len(suffixes)} chat_id encontrados (hit ratio de caché {chat_cache.get_stats()['hit_ratio']})")
+        
         messages_processed = 0
         messages_sent = 0
         messages_failed = 0
+        left_pending = []  # Mensajes con envíos diferidos: quedan sin marcar para otro ciclo
         
-        for msg in unsent_messages:
-            try:
-                msg_id, message, _, code_cli, _, _, _, _ = msg
-                logger.info(f"Procesando mensaje ID {msg_id} para cliente {code_cli}")
-                
-                # Obtener teléfonos del cliente
-                phones_result = db.get_phone_from_code(code_cli)
+        with MarkBuffer(db, "mensaje_a_telegram", MARK_FLUSH_EVERY, worker_id=WORKER_ID if CLAIM_LEASES else None) as marks:
+            # Etapa 1: armar los envíos (chat_id de cada teléfono) sin tocar la red
+            deliveries = []  # (msg_id, cantidad de teléfonos)
+            jobs = []        # ((msg_id, índice), chat_id, texto)
+            outcomes = {}    # (msg_id, índice) -> (éxito, observación)
+            for msg in unsent_messages:
+                try:
+                    msg_id, message, _, code_cli, _, _, _, _ = msg
+                    logger.info(f"Procesando mensaje ID {msg_id} para cliente {code_cli}")
                 
-                if not phones_result or not phones_result[0]:
-                    logger.warning(f"No hay teléfonos registrados para el cliente {code_cli}. Marcando mensaje como enviado.")
-                    db.mark_as_sent(msg_id)
-                    messages_processed += 1
-                    continue
+                    # Teléfonos del cliente (ya resueltos en la pre-resolución)
+                    phones_list = split_phones(phones_by_client.get(str(code_cli)))
                 
-                phones = phones_result[0]
-                phones_list = [phone.strip() for phone in phones.split(";") if phone.strip()]
-                logger.info(f"Encontrados {len(phones_list)} teléfonos para el cliente {code_cli}")
+                    if not phones_list:
+                        logger.warning(f"No hay teléfonos registrados para el cliente {code_cli}. Marcando mensaje como enviado.")
+                        marks.add(msg_id)
+                        messages_processed += 1
+                        continue
                 
-                all_sent = True
-                phones_sent = 0
-                phones_failed = 0
-
-                for phone in phones_list:
+                    logger.info(f"Encontrados {len(phones_list)} teléfonos para el cliente {code_cli}")
+                    done = resolved_phones.get(msg_id, ())
+                    for index, phone in enumerate(phones_list):
+                        if index in done:
+                            continue  # Ya enviado (o fallido) en un ciclo anterior
+                        chat_id, error = resolve_chat_id(db, phone, chat_ids)
+                        if chat_id:
+                            jobs.append(((msg_id, index), chat_id, message))
+                        else:
+                            outcomes[(msg_id, index)] = (False, error)
+                    deliveries.append((msg_id, len(phones_list)))
+            
+                except Exception as msg_error:
+                    logger.exception(f"Error al procesar mensaje {msg}: {str(msg_error)}")
+                    # Intentar marcar como enviado para evitar reprocesamiento infinito
                     try:
-                        success, obs = send_message_to_phone(db, phone, message)
-                        
+                        marks.add(msg_id)
+                    except Exception:
+                        pass
+                    messages_failed += 1
+
+            # Etapa 2: todos los teléfonos del lote en paralelo (en orden dentro de cada chat)
+            send_start = time.time()
+            outcomes.update(dispatcher.dispatch(jobs))
+            logger.info(f"{len(jobs)} envíos despachados en {time.time() - send_start:.2f} segundos con concurrencia {dispatcher.concurrency}")
+
+            # Etapa 3: registrar el resultado de cada teléfono y marcar los mensajes
+            for msg_id, phone_count in deliveries:
+                try:
+                    phones_sent = 0
+                    phones_failed = 0
+                    phones_deferred = 0
+                    done = resolved_phones.pop(msg_id, set())
+                    for index in range(phone_count):
+                        if index in done:
+                            continue
+                        success, obs = outcomes.get((msg_id, index), (False, "Envío sin resultado"))
+                        if success is DEFERRED:
+                            phones_deferred += 1
+                            continue
+                        done.add(index)
                         if success:
                             phones_sent += 1
                         else:
                             phones_failed += 1
-                            all_sent = False
-                            # Guardar observación de error
-                            if isinstance(obs, Exception):
-                                obs_text = str(obs)
-                            else:
-                                obs_text = obs
-                            db.insert_obs(obs_text[:500])  # Limitar longitud para evitar problemas
-                    except Exception as phone_error:
-                        logger.exception(f"Error al procesar teléfono {phone}: {str(phone_error)}")
-                        phones_failed += 1
-                        all_sent = False
-
-                # Marcar el mensaje como enviado independientemente de los resultados
-                db.mark_as_sent(msg_id)
-                messages_processed += 1
+                            db.insert_obs(obs[:500])  # Limitar longitud para evitar problemas
+
+                    if phones_deferred:
+                        # Límite de Telegram: la fila queda sin marcar y se reenvía lo que falta en otro ciclo
+                        resolved_phones[msg_id] = done
+                        left_pending.append(msg_id)
+                        logger.warning(f"Mensaje {msg_id}: {phones_sent} enviados, {phones_failed} fallidos, {phones_deferred} diferidos por límite de Telegram")
+                        continue
+
+                    # Marcar el mensaje como enviado independientemente de los resultados
+                    marks.add(msg_id)
+                    messages_processed += 1
                 
-                if all_sent:
-                    messages_sent += 1
-                    logger.info(f"Mensaje {msg_id} enviado correctamente a {phones_sent} teléfonos")
-                else:
-                    messages_failed += 1
-                    logger.warning(f"Mensaje {msg_id}: {phones_sent} enviados, {phones_failed} fallidos")
+                    if phones_failed == 0:
+                        messages_sent += 1
+                        logger.info(f"Mensaje {msg_id} enviado correctamente a {phones_sent} teléfonos")
+                    else:
+                        messages_failed += 1
+                        logger.warning(f"Mensaje {msg_id}: {phones_sent} enviados, {phones_failed} fallidos")
             
-            except Exception as msg_error:
-                logger.exception(f"Error al procesar mensaje {msg}: {str(msg_error)}")
-                # Intentar marcar como enviado para evitar reprocesamiento infinito
-                try:
-                    db.mark_as_sent(msg_id)
-                except Exception:
-                    pass
-                messages_failed += 1
+                except Exception as msg_error:
+                    logger.exception(f"Error al registrar resultados del mensaje {msg_id}: {str(msg_error)}")
+                    try:
+                        marks.add(msg_id)
+                    except Exception:
+                        pass
+                    messages_failed += 1
         
+        if left_pending:
+            if CLAIM_LEASES:
+                # Soltar el lease para que la fila se vuelva a reservar en el próximo ciclo
+                db.release_leases("mensaje_a_telegram", WORKER_ID, left_pending)
+            else:
+                rewind_fetch_position(db, left_pending)
+
         # Resumen de la ejecución
         execution_time = time.time() - start_time
-        logger.info(f"Rutina completada en {execution_time:.2f} segundos. Procesados: {messages_processed}, Exitosos: {messages_sent}, Fallidos: {messages_failed}")
+        logger.info(f"Rutina completada en {execution_time:.2f} segundos. Procesados: {messages_processed}, Exitosos: {messages_sent}, Fallidos: {messages_failed}, Diferidos: {len(left_pending)}")
+        # Los diferidos no cuentan para el sondeo adaptativo: releerlos no acelera el retry_after
+        return message_count - len(left_pending)
     
     except Exception as routine_error:
         logger.exception(f"Error general en la rutina: {str(routine_error)}")
+        # Los mensajes marcados no se releen (men_status = 1); el resto del lote vuelve en el próximo ciclo
+        rewind_fetch_position(db, [msg[0] for msg in unsent_messages])
         raise  # Re-lanzamos la excepción para que se maneje en el bucle principal
 
 
 
-def send_message_to_phone(db, phone, message):
+def sync_chat_cache(db):
+    """Invalida en la caché los chat_id que telegram_server dio de alta o cambió."""
+    try:
+        changed = chat_cache.sync(db)
+        if changed:
+            logger.info(f"Caché de chat_id: {changed} avisos de cambios aplicados")
+    except Exception as e:
+        # Sin avisos no se puede confiar en la caché (p.ej. migración 004 sin aplicar)
+        logger.warning(f"No se pudieron leer los avisos de telegram_chat_evento, se vacía la caché: {e}")
+        chat_cache.clear()
+
+
+def resolve_chat_id(db, phone, chat_ids=None):
     """
-    Envía un mensaje a un teléfono específico usando la API de Telegram.
+    Busca el chat_id de un teléfono. Devuelve (chat_id, None) o (None, error).
+    Si se pasa chat_ids (mapa pre-resuelto) no se consulta la DB.
     """
-    try:
-        # Validar que el teléfono tenga al menos 7 dígitos
-        if not phone or len(phone) < 7:
-            error = f"Teléfono inválido: {phone}"
-            logger.error(error)
-            return False, error
+    # Validar que el teléfono tenga al menos 7 dígitos
+    if not phone or len(phone) < 7:
+        error = f"Teléfono inválido: {phone}"
+        logger.error(error)
+        return None, error
 
-        last_num_phone = phone[-7:]
-        chat_id_result = db.get_chat_id(last_num_phone)
+    last_num_phone = phone[-7:]
+    if chat_ids is not None:
+        chat_id = chat_ids.get(last_num_phone)
+    else:
+        chat_id = chat_cache.get(db, last_num_phone)
 
-        if chat_id_result:
-            chat_id = chat_id_result[0]
-            logger.info(f"Chat_id encontrado para teléfono terminado en {last_num_phone}: {chat_id}")
-            url = f"{API}/sendMessage?chat_id={chat_id}&text={message}"
-            logger.info(f"Enviando mensaje a URL: {url[:100]}...")  # Log primeros 100 caracteres
-            # Agregar timeout para evitar que las peticiones se queden colgadas
-            response = requests.get(url, timeout=REQUEST_TIMEOUT)
+    if not chat_id:
+        error = f"Teléfono {phone} no está registrado en la DB."
+        logger.warning(error)
+        return None, error
+    logger.info(f"Chat_id encontrado para teléfono terminado en {last_num_phone}: {chat_id}")
+    return chat_id, None
 
-            if response.status_code == 200:
-                logger.info(f"Mensaje enviado exitosamente a {phone}")
-                return True, ""
-            else:
-                error = f"Error al enviar mensaje a {phone}: Código {response.status_code}, Respuesta: {response.text}"
-                logger.error(error)
-                return False, error
-        else:
-            error = f"Teléfono {phone} no está registrado en la DB."
-            logger.warning(error)
+
+def send_message_to_phone(db, phone, message, chat_ids=None):
+    """
+    Envía un mensaje a un teléfono específico usando la API de Telegram.
+    Si se pasa chat_ids (mapa pre-resuelto) no se consulta la DB.
+    """
+    try:
+        chat_id, error = resolve_chat_id(db, phone, chat_ids)
+        if not chat_id:
             return False, error
-    except requests.Timeout:
-        error = f"Timeout al enviar mensaje a {phone}"
-        logger.error(error)
-        return False, error
+        success, obs = dispatcher.send(chat_id, message)
+        if success:
+            logger.info(f"Mensaje enviado exitosamente a {phone}")
+        return success, obs
     except Exception as e:
         error = f"Error inesperado al enviar mensaje a {phone}: {str(e)}"
         logger.error(error, exc_info=True)
@@ -221,7 +359,13 @@ def health_check():
             return jsonify({
                 "status": "warning",
                 "last_success": LAST_SUCCESSFUL_RUN.isoformat(),
-                "seconds_since_success": time_since_last_success
+                "seconds_since_success": time_since_last_success,
+                "db_pool": db_pool.get_stats(),
+                "statements": get_statement_stats(),
+                "poller": poller.get_stats(),
+                "kicks": waker.get_stats(),
+                "telegram": dispatcher.get_stats(),
+                "chat_cache": chat_cache.get_stats()
             }), 200  # Seguimos devolviendo 200 para no reiniciar el servicio automáticamente
         
         # Para pruebas, mantenemos el contador
@@ -231,12 +375,27 @@ def health_check():
         return jsonify({
             "status": "ok",
             "last_success": LAST_SUCCESSFUL_RUN.isoformat(),
-            "seconds_since_success": time_since_last_success
+            "seconds_since_success": time_since_last_success,
+            "db_pool": db_pool.get_stats(),
+            "statements": get_statement_stats(),
+            "poller": poller.get_stats(),
+            "kicks": waker.get_stats(),
+            "telegram": dispatcher.get_stats(),
+            "chat_cache": chat_cache.get_stats()
         }), 200
     except Exception as e:
         logger.error(f"Error en health check: {str(e)}", exc_info=True)
         return jsonify({"status": "error", "error": str(e)}), 500
 
+@app.route("/kick", methods=['POST', 'GET'])
+def kick():
+    """Despierta el bucle principal para que consulte la tabla sin esperar el próximo sondeo"""
+    if KICK_TOKEN and request.headers.get("X-Kick-Token", request.args.get("token")) != KICK_TOKEN:
+        return jsonify({"status": "forbidden"}), 403
+    queued = waker.kick()
+    # Si ya había un kick pendiente éste se coalesce con aquél
+    return jsonify({"status": "ok", "coalesced": not queued}), 202
+
 def watchdog_check():
     """Comprueba si el programa está funcionando correctamente y lo reinicia si es necesario"""
     global LAST_SUCCESSFUL_RUN
@@ -256,7 +415,8 @@ def watchdog_check():
 # Maneja señales de terminación para limpieza
 def signal_handler(sig, frame):
     logger.info("Señal de terminación recibida. Limpiando recursos...")
-    # Aquí podríamos realizar tareas de limpieza si fuera necesario
+    dispatcher.close()
+    db_pool.close_all()
     sys.exit(0)
 
 if __name__ == '__main__':
@@ -276,16 +436,22 @@ if __name__ == '__main__':
     watchdog_thread.start()
     logger.info("Watchdog iniciado")
     
+    if ARCHIVE_IN_WORKER:
+        archive_job = ArchiveJob(lambda: Database(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE, pool=db_pool),
+                                 tables=["mensaje_a_telegram", "telegram_observaciones"], retention_days=ARCHIVE_RETENTION_DAYS)
+        archive_job.start(ARCHIVE_INTERVAL)
+        logger.info(f"Archivado en segundo plano iniciado (retención {ARCHIVE_RETENTION_DAYS} días)")
+    
     # Bucle principal mejorado
     consecutive_errors = 0
     max_consecutive_errors = 5
     
-    logger.info(f"Iniciando bucle principal con intervalo de {SLEEP} segundos")
+    logger.info(f"Iniciando bucle principal con intervalo adaptativo entre {POLL_MIN_INTERVAL} y {SLEEP} segundos")
     while True:
         try:
             start_time = time.time()
             logger.info(f"Ejecutando rutina de verificación de mensajes...")
-            routine()
+            fetched = routine()
             
             # Actualiza el timestamp de última ejecución exitosa
             LAST_SUCCESSFUL_RUN = datetime.now()
@@ -295,9 +461,10 @@ if __name__ == '__main__':
             execution_time = time.time() - start_time
             logger.info(f"Rutina completada en {execution_time:.2f} segundos")
             
-            # Asegura un intervalo constante ajustando el tiempo de espera
-            sleep_time = max(0.1, SLEEP - execution_time)  # Al menos 0.1 segundos
-            time.sleep(sleep_time)
+            # Intervalo adaptativo: sin espera si hay cola, backoff si no hay mensajes
+            sleep_time = poller.next_sleep(fetched, execution_time)
+            if waker.wait(sleep_time):
+                logger.info("Kick recibido: consultando en el acto")
             
         except Exception as e:
             consecutive_errors += 1
@@ -0,0 +1,163 @@
+"""
+Codificación de SMS-SUBMIT en modo PDU (3GPP TS 23.040 / 23.038).
+
+En modo texto clean_sms_message quitaba acentos, ñ y todo lo no ASCII, y
+un mensaje de más de 160 caracteres salía como un único AT+CMGS que la
+red truncaba o rechazaba. build_submit_pdus() codifica en GSM-7 (con la
+tabla de extensión: €, [, ], {, }, ...) y sólo si algún carácter no
+existe en GSM-7 pasa a UCS-2. Si el texto no entra en un SMS lo parte en
+segmentos con cabecera UDH de concatenación, que el teléfono reensambla.
+"""
+import itertools
+import unicodedata
+from threading import Lock
+
+# Alfabeto GSM-7 por defecto; la posición es el valor del septeto (0x1B es el escape a la extensión)
+GSM7_BASIC = (
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM7_ESCAPE = 0x1B
+GSM7_EXTENSION = {"\f": 0x0A, "^": 0x14, "{": 0x28, "}": 0x29, "\\": 0x2F, "[": 0x3C, "~": 0x3D, "]": 0x3E,
+                  "|": 0x40, "€": 0x65}
+GSM7_CODES = {char: code for code, char in enumerate(GSM7_BASIC) if code != GSM7_ESCAPE}
+
+DCS_GSM7 = 0x00
+DCS_UCS2 = 0x08
+
+# Capacidad de un SMS (septetos GSM-7 u octetos UCS-2) sin y con cabecera de concatenación
+GSM7_SINGLE, GSM7_MULTI = 160, 153
+UCS2_SINGLE, UCS2_MULTI = 140, 134
+MAX_SEGMENTS = 255
+
+# Reemplazos para caracteres sin equivalente GSM-7 que la descomposición NFD no resuelve
+GSM7_REPLACEMENTS = {
+    "‘": "'", "’": "'", "“": '"', "”": '"', "–": "-", "—": "-", "…": "...",
+    " ": " ", "\t": " ", "`": "'", "´": "'",
+}
+
+_references = itertools.count(1)
+_references_lock = Lock()
+
+
+def next_reference():
+    """Referencia de concatenación (8 bits) distinta para cada mensaje multiparte."""
+    with _references_lock:
+        return next(_references) % 256
+
+
+def to_gsm7(text):
+    """
+    Aproxima a GSM-7 lo que tiene un equivalente cercano (á -> a, comillas
+    tipográficas -> comillas rectas) y conserva lo que GSM-7 ya tiene (ñ,
+    é, ü, ¿, €). Lo que no tiene equivalente queda igual y el mensaje sale en UCS-2.
+    """
+    if not text:
+        return text
+    result = []
+    for char in text:
+        if char in GSM7_CODES or char in GSM7_EXTENSION:
+            result.append(char)
+        elif char in GSM7_REPLACEMENTS:
+            result.append(GSM7_REPLACEMENTS[char])
+        else:
+            base = unicodedata.normalize("NFD", char)[0]
+            result.append(base if base in GSM7_CODES else char)
+    return "".join(result)
+
+
+def gsm7_septets(char):
+    """Septetos de un carácter (uno, o escape + código de la extensión), o None si no existe en GSM-7."""
+    if char in GSM7_CODES:
+        return (GSM7_CODES[char],)
+    if char in GSM7_EXTENSION:
+        return (GSM7_ESCAPE, GSM7_EXTENSION[char])
+    return None
+
+
+def pack_septets(septets, fill_bits=0):
+    """Empaqueta septetos de 7 bits en octetos, empezando después de 'fill_bits' bits de relleno."""
+    packed = bytearray()
+    value, bits = 0, fill_bits
+    for septet in septets:
+        value |= septet << bits
+        bits += 7
+        while bits >= 8:
+            packed.append(value & 0xFF)
+            value >>= 8
+            bits -= 8
+    if septets and bits:
+        packed.append(value & 0xFF)
+    return bytes(packed)
+
+
+def encode_address(number):
+    """TP-DA: cantidad de dígitos, tipo (0x91 internacional si empieza con '+') y dígitos en semi-octetos."""
+    digits = "".join(char for char in number if char.isdigit())
+    if not digits:
+        raise ValueError(f"Número inválido: {number}")
+    address_type = 0x91 if number.strip().startswith("+") else 0x81
+    padded = digits + "F" if len(digits) % 2 else digits
+    swapped = "".join(padded[i + 1] + padded[i] for i in range(0, len(padded), 2))
+    return f"{len(digits):02X}{address_type:02X}{swapped}"
+
+
+def split_text(text):
+    """
+    (dcs, segmentos): GSM-7 si todos los caracteres existen en él (cada
+    segmento es una lista de septetos), si no UCS-2 (cada segmento son
+    octetos UTF-16BE). Nunca parte un escape GSM-7 ni un par sustituto UTF-16.
+    """
+    units = [gsm7_septets(char) for char in text]
+    if all(unit is not None for unit in units):
+        dcs, single, multi = DCS_GSM7, GSM7_SINGLE, GSM7_MULTI
+        total = sum(len(unit) for unit in units)
+    else:
+        dcs, single, multi = DCS_UCS2, UCS2_SINGLE, UCS2_MULTI
+        units = [char.encode("utf-16-be") for char in text]
+        total = sum(len(unit) for unit in units)
+    if total <= single:
+        segments = [[item for unit in units for item in unit]]
+    else:
+        segments, current = [], []
+        for unit in units:
+            if len(current) + len(unit) > multi:
+                segments.append(current)
+                current = []
+            current.extend(unit)
+        segments.append(current)
+    if len(segments) > MAX_SEGMENTS:
+        raise ValueError(f"Mensaje demasiado largo: {len(segments)} segmentos (máximo {MAX_SEGMENTS})")
+    if dcs == DCS_UCS2:
+        segments = [bytes(segment) for segment in segments]
+    return dcs, segments
+
+
+def build_submit_pdus(number, text, reference=None):
+    """
+    PDUs SMS-SUBMIT para 'text' a 'number': lista de (pdu_hex, largo_tpdu),
+    una por segmento, listas para AT+CMGS=<largo_tpdu> en modo PDU. El SMSC
+    es el configurado en la SIM (octeto 00).
+    """
+    dcs, segments = split_text(text or "")
+    multipart = len(segments) > 1
+    if multipart and reference is None:
+        reference = next_reference()
+    address = encode_address(number)
+    pdus = []
+    for index, segment in enumerate(segments, 1):
+        # TP-MTI=01 (SMS-SUBMIT), sin período de validez; TP-UDHI si lleva cabecera
+        first_octet = 0x41 if multipart else 0x01
+        header = bytes([0x05, 0x00, 0x03, reference, len(segments), index]) if multipart else b""
+        if dcs == DCS_GSM7:
+            # La cabecera ocupa septetos completos: relleno hasta el próximo límite de 7 bits
+            header_septets = (len(header) * 8 + 6) // 7
+            fill_bits = header_septets * 7 - len(header) * 8
+            user_data = header + pack_septets(segment, fill_bits)
+            user_data_length = header_septets + len(segment)
+        else:
+            user_data = header + segment
+            user_data_length = len(user_data)
+        tpdu = f"{first_octet:02X}00{address}00{dcs:02X}{user_data_length:02X}{user_data.hex().upper()}"
+        pdus.append(("00" + tpdu, len(tpdu) // 2))
+    return pdus
@@ -0,0 +1,292 @@
+"""
+Envío concurrente de mensajes a la API de Telegram.
+
+Todos los envíos comparten una requests.Session con un pool de conexiones
+keep-alive, así que sólo el primer mensaje de cada conexión paga el
+handshake TLS. Los trabajos se agrupan en "carriles" por chat_id: cada
+carril corre secuencialmente en un hilo del pool (se preserva el orden
+dentro de un chat) y los distintos chats avanzan en paralelo.
+
+Antes de cada envío el RateLimiter reserva turno en dos token buckets, uno
+global (~30 msg/s) y otro por chat (~1 msg/s), para no caer en los límites
+anti-flood de Telegram. Si aun así llega un 429, se respeta su retry_after:
+las esperas cortas se reintentan en el momento y las largas devuelven
+DEFERRED (junto con el resto del carril, para no desordenar el chat). Los
+mensajes diferidos no se guardan en memoria: el llamador deja la fila sin
+marcar y la vuelve a despachar en un ciclo posterior; mientras el chat siga
+frenado, dispatch() los difiere sin enviarlos.
+"""
+import time
+import logging
+import itertools
+import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Resultado de un envío diferido por un 429: (DEFERRED, observación). No se envió
+# y no queda en memoria: el llamador debe volver a despacharlo más tarde.
+# Centinela propio (comparar con 'is') para no confundirlo con un resultado vacío.
+DEFERRED = object()
+MAX_INLINE_RETRIES = 3  # 429 cortos seguidos antes de diferir
+MAX_TRACKED_DEFERRALS = 10000  # Claves con 429 recordadas para el tope de max_deferrals
+
+
+class TokenBucket(object):
+    """
+    Token bucket expresado como "próximo turno libre" (GCRA): con 'rate'
+    envíos por segundo y ráfagas de hasta 'capacity'. No es thread-safe;
+    lo protege el lock del RateLimiter.
+    """
+    def __init__(self, rate, capacity=1):
+        self.interval = 1.0 / rate
+        self.tolerance = (max(1, capacity) - 1) * self.interval
+        self.tat = 0.0  # Instante teórico en que el balde vuelve a estar lleno
+
+    def next_slot(self, t):
+        """Primer instante >= t en que hay un token disponible."""
+        return max(t, self.tat - self.tolerance)
+
+    def take(self, t):
+        self.tat = max(self.tat, t) + self.interval
+
+    def idle(self, now):
+        return self.tat <= now
+
+
+class RateLimiter(object):
+    """Límite global y por chat, más bloqueos explícitos por retry_after."""
+    def __init__(self, global_rate=30, chat_rate=1, global_burst=None, chat_burst=1):
+        self.__lock = Lock()
+        self.__global = TokenBucket(global_rate, global_burst or int(global_rate))
+        self.__chat_rate = chat_rate
+        self.__chat_burst = chat_burst
+        self.__chats = {}          # chat_id -> TokenBucket
+        self.__blocked_until = {}  # chat_id -> instante (monotonic) hasta el que no se envía
+
+    def reserve(self, chat_id):
+        """Reserva el próximo turno para el chat. Devuelve cuántos segundos esperar."""
+        with self.__lock:
+            now = time.monotonic()
+            bucket = self.__chats.get(chat_id)
+            if bucket is None:
+                if len(self.__chats) > 1000:
+                    self.__prune(now)
+                bucket = self.__chats[chat_id] = TokenBucket(self.__chat_rate, self.__chat_burst)
+            slot = max(now, self.__blocked_until.get(chat_id, 0.0))
+            slot = max(bucket.next_slot(slot), self.__global.next_slot(slot))
+            slot = max(bucket.next_slot(slot), self.__global.next_slot(slot))
+            bucket.take(slot)
+            self.__global.take(slot)
+            return slot - now
+
+    def acquire(self, chat_id):
+        """Bloquea hasta que el chat puede enviar. Devuelve los segundos esperados."""
+        wait = self.reserve(chat_id)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def blocked_for(self, chat_id):
+        """Segundos que le quedan al chat frenado por un retry_after (0 si no lo está)."""
+        with self.__lock:
+            return max(0.0, self.__blocked_until.get(chat_id, 0.0) - time.monotonic())
+
+    def block(self, chat_id, seconds):
+        """Frena al chat 'seconds' segundos (retry_after de un 429)."""
+        with self.__lock:
+            until = time.monotonic() + seconds
+            self.__blocked_until[chat_id] = max(self.__blocked_until.get(chat_id, 0.0), until)
+
+    def __prune(self, now):
+        """Descarta baldes llenos (equivalen a uno nuevo) y bloqueos vencidos."""
+        self.__chats = {chat_id: bucket for chat_id, bucket in self.__chats.items() if not bucket.idle(now)}
+        self.__blocked_until = {chat_id: until for chat_id, until in self.__blocked_until.items() if until > now}
+
+
+def parse_retry_after(response, default=1):
+    """Segundos a esperar según un 429: parameters.retry_after del cuerpo o el header Retry-After."""
+    try:
+        return max(1, int(response.json()["parameters"]["retry_after"]))
+    except (ValueError, KeyError, TypeError):
+        pass
+    try:
+        return max(1, int(response.headers.get("Retry-After")))
+    except (ValueError, TypeError):
+        return default
+
+
+class TelegramDispatcher(object):
+    """
+    Despachador con un pool de 'concurrency' hilos y otras tantas conexiones
+    HTTP reutilizables hacia api.telegram.org.
+    Los 429 con retry_after <= max_inline_wait se reintentan en el carril;
+    los más largos se difieren. Un mismo trabajo (misma clave entre
+    despachos) se difiere por 429 hasta max_deferrals veces y después se da
+    por fallido. El tope cuenta sólo los 429 reales: los trabajos de un chat
+    todavía frenado se difieren sin enviarlos y sin contar, porque el freno
+    vence con su retry_after y el próximo despacho sí intenta el envío (y un
+    nuevo 429 cuenta para todo el carril). Así una fila no queda sin marcar
+    más allá de max_deferrals retry_after seguidos.
+    """
+    def __init__(self, api, concurrency=8, timeout=30, limiter=None, max_inline_wait=5, max_deferrals=5):
+        self.__api = api
+        self.__timeout = timeout
+        self.concurrency = concurrency
+        self.limiter = limiter or RateLimiter()
+        self.__max_inline_wait = max_inline_wait
+        self.__max_deferrals = max_deferrals
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.__executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="telegram")
+        self.__lock = Lock()
+        self.__deferrals = OrderedDict()  # clave -> cantidad de 429 que la difirieron
+        self.__stats = {"sent": 0, "failed": 0, "batches": 0, "lanes": 0, "send_seconds": 0.0,
+                        "throttled": 0, "inline_retries": 0, "deferred": 0, "blocked": 0, "wait_seconds": 0.0}
+
+    def __count(self, name, amount=1):
+        with self.__lock:
+            self.__stats[name] += amount
+
+    def __post(self, chat_id, text):
+        """Un único intento HTTP. Devuelve (éxito, observación, retry_after o None)."""
+        start_time = time.time()
+        retry_after = None
+        try:
+            # params= codifica el texto (la URL armada a mano rompía con '&', '#', etc.)
+            response = self.session.get(f"{self.__api}/sendMessage",
+                                        params={"chat_id": chat_id, "text": text},
+                                        timeout=self.__timeout)
+            if response.status_code == 200:
+                result = (True, "")
+            else:
+                if response.status_code == 429:
+                    retry_after = parse_retry_after(response)
+                result = (False, f"Error al enviar mensaje al chat {chat_id}: Código {response.status_code}, Respuesta: {response.text}")
+        except requests.Timeout:
+            result = (False, f"Timeout al enviar mensaje al chat {chat_id}")
+        except requests.RequestException as e:
+            result = (False, f"Error de conexión al enviar mensaje al chat {chat_id}: {e}")
+        self.__count("send_seconds", time.time() - start_time)
+        return result + (retry_after,)
+
+    def __deliver(self, chat_id, text):
+        """
+        Envía respetando el RateLimiter y reintenta los 429 cortos.
+        Devuelve (éxito, observación, retry_after) con retry_after sólo si hay que reencolar.
+        """
+        for attempt in itertools.count(1):
+            self.__count("wait_seconds", self.limiter.acquire(chat_id))
+            success, obs, retry_after = self.__post(chat_id, text)
+            if retry_after is None:
+                self.__count("sent" if success else "failed")
+                if not success:
+                    logger.error(obs)
+                return success, obs, None
+            self.__count("throttled")
+            self.limiter.block(chat_id, retry_after)
+            if retry_after > self.__max_inline_wait or attempt > MAX_INLINE_RETRIES:
+                return False, obs, retry_after
+            logger.warning(f"429 en el chat {chat_id}: reintentando en {retry_after} segundos")
+            self.__count("inline_retries")
+
+    def send(self, chat_id, text):
+        """Envía un mensaje a un chat (sin reencolar). Devuelve (éxito, observación)."""
+        success, obs, retry_after = self.__deliver(chat_id, text)
+        if retry_after is not None:
+            self.__count("failed")
+            logger.error(obs)
+        return success, obs
+
+    def __defer(self, chat_id, retry_after, keys):
+        """Difiere las claves del chat tras un 429. Devuelve {clave: resultado}."""
+        results = {}
+        with self.__lock:
+            for key in keys:
+                deferrals = self.__deferrals.pop(key, 0) + 1
+                if deferrals > self.__max_deferrals:
+                    obs = f"Mensaje al chat {chat_id} descartado tras {self.__max_deferrals} diferimientos por límite de Telegram"
+                    logger.error(obs)
+                    results[key] = (False, obs)
+                    self.__stats["failed"] += 1
+                    continue
+                self.__deferrals[key] = deferrals
+                results[key] = (DEFERRED, f"Diferido para el chat {chat_id} por {retry_after} segundos")
+                self.__stats["deferred"] += 1
+            while len(self.__deferrals) > MAX_TRACKED_DEFERRALS:
+                self.__deferrals.popitem(last=False)
+        deferred = sum(1 for success, _ in results.values() if success is DEFERRED)
+        if deferred:
+            logger.warning(f"Límite de Telegram en el chat {chat_id}: {deferred} mensajes diferidos por {retry_after} segundos")
+        return results
+
+    def __run_lane(self, chat_id, jobs):
+        """Envía en orden todos los trabajos (clave, texto) de un mismo chat."""
+        results = {}
+        for position, (key, text) in enumerate(jobs):
+            success, obs, retry_after = self.__deliver(chat_id, text)
+            if retry_after is not None:
+                # Diferir también el resto del carril para no desordenar el chat
+                results.update(self.__defer(chat_id, retry_after, [key for key, _ in jobs[position:]]))
+                break
+            with self.__lock:
+                self.__deferrals.pop(key, None)
+            results[key] = (success, obs)
+        return results
+
+    def dispatch(self, jobs):
+        """
+        jobs: iterable de (clave, chat_id, texto), en el orden en que deben
+        llegar a cada chat. Devuelve {clave: (éxito, observación)}, donde éxito
+        es DEFERRED si no se envió por el límite de Telegram y hay que volver
+        a despacharlo en un ciclo posterior. Los chats todavía frenados por un
+        retry_after largo se difieren sin intentar el envío; esos diferimientos
+        no cuentan para max_deferrals (ver la clase).
+        """
+        lanes = OrderedDict()
+        results = {}
+        for key, chat_id, text in jobs:
+            if chat_id not in lanes:
+                blocked = self.limiter.blocked_for(chat_id)
+                if blocked > self.__max_inline_wait:
+                    results[key] = (DEFERRED, f"Chat {chat_id} frenado por límite de Telegram {blocked:.0f} segundos más")
+                    self.__count("blocked")
+                    continue
+            lanes.setdefault(chat_id, []).append((key, text))
+        if not lanes:
+            return results
+
+        futures = {self.__executor.submit(self.__run_lane, chat_id, lane): (chat_id, lane) for chat_id, lane in lanes.items()}
+        for future in as_completed(futures):
+            try:
+                results.update(future.result())
+            except Exception as e:
+                # No debería pasar (__post atrapa sus errores), pero no perder el resultado del carril
+                chat_id, lane = futures[future]
+                logger.error(f"Error inesperado en el carril del chat {chat_id}: {e}", exc_info=True)
+                for key, _ in lane:
+                    results.setdefault(key, (False, f"Error inesperado al enviar mensaje al chat {chat_id}: {e}"))
+
+        with self.__lock:
+            self.__stats["batches"] += 1
+            self.__stats["lanes"] += len(lanes)
+        return results
+
+    def get_stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats["tracked_deferrals"] = len(self.__deferrals)
+        attempts = stats["sent"] + stats["failed"] + stats["throttled"]
+        stats["avg_send_seconds"] = round(stats.pop("send_seconds") / attempts, 3) if attempts else 0.0
+        stats["wait_seconds"] = round(stats["wait_seconds"], 2)
+        stats["concurrency"] = self.concurrency
+        return stats
+
+    def close(self):
+        self.__executor.shutdown(wait=False)
+        self.session.close()
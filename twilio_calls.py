@@ -0,0 +1,102 @@
+"""
+Cliente Twilio de larga vida para las llamadas de alarma.
+
+Antes cada llamada creaba un twilio.rest.Client nuevo, con su propia
+sesión HTTP: cada alarma pagaba conexión TCP + TLS hacia api.twilio.com.
+TwilioClientHolder construye un único Client sobre un TwilioHttpClient con
+pool keep-alive, lo comparte entre hilos y lo reconstruye recién cuando
+hace falta (credenciales rechazadas o conexión caída).
+"""
+import time
+import logging
+import requests
+from collections import deque
+from threading import Lock
+from requests.adapters import HTTPAdapter
+from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+from twilio.base.exceptions import TwilioRestException
+
+logger = logging.getLogger(__name__)
+
+# Estados HTTP de Twilio que indican credenciales inválidas o revocadas
+CREDENTIAL_ERRORS = (401, 403)
+
+
+class TwilioClientHolder(object):
+    """
+    Client compartido y thread-safe. connect_timeout y read_timeout se
+    aplican por separado a cada request a la API (no confundir con el
+    'timeout' de calls.create, que es cuánto suena el teléfono).
+    """
+    def __init__(self, account_sid, auth_token, connect_timeout=5, read_timeout=30, pool_size=8):
+        self.__account_sid = account_sid
+        self.__auth_token = auth_token
+        self.__timeout = (connect_timeout, read_timeout)
+        self.__pool_size = pool_size
+        self.__client = None
+        self.__lock = Lock()
+        self.__latencies = deque(maxlen=200)  # Últimas latencias de API (segundos)
+        self.__stats = {"calls": 0, "errors": 0, "builds": 0, "latency_total": 0.0, "latency_max": 0.0}
+
+    def __build(self):
+        http_client = TwilioHttpClient(pool_connections=True)
+        # TwilioHttpClient sólo valida timeouts numéricos en el constructor;
+        # requests acepta la tupla (connect, read) tal cual
+        http_client.timeout = self.__timeout
+        http_client.session.mount("https://", HTTPAdapter(pool_maxsize=self.__pool_size))
+        self.__stats["builds"] += 1
+        logger.info(f"Cliente Twilio creado (pool de {self.__pool_size} conexiones, timeouts {self.__timeout})")
+        return Client(self.__account_sid, self.__auth_token, http_client=http_client)
+
+    def get(self):
+        """Devuelve el Client compartido, creándolo si hace falta."""
+        with self.__lock:
+            if self.__client is None:
+                self.__client = self.__build()
+            return self.__client
+
+    def invalidate(self, reason):
+        """Descarta el Client actual; el próximo get() arma uno nuevo."""
+        with self.__lock:
+            if self.__client is not None:
+                logger.warning(f"Descartando cliente Twilio: {reason}")
+                self.__client = None
+
+    def create_call(self, **kwargs):
+        """calls.create sobre el Client compartido, midiendo la latencia de la API."""
+        client = self.get()
+        start_time = time.perf_counter()
+        try:
+            return client.calls.create(**kwargs)
+        except TwilioRestException as e:
+            if e.status in CREDENTIAL_ERRORS:
+                self.invalidate(f"credenciales rechazadas ({e.status})")
+            self.__count_error()
+            raise
+        except (requests.ConnectionError, requests.Timeout) as e:
+            self.invalidate(f"error de conexión ({e.__class__.__name__})")
+            self.__count_error()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start_time
+            with self.__lock:
+                self.__stats["calls"] += 1
+                self.__stats["latency_total"] += elapsed
+                self.__stats["latency_max"] = max(self.__stats["latency_max"], elapsed)
+                self.__latencies.append(elapsed)
+            logger.info(f"Twilio calls.create respondió en {elapsed * 1000:.0f} ms")
+
+    def __count_error(self):
+        with self.__lock:
+            self.__stats["errors"] += 1
+
+    def get_stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            recent = sorted(self.__latencies)
+        total = stats.pop("latency_total")
+        stats["latency_avg_ms"] = round(total / stats["calls"] * 1000) if stats["calls"] else 0
+        stats["latency_max_ms"] = round(stats.pop("latency_max") * 1000)
+        stats["latency_p95_ms"] = round(recent[min(len(recent) - 1, int(len(recent) * 0.95))] * 1000) if recent else 0
+        return stats